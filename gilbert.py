@@ -563,3 +563,54 @@ def gilbert_block_neighbor_mapping(t, h, w, block_size=128, transpose_order=None
     print(f"Calculated neighborhood relationships for {len(block_neighbors_list)} blocks")
     # print(block_neighbors_list)
     return block_neighbor_tensor
+
+
+def gilbert_patch_index(hilbert_order, t, h, w, patch_size=[1, 2, 2]):
+    """
+    Build a gather index that reads a latent grid patch by patch in Gilbert curve order
+
+    Parameters:
+        hilbert_order: Linear token indices in Gilbert curve order (list or LongTensor of length t*h*w)
+        t, h, w: Token grid size (latent size divided by patch size)
+        patch_size: Patch size [pt, ph, pw] of the patch embedding
+
+    Returns:
+        patch_index: LongTensor of shape [t*h*w, pt*ph*pw], flat positions in the
+                     [t*pt, h*ph, w*pw] latent grid for each token (curve order) and patch element
+    """
+    pt, ph, pw = patch_size
+    hilbert_order = torch.as_tensor(hilbert_order, dtype=torch.long)
+    tok_t = (hilbert_order // (h * w)).view(-1, 1, 1, 1)
+    tok_h = (hilbert_order // w % h).view(-1, 1, 1, 1)
+    tok_w = (hilbert_order % w).view(-1, 1, 1, 1)
+
+    lat_t = tok_t * pt + torch.arange(pt).view(1, -1, 1, 1)
+    lat_h = tok_h * ph + torch.arange(ph).view(1, 1, -1, 1)
+    lat_w = tok_w * pw + torch.arange(pw).view(1, 1, 1, -1)
+    patch_index = (lat_t * (h * ph) + lat_h) * (w * pw) + lat_w
+    return patch_index.reshape(hilbert_order.numel(), pt * ph * pw)
+
+
+def curve_patchify(latents, patch_index):
+    """
+    [B, C, T, H, W] latents -> [B, L, C*pt*ph*pw] tokens in curve order, with a single gather.
+    The feature layout (c, pt, ph, pw) matches both PatchEmbed weights and FinalLayer outputs.
+    """
+    b, c = latents.shape[:2]
+    num_tokens, patch_numel = patch_index.shape
+    tokens = latents.flatten(2).index_select(2, patch_index.flatten())
+    tokens = tokens.view(b, c, num_tokens, patch_numel).transpose(1, 2)
+    return tokens.reshape(b, num_tokens, c * patch_numel)
+
+
+def curve_unpatchify(tokens, patch_index, latent_size):
+    """
+    [B, L, C*pt*ph*pw] tokens in curve order -> [B, C, T, H, W] latents, with a single scatter.
+    """
+    b, num_tokens, feat = tokens.shape
+    patch_numel = patch_index.shape[1]
+    c = feat // patch_numel
+    tokens = tokens.view(b, num_tokens, c, patch_numel).transpose(1, 2).reshape(b, c, -1)
+    latents = tokens.new_empty(b, c, tokens.shape[-1])
+    latents.index_copy_(2, patch_index.flatten(), tokens)
+    return latents.view(b, c, *latent_size)
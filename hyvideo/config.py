@@ -1,7 +1,6 @@
 import argparse
 from .constants import *
 import re
-from .modules.models import HUNYUAN_VIDEO_CONFIG
 
 
 def parse_args(namespace=None):
@@ -77,6 +76,21 @@ def add_extra_models_args(parser: argparse.ArgumentParser):
         help="Enable tiling for the VAE model to save GPU memory.",
     )
     group.set_defaults(vae_tiling=True)
+    group.add_argument(
+        "--vae-tile-batch-size",
+        type=int,
+        default=1,
+        help="Number of same-shape VAE tiles decoded in one call. Peak VAE memory grows linearly with it "
+        "(one micro-batch of tile activations on top of the output).",
+    )
+    group.add_argument(
+        "--vae-stream-chunk",
+        type=int,
+        default=0,
+        help="Decode the video causally in chunks of this many latent frames, caching conv/attention "
+        "state across chunks instead of blending temporal tiles. Spatial tiling still applies with "
+        "--vae-tiling. 0 disables streaming decode.",
+    )
 
     group.add_argument(
         "--text-encoder",
@@ -261,6 +275,31 @@ def add_inference_args(parser: argparse.ArgumentParser):
         action="store_true",
         help="Use CPU offload for the model load.",
     )
+    group.add_argument(
+        "--residency-budget-gb",
+        type=float,
+        default=None,
+        help="Device memory (GB) for model weights. When set, the text encoders, DiT and VAE are only "
+        "kept on the device during their own phase, except those that fit in the budget. They are loaded on "
+        "the host, so they need not fit on the device together.",
+    )
+    group.add_argument(
+        "--block-offload",
+        action="store_true",
+        help="Keep DiT blocks in pinned host memory and prefetch them to the GPU block by block.",
+    )
+    group.add_argument(
+        "--offload-resident-blocks",
+        type=int,
+        default=0,
+        help="Number of leading DiT blocks kept on the GPU with --block-offload.",
+    )
+    group.add_argument(
+        "--offload-prefetch",
+        type=int,
+        default=1,
+        help="How many DiT blocks ahead to prefetch with --block-offload.",
+    )
 
     # ======================== Inference general setting ========================
     group.add_argument(
@@ -298,6 +337,39 @@ def add_inference_args(parser: argparse.ArgumentParser):
         default="",
         help="Suffix for the names of saved samples.",
     )
+    group.add_argument(
+        "--async-save",
+        action="store_true",
+        help="Keep decoded videos on the device, convert them to uint8 there and encode them in a background "
+        "thread, so the next prompt starts while the previous video is being written.",
+    )
+    group.add_argument(
+        "--decode-worker",
+        type=str,
+        default="none",
+        choices=["none", "thread", "spool"],
+        help="Decode and save videos outside the sampling loop. 'thread' decodes in a background thread "
+        "of this process, 'spool' writes latents to --latent-spool-dir for a separate decode process "
+        "(python -m hyvideo.utils.decode_worker) that can serve several samplers.",
+    )
+    group.add_argument(
+        "--decode-queue-size",
+        type=int,
+        default=2,
+        help="Maximum number of latents waiting for the decode worker before sampling blocks.",
+    )
+    group.add_argument(
+        "--latent-spool-dir",
+        type=str,
+        default=None,
+        help="Spool directory of --decode-worker spool. Defaults to <save-path>/latent_spool.",
+    )
+    group.add_argument(
+        "--decode-idle-timeout",
+        type=float,
+        default=0.0,
+        help="Stop the spool decode worker after this many idle seconds. 0 waits for a STOP file.",
+    )
     group.add_argument(
         "--num-videos",
         type=int,
@@ -355,6 +427,16 @@ def add_inference_args(parser: argparse.ArgumentParser):
         # choices=["no_neighbor", "linear"],
         help="curve type",
     )
+    group.add_argument(
+        "--curve-native",
+        action="store_true",
+        help="Keep latents patchified in space-curve order across steps instead of re-indexing every forward.",
+    )
+    group.add_argument(
+        "--precompute-modulation",
+        action="store_true",
+        help="Precompute block modulations and refined text for all timesteps once per schedule.",
+    )
     # --- disable-txt-amp ---
     group.add_argument(
         "--scale-txt-amp",
@@ -407,6 +489,19 @@ def add_inference_args(parser: argparse.ArgumentParser):
         default=0,
         help="current gpu thread id",
     )
+    # --- dynamic prompt distribution ---
+    group.add_argument(
+        "--prompt-queue",
+        action="store_true",
+        help="Claim prompts dynamically from a queue in the save directory shared by all workers, instead of "
+        "the static --cur-id/--chunk-num shards. Finished prompts are skipped when the run is restarted.",
+    )
+    group.add_argument(
+        "--prompt-lease-seconds",
+        type=float,
+        default=600.0,
+        help="Lease of a claimed prompt. Prompts of a crashed worker are claimed again after it expires.",
+    )
     group.add_argument(
         "--seed-type",
         type=str,
@@ -432,12 +527,34 @@ def add_inference_args(parser: argparse.ArgumentParser):
         default=6.0,
         help="Embeded classifier free guidance scale.",
     )
+    group.add_argument(
+        "--cfg-truncate-step",
+        type=int,
+        default=None,
+        help="From this denoising step on, run only the cond branch and reuse the guidance delta of the "
+        "last full step. The first step at a new ProRes resolution still runs both branches.",
+    )
+    group.add_argument(
+        "--cfg-truncate-stage",
+        type=int,
+        default=None,
+        help="Like --cfg-truncate-step, from this ProRes stage on.",
+    )
 
     group.add_argument(
         "--use-fp8",
         action="store_true",
         help="Enable use fp8 for inference acceleration."
     )
+    group.add_argument(
+        "--fp8-strategy",
+        type=str,
+        default="dequant_per_call",
+        choices=["dequant_per_call", "dequant_on_load", "stream", "scaled_mm"],
+        help="How fp8 linears run: dequantize the whole weight on every call (the original behavior), "
+        "dequantize once to bf16 on load, stream per-block dequant into a shared scratch buffer, or use "
+        "scaled fp8 matmul (falls back to stream where unsupported).",
+    )
 
     group.add_argument(
         "--reproduce",
@@ -464,6 +581,24 @@ def add_parallel_args(parser: argparse.ArgumentParser):
         default=1,
         help="Ulysses degree.",
     )
+    group.add_argument(
+        "--unpacked-qkv-all-to-all",
+        action="store_true",
+        help="Use one all-to-all per tensor in Ulysses attention instead of the packed q/k/v all-to-all.",
+    )
+    group.add_argument(
+        "--head-balance-interval",
+        type=int,
+        default=0,
+        help="Every this many steps, reassign Ulysses attention heads to ranks so each rank computes the same "
+        "number of selected sparse blocks. 0 keeps contiguous head slices.",
+    )
+    group.add_argument(
+        "--cfg-parallel",
+        action="store_true",
+        help="Run the uncond and cond halves of classifier free guidance on two rank groups, "
+        "doubling the world size to 2 x ulysses_degree x ring_degree.",
+    )
 
     return parser
 
@@ -482,4 +617,9 @@ def sanity_check_args(args):
         raise ValueError(
             f"Latent channels ({args.latent_channels}) must match the VAE channels ({vae_channels})."
         )
+    if args.cfg_parallel and args.cfg_scale <= 1:
+        raise ValueError("--cfg-parallel needs --cfg-scale > 1.")
+    # With CFG parallel both halves already run concurrently, and all ranks share the step-cache all-reduce.
+    if args.cfg_parallel and (args.cfg_truncate_step is not None or args.cfg_truncate_stage is not None):
+        raise ValueError("--cfg-truncate-step/--cfg-truncate-stage cannot be combined with --cfg-parallel.")
     return args
@@ -14,6 +14,7 @@ __all__ = [
     "TEXT_PROJECTION",
     "DATA_TYPE",
     "NEGATIVE_PROMPT",
+    "HUNYUAN_VIDEO_CONFIG",
 ]
 
 PRECISION_TO_TYPE = {
@@ -88,3 +89,25 @@ TEXT_PROJECTION = {
     "linear",  # Default, an nn.Linear() layer
     "single_refiner",  # Single TokenRefiner. Refer to LI-DiT
 }
+
+# =================== Model Configs =====================
+# Kept here (not in the model modules) so argument parsing does not import the model stack.
+HUNYUAN_VIDEO_CONFIG = {
+    "HYVideo-T/2": {
+        "mm_double_blocks_depth": 20,
+        "mm_single_blocks_depth": 40,
+        "rope_dim_list": [16, 56, 56],
+        "hidden_size": 3072,
+        "heads_num": 24,
+        "mlp_width_ratio": 4,
+    },
+    "HYVideo-T/2-cfgdistill": {
+        "mm_double_blocks_depth": 20,
+        "mm_single_blocks_depth": 40,
+        "rope_dim_list": [16, 56, 56],
+        "hidden_size": 3072,
+        "heads_num": 24,
+        "mlp_width_ratio": 4,
+        "guidance_embed": True,
+    },
+}
@@ -50,8 +50,10 @@ from ...modules import HYVideoDiffusionTransformer
 from hyvideo.diffusion.pipelines.pipeline_hunyuan_video import HunyuanVideoPipeline
 
 # JENGA: space curve related.
-from gilbert import gilbert_mapping
+from gilbert import gilbert_mapping, gilbert_patch_index, curve_patchify, curve_unpatchify
 from hyvideo.modules.posemb_layers import get_nd_rotary_pos_embed, get_meshgrid_nd
+from hyvideo.modules.attenion import get_cu_seqlens
+from hyvideo.utils.cfg_parallel import CFGTruncation, cond_half
 import math
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
@@ -283,6 +285,41 @@ class HunyuanVideoPipelineProRes(HunyuanVideoPipeline):
         )
         return freqs_cos, freqs_sin
 
+    def get_seqlens_meta(self, text_mask, current_size):
+        """
+        Flash attention metadata for one stage. The token count only changes at stage
+        boundaries, so this is computed once per stage instead of in every forward.
+        Under sequence parallel, each rank attends over its local chunk of image tokens.
+        """
+        img_seq_len = current_size[0] * current_size[1] * current_size[2]
+        if dist.is_initialized():
+            # The CFG group splits the batch, not the sequence.
+            cfg_parallel = getattr(self, "cfg_parallel", None)
+            img_seq_len = img_seq_len // (dist.get_world_size() // (cfg_parallel.world_size if cfg_parallel else 1))
+        cu_seqlens = get_cu_seqlens(text_mask, img_seq_len)
+        max_seqlen = img_seq_len + text_mask.shape[1]
+        return cu_seqlens, max_seqlen
+
+    def to_curve_native(self, latents, current_size, freqs_cis):
+        """
+        JENGA: move the scheduler state of a stage into curve order once, so the transformer
+        neither gathers nor scatters the sequence on every step.
+
+        Returns the patchified latents [B, L, C*pt*ph*pw], the curve-ordered rope freqs, the patch
+        index and the spatial latent size needed to convert back at the end of the stage.
+        """
+        latent_size = list(latents.shape[2:])
+        patch_index = gilbert_patch_index(
+            self.transformer.hilbert_order, *current_size, self.transformer.patch_size
+        ).to(latents.device)
+        hilbert_order = torch.as_tensor(self.transformer.hilbert_order, dtype=torch.long)
+        freqs_cis = (
+            freqs_cis[0][hilbert_order.to(freqs_cis[0].device)],
+            freqs_cis[1][hilbert_order.to(freqs_cis[1].device)],
+        )
+        latents = curve_patchify(latents, patch_index)
+        return latents, freqs_cis, patch_index, latent_size
+
     @torch.no_grad()
     @replace_example_docstring(EXAMPLE_DOC_STRING)
     def __call__(
@@ -321,6 +358,8 @@ class HunyuanVideoPipelineProRes(HunyuanVideoPipeline):
         freqs_cis: Tuple[torch.Tensor, torch.Tensor] = None,
         vae_ver: str = "88-4c-sd",
         enable_tiling: bool = False,
+        vae_stream_chunk: int = 0,
+        keep_on_device: bool = False,
         n_tokens: Optional[int] = None,
         embedded_guidance_scale: Optional[float] = None,
         sa_drop_rate: float = 0.0,
@@ -476,6 +515,11 @@ class HunyuanVideoPipelineProRes(HunyuanVideoPipeline):
             batch_size = prompt_embeds.shape[0]
 
         device = torch.device(f"cuda:{dist.get_rank()}") if dist.is_initialized() else self._execution_device
+        # JENGA: components may sit on the host between phases, see ResidencyManager.
+        residency = getattr(self, "residency", None)
+        if residency is not None:
+            device = residency.device
+            residency.enter("encode")
 
         # 3. Encode input prompt
         lora_scale = (
@@ -503,6 +547,9 @@ class HunyuanVideoPipelineProRes(HunyuanVideoPipeline):
             clip_skip=self.clip_skip,
             data_type=data_type,
         )
+        if residency is not None:
+            # Upload the DiT behind the second (small) text encoder if it fits.
+            residency.prefetch("denoise")
         if self.text_encoder_2 is not None:
             (
                 prompt_embeds_2,
@@ -542,6 +589,19 @@ class HunyuanVideoPipelineProRes(HunyuanVideoPipeline):
             if prompt_mask_2 is not None:
                 prompt_mask_2 = torch.cat([negative_prompt_mask_2, prompt_mask_2])
 
+        # JENGA: with CFG parallel each rank of the CFG group keeps its half of the guidance batch, and
+        # noise_pred is all-gathered after the DiT. Otherwise the uncond branch may be truncated.
+        cfg_parallel = getattr(self, "cfg_parallel", None) if self.do_classifier_free_guidance else None
+        cfg_truncation = None
+        if cfg_parallel is not None:
+            prompt_embeds, prompt_mask, prompt_embeds_2 = (
+                cfg_parallel.split(x) for x in (prompt_embeds, prompt_mask, prompt_embeds_2)
+            )
+        elif self.do_classifier_free_guidance:
+            cfg_truncation = CFGTruncation.from_args(self.args)
+
+        if residency is not None:
+            residency.enter("denoise")
 
         # 4. Prepare timesteps
         extra_set_timesteps_kwargs = self.prepare_extra_func_kwargs(
@@ -597,6 +657,13 @@ class HunyuanVideoPipelineProRes(HunyuanVideoPipeline):
             current_size
         )
         stage_idx = 0
+        cu_seqlens, max_seqlen = self.get_seqlens_meta(prompt_mask, current_size)
+
+        curve_native = getattr(self.args, "curve_native", False)
+        if curve_native:
+            latents, freqs_cis, patch_index, latent_size = self.to_curve_native(
+                latents, current_size, freqs_cis
+            )
 
         if hasattr(self.scheduler, "init_noise_sigma"):
             # scale the initial noise by the standard deviation required by the scheduler
@@ -621,6 +688,27 @@ class HunyuanVideoPipelineProRes(HunyuanVideoPipeline):
         num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
         self._num_timesteps = len(timesteps)
 
+        cfg_batch_size = prompt_embeds.shape[0]
+        guidance_expand = (
+            torch.tensor(
+                [embedded_guidance_scale] * cfg_batch_size,
+                dtype=torch.float32,
+                device=device,
+            ).to(target_dtype)
+            * 1000.0
+            if embedded_guidance_scale is not None
+            else None
+        )
+        # JENGA: modulations only depend on the schedule, rebuilt after every scheduler re-shift.
+        precompute_modulation = getattr(self.args, "precompute_modulation", False)
+        if precompute_modulation:
+            with torch.autocast(
+                device_type="cuda", dtype=target_dtype, enabled=autocast_enabled
+            ):
+                self.transformer.precompute_modulations(
+                    timesteps, prompt_embeds, prompt_mask, prompt_embeds_2, guidance_expand
+                )
+
         # if is_progress_bar:
         with self.progress_bar(total=num_inference_steps) as progress_bar:
             for i in range(len(timesteps)):
@@ -630,26 +718,28 @@ class HunyuanVideoPipelineProRes(HunyuanVideoPipeline):
                     continue
 
                 # expand the latents if we are doing classifier free guidance
+                run_uncond = cfg_truncation is None or cfg_truncation.run_uncond(i, stage_idx, latents)
                 latent_model_input = (
                     torch.cat([latents] * 2)
-                    if self.do_classifier_free_guidance
+                    if self.do_classifier_free_guidance and cfg_parallel is None and run_uncond
                     else latents
                 )
+                step_cu_seqlens, step_embeds, step_mask, step_embeds_2, step_guidance = (
+                    cu_seqlens, prompt_embeds, prompt_mask, prompt_embeds_2, guidance_expand
+                )
+                if not run_uncond:
+                    step_cu_seqlens, step_embeds, step_mask, step_embeds_2, step_guidance = cond_half(
+                        cu_seqlens, prompt_embeds, prompt_mask, prompt_embeds_2, guidance_expand
+                    )
+                    # The step cache of the DiT holds the residual of the guidance batch.
+                    residual = getattr(self.transformer, "previous_residual", None)
+                    if residual is not None and residual.shape[0] != latents.shape[0]:
+                        self.transformer.previous_residual = residual.chunk(2)[1]
                 latent_model_input = self.scheduler.scale_model_input(
                     latent_model_input, t
                 )
 
                 t_expand = t.repeat(latent_model_input.shape[0])
-                guidance_expand = (
-                    torch.tensor(
-                        [embedded_guidance_scale] * latent_model_input.shape[0],
-                        dtype=torch.float32,
-                        device=device,
-                    ).to(target_dtype)
-                    * 1000.0
-                    if embedded_guidance_scale is not None
-                    else None
-                )
                 # from thop import profile
                 # with torch.autocast(
                 #     device_type="cuda", dtype=target_dtype, enabled=autocast_enabled
@@ -659,6 +749,9 @@ class HunyuanVideoPipelineProRes(HunyuanVideoPipeline):
                 
                 # print('FLOPs = ' + str(flops/1000**3) + 'G')
                 # print('Params = ' + str(params/1000**2) + 'M')
+                if residency is not None and i == len(timesteps) - 1:
+                    # Upload the VAE during the last DiT step if it fits.
+                    residency.prefetch("decode")
                 # predict the noise residual
                 with torch.autocast(
                     device_type="cuda", dtype=target_dtype, enabled=autocast_enabled
@@ -666,24 +759,35 @@ class HunyuanVideoPipelineProRes(HunyuanVideoPipeline):
                     noise_pred = self.transformer(  # For an input image (129, 192, 336) (1, 256, 256)
                         latent_model_input,  # [2, 16, 33, 24, 42]
                         t_expand,  # [2]
-                        text_states=prompt_embeds,  # [2, 256, 4096]
-                        text_mask=prompt_mask,  # [2, 256]
-                        text_states_2=prompt_embeds_2,  # [2, 768]
+                        text_states=step_embeds,  # [2, 256, 4096]
+                        text_mask=step_mask,  # [2, 256]
+                        text_states_2=step_embeds_2,  # [2, 768]
                         freqs_cos=freqs_cis[0],  # [seqlen, head_dim]
                         freqs_sin=freqs_cis[1],  # [seqlen, head_dim]
                         sa_drop_rate=sa_drop_rate,
-                        guidance=guidance_expand,
+                        guidance=step_guidance,
                         return_dict=True,
+                        cu_seqlens=step_cu_seqlens,
+                        max_seqlen=max_seqlen,
+                        # Precomputed modulations hold the whole guidance batch.
+                        modulation_step=i if precompute_modulation and run_uncond else None,
                     )[
                         "x"
                     ]
 
                 # perform guidance
-                if self.do_classifier_free_guidance:
+                if cfg_parallel is not None:
+                    noise_pred = cfg_parallel.gather(noise_pred)
+                if self.do_classifier_free_guidance and run_uncond:
                     noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
                     noise_pred = noise_pred_uncond + self.guidance_scale * (
                         noise_pred_text - noise_pred_uncond
                     )
+                    if cfg_truncation is not None:
+                        cfg_truncation.update(noise_pred_uncond, noise_pred_text)
+                elif self.do_classifier_free_guidance:
+                    noise_pred_text = noise_pred
+                    noise_pred = cfg_truncation.guide(noise_pred_text, self.guidance_scale)
 
                 if self.do_classifier_free_guidance and self.guidance_rescale > 0.0:
                     # Based on 3.4. in https://arxiv.org/pdf/2305.08891.pdf
@@ -727,7 +831,8 @@ class HunyuanVideoPipelineProRes(HunyuanVideoPipeline):
                         latents = self.scheduler.predict_x0_from_xt(
                             noise_pred, t, latents, **extra_step_kwargs, return_dict=False
                         )[0]
-
+                        if curve_native:
+                            latents = curve_unpatchify(latents, patch_index, latent_size)
                     
 
                         latents = torch.nn.functional.interpolate(latents, size=resize_size, mode="trilinear")
@@ -759,6 +864,18 @@ class HunyuanVideoPipelineProRes(HunyuanVideoPipeline):
                         freqs_cis = self.get_rotary_pos_embed(
                             current_size
                         )
+                        cu_seqlens, max_seqlen = self.get_seqlens_meta(prompt_mask, current_size)
+                        if precompute_modulation:
+                            with torch.autocast(
+                                device_type="cuda", dtype=target_dtype, enabled=autocast_enabled
+                            ):
+                                self.transformer.precompute_modulations(
+                                    timesteps, prompt_embeds, prompt_mask, prompt_embeds_2, guidance_expand
+                                )
+                        if curve_native:
+                            latents, freqs_cis, patch_index, latent_size = self.to_curve_native(
+                                latents, current_size, freqs_cis
+                            )
                         self.scheduler._step_index += 1
                     else:
                         latents = self.scheduler.step(
@@ -799,7 +916,12 @@ class HunyuanVideoPipelineProRes(HunyuanVideoPipeline):
                         step_idx = i // getattr(self.scheduler, "order", 1)
                         callback(step_idx, t, latents)
 
+        if curve_native:
+            latents = curve_unpatchify(latents, patch_index, latent_size)
+
         if not output_type == "latent":
+            if residency is not None:
+                residency.enter("decode")
             expand_temporal_dim = False
             if len(latents.shape) == 4:
                 if isinstance(self.vae, AutoencoderKLCausal3D):
@@ -826,7 +948,15 @@ class HunyuanVideoPipelineProRes(HunyuanVideoPipeline):
             with torch.autocast(
                 device_type="cuda", dtype=vae_dtype, enabled=vae_autocast_enabled
             ):
-                if enable_tiling:
+                if vae_stream_chunk > 0 and isinstance(self.vae, AutoencoderKLCausal3D):
+                    # Chunked causal decode, no temporal tiles to overlap and blend. Large frames are
+                    # still split into spatial tiles.
+                    if enable_tiling:
+                        self.vae.enable_tiling()
+                    image = torch.cat(
+                        list(self.vae.streaming_decode(latents, chunk_size=vae_stream_chunk)), dim=2
+                    )
+                elif enable_tiling:
                     self.vae.enable_tiling()
                     image = self.vae.decode(
                         latents, return_dict=False, generator=generator
@@ -839,15 +969,21 @@ class HunyuanVideoPipelineProRes(HunyuanVideoPipeline):
             if expand_temporal_dim or image.shape[2] == 1:
                 image = image.squeeze(2)
 
+            image = (image / 2 + 0.5).clamp(0, 1)
+
         else:
+            # Raw latents for a separate decode worker, see hyvideo/utils/decode_worker.py.
             image = latents
+            keep_on_device = True
 
-        image = (image / 2 + 0.5).clamp(0, 1)
-        # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
-        image = image.cpu().float()
+        if not keep_on_device:
+            # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
+            image = image.cpu().float()
 
         # Offload all models
         self.maybe_free_model_hooks()
+        if residency is not None:
+            residency.finish()
 
         if not return_dict:
             return image
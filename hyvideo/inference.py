@@ -14,8 +14,11 @@ from hyvideo.vae import load_vae
 from hyvideo.modules import load_model
 from hyvideo.text_encoder import TextEncoder
 from hyvideo.utils.data_utils import align_to
+from hyvideo.utils.safetensors_utils import find_safetensors, load_safetensors_into_model
 from hyvideo.modules.posemb_layers import get_nd_rotary_pos_embed
-from hyvideo.modules.fp8_optimization import convert_fp8_linear
+from hyvideo.modules.fp8_optimization import convert_fp8_linear, prepare_fp8_linears
+from hyvideo.modules.offload import enable_block_offload, ResidencyManager
+from hyvideo.utils.cfg_parallel import CFGParallel
 from hyvideo.diffusion.schedulers import FlowMatchDiscreteScheduler
 from hyvideo.diffusion.pipelines import HunyuanVideoPipeline
 
@@ -25,6 +28,7 @@ try:
         get_sequence_parallel_world_size,
         get_sequence_parallel_rank,
         get_sp_group,
+        get_cfg_group,
         initialize_model_parallel,
         init_distributed_environment
     )
@@ -33,6 +37,7 @@ except:
     get_sequence_parallel_world_size = None
     get_sequence_parallel_rank = None
     get_sp_group = None
+    get_cfg_group = None
     initialize_model_parallel = None
     init_distributed_environment = None
 
@@ -163,22 +168,24 @@ class Inference(object):
         logger.info(f"Got text-to-video model root path: {pretrained_model_path}")
         
         # ==================== Initialize Distributed Environment ================
-        if args.ulysses_degree > 1 or args.ring_degree > 1:
+        cfg_degree = 2 if getattr(args, "cfg_parallel", False) else 1
+        if args.ulysses_degree > 1 or args.ring_degree > 1 or cfg_degree > 1:
             assert xfuser is not None, \
-                "Ulysses Attention and Ring Attention requires xfuser package."
+                "Ulysses Attention, Ring Attention and CFG parallel require the xfuser package."
 
             assert args.use_cpu_offload is False, \
                 "Cannot enable use_cpu_offload in the distributed environment."
 
             dist.init_process_group("nccl")
 
-            assert dist.get_world_size() == args.ring_degree * args.ulysses_degree, \
-                "number of GPUs should be equal to ring_degree * ulysses_degree."
+            assert dist.get_world_size() == args.ring_degree * args.ulysses_degree * cfg_degree, \
+                "number of GPUs should be equal to ring_degree * ulysses_degree (x 2 with --cfg-parallel)."
 
             init_distributed_environment(rank=dist.get_rank(), world_size=dist.get_world_size())
             
             initialize_model_parallel(
-                sequence_parallel_degree=dist.get_world_size(),
+                sequence_parallel_degree=args.ring_degree * args.ulysses_degree,
+                classifier_free_guidance_degree=cfg_degree,
                 ring_degree=args.ring_degree,
                 ulysses_degree=args.ulysses_degree,
             )
@@ -187,7 +194,7 @@ class Inference(object):
             if device is None:
                 device = "cuda" if torch.cuda.is_available() else "cpu"
 
-        parallel_args = {"ulysses_degree": args.ulysses_degree, "ring_degree": args.ring_degree}
+        parallel_args = {"ulysses_degree": args.ulysses_degree, "ring_degree": args.ring_degree, "cfg_degree": cfg_degree}
 
         # ======================== Get the args path =============================
 
@@ -196,7 +203,22 @@ class Inference(object):
 
         # =========================== Build main model ===========================
         logger.info("Building model...")
-        factor_kwargs = {"device": device, "dtype": PRECISION_TO_TYPE[args.precision]}
+        start_time = time.time()
+        # A safetensors checkpoint (see hyvideo/utils/safetensors_utils.py) is memory-mapped and
+        # streamed into a meta-device model, skipping random init and the host copy of torch.load.
+        safetensors_path = (
+            find_safetensors(args.dit_weight) if args.dit_weight is not None else None
+        )
+        # With a residency budget every component is loaded on the host, the ResidencyManager uploads it
+        # for its phase (or keeps it on the device if it fits the budget), so they never all meet on the device.
+        use_residency = args.residency_budget_gb is not None and not args.use_cpu_offload
+        load_device = "cpu" if args.use_cpu_offload or use_residency else device
+        # With block offload the DiT is loaded on the host and its blocks are streamed in.
+        dit_device = "cpu" if args.block_offload or use_residency else device
+        factor_kwargs = {
+            "device": "meta" if safetensors_path is not None else dit_device,
+            "dtype": PRECISION_TO_TYPE[args.precision],
+        }
         in_channels = args.latent_channels
         out_channels = args.latent_channels
 
@@ -207,20 +229,43 @@ class Inference(object):
             factor_kwargs=factor_kwargs,
         )
         if args.use_fp8:
-            convert_fp8_linear(model, args.dit_weight, original_dtype=PRECISION_TO_TYPE[args.precision])
-        model = model.to(device)
-        model = Inference.load_state_dict(args, model, pretrained_model_path)
+            convert_fp8_linear(
+                model,
+                args.dit_weight,
+                original_dtype=PRECISION_TO_TYPE[args.precision],
+                strategy=args.fp8_strategy,
+            )
+        if safetensors_path is not None:
+            logger.info(f"Loading safetensors model {safetensors_path}...")
+            model = load_safetensors_into_model(model, safetensors_path, dit_device, load_key=args.load_key)
+        else:
+            model = model.to(dit_device)
+            model = Inference.load_state_dict(args, model, pretrained_model_path)
         model.eval()
+        if args.use_fp8:
+            # Before offloading takes its copies of the weights.
+            prepare_fp8_linears(model, PRECISION_TO_TYPE[args.precision])
+        if args.block_offload:
+            enable_block_offload(
+                model,
+                device,
+                num_resident=args.offload_resident_blocks,
+                num_prefetch=args.offload_prefetch,
+            )
+        dit_time = time.time() - start_time
 
         # ============================= Build extra models ========================
         # VAE
+        start_time = time.time()
         vae, _, s_ratio, t_ratio = load_vae(
             args.vae,
             args.vae_precision,
             logger=logger,
-            device=device if not args.use_cpu_offload else "cpu",
+            device=load_device,
         )
+        vae.enable_tile_batching(args.vae_tile_batch_size)
         vae_kwargs = {"s_ratio": s_ratio, "t_ratio": t_ratio}
+        vae_time = time.time() - start_time
 
         # Text encoder
         if args.prompt_template_video is not None:
@@ -247,6 +292,7 @@ class Inference(object):
             else None
         )
 
+        start_time = time.time()
         text_encoder = TextEncoder(
             text_encoder_type=args.text_encoder,
             max_length=max_length,
@@ -258,7 +304,7 @@ class Inference(object):
             apply_final_norm=args.apply_final_norm,
             reproduce=args.reproduce,
             logger=logger,
-            device=device if not args.use_cpu_offload else "cpu",
+            device=load_device,
         )
         text_encoder_2 = None
         if args.text_encoder_2 is not None:
@@ -269,8 +315,13 @@ class Inference(object):
                 tokenizer_type=args.tokenizer_2,
                 reproduce=args.reproduce,
                 logger=logger,
-                device=device if not args.use_cpu_offload else "cpu",
+                device=load_device,
             )
+        text_encoder_time = time.time() - start_time
+        logger.info(
+            f"Startup time: DiT {dit_time:.2f}s, VAE {vae_time:.2f}s, "
+            f"text encoders {text_encoder_time:.2f}s, total {dit_time + vae_time + text_encoder_time:.2f}s"
+        )
 
         return cls(
             args=args,
@@ -414,6 +465,26 @@ class HunyuanVideoSampler(Inference):
             device=self.device,
         )
 
+        # Sequence the text encoders, DiT and VAE on the device by phase.
+        self.residency = None
+        if args.residency_budget_gb is not None and not self.use_cpu_offload:
+            self.residency = ResidencyManager(
+                {
+                    "text_encoder": self.pipeline.text_encoder,
+                    "text_encoder_2": self.pipeline.text_encoder_2,
+                    "transformer": self.pipeline.transformer,
+                    "vae": self.pipeline.vae,
+                },
+                self.device,
+                args.residency_budget_gb,
+                logger=logger,
+            )
+        self.pipeline.residency = self.residency
+        # The two halves of the guidance batch on the two ranks of the CFG group.
+        self.pipeline.cfg_parallel = None
+        if self.parallel_args.get("cfg_degree", 1) > 1:
+            self.pipeline.cfg_parallel = CFGParallel(get_cfg_group().device_group)
+
         self.default_negative_prompt = NEGATIVE_PROMPT
         if self.parallel_args['ulysses_degree'] > 1 or self.parallel_args['ring_degree'] > 1:
             parallelize_transformer(self.pipeline)
@@ -452,6 +523,12 @@ class HunyuanVideoSampler(Inference):
         )
         if self.use_cpu_offload:
             pipeline.enable_sequential_cpu_offload()
+        elif args.residency_budget_gb is not None:
+            # Components stay on the host, the ResidencyManager built in __init__ places them.
+            pass
+        elif getattr(model, "block_offloader", None) is not None:
+            with model.block_offloader.frozen():
+                pipeline = pipeline.to(device)
         else:
             pipeline = pipeline.to(device)
 
@@ -524,6 +601,7 @@ class HunyuanVideoSampler(Inference):
         scheduler_shift_list: list[int] = [7],
         offset_timesteps: int = 0,
         num_videos_per_prompt=1,
+        output_type="pil",
         **kwargs,
     ):
         """
@@ -669,7 +747,7 @@ class HunyuanVideoSampler(Inference):
             negative_prompt=negative_prompt,
             num_videos_per_prompt=num_videos_per_prompt,
             generator=generator,
-            output_type="pil",
+            output_type=output_type,
             freqs_cis=(freqs_cos, freqs_sin),
             n_tokens=n_tokens,
             embedded_guidance_scale=embedded_guidance_scale,
@@ -677,6 +755,8 @@ class HunyuanVideoSampler(Inference):
             is_progress_bar=True,
             vae_ver=self.args.vae,
             enable_tiling=self.args.vae_tiling,
+            vae_stream_chunk=self.args.vae_stream_chunk,
+            keep_on_device=self.args.async_save,
             sa_drop_rate=sa_drop_rate,
             res_rate_list=res_rate_list,
             step_rate_list=step_rate_list,
@@ -7,7 +7,17 @@
 # from .models_moba import HYVideoDiffusionTransformer, HUNYUAN_VIDEO_CONFIG
 # from .models import HYVideoDiffusionTransformer, HUNYUAN_VIDEO_CONFIG
 # from .models_multigpu_dev import HYVideoDiffusionTransformer, HUNYUAN_VIDEO_CONFIG
-from .models_mul_block_gc_ha_multigpu import HYVideoDiffusionTransformer, HUNYUAN_VIDEO_CONFIG
+# from .models_mul_block_gc_ha_multigpu import HYVideoDiffusionTransformer, HUNYUAN_VIDEO_CONFIG
+# The model module pulls in diffusers, triton and xfuser, so it is imported on first use.
+from ..constants import HUNYUAN_VIDEO_CONFIG
+
+
+def __getattr__(name):
+    if name == "HYVideoDiffusionTransformer":
+        from .models_mul_block_gc_ha_multigpu import HYVideoDiffusionTransformer
+        return HYVideoDiffusionTransformer
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 def load_model(args, in_channels, out_channels, factor_kwargs):
     """load hunyuan video model
@@ -21,6 +31,8 @@ def load_model(args, in_channels, out_channels, factor_kwargs):
     Returns:
         model (nn.Module): The hunyuan video model
     """
+    from .models_mul_block_gc_ha_multigpu import HYVideoDiffusionTransformer
+
     if args.model in HUNYUAN_VIDEO_CONFIG.keys():
         model = HYVideoDiffusionTransformer(
             args,
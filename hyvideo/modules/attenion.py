@@ -5,14 +5,22 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-try:
-    import flash_attn
-    from flash_attn.flash_attn_interface import _flash_attn_forward
-    from flash_attn.flash_attn_interface import flash_attn_varlen_func
-except ImportError:
-    flash_attn = None
-    flash_attn_varlen_func = None
-    _flash_attn_forward = None
+# flash_attn is imported on first use, see _import_flash_attn.
+flash_attn = None
+flash_attn_varlen_func = None
+_flash_attn_forward = None
+
+
+def _import_flash_attn():
+    global flash_attn, flash_attn_varlen_func, _flash_attn_forward
+    if flash_attn is None:
+        try:
+            import flash_attn as _flash_attn
+            from flash_attn.flash_attn_interface import _flash_attn_forward as _forward
+            from flash_attn.flash_attn_interface import flash_attn_varlen_func as _varlen_func
+        except ImportError:
+            return
+        flash_attn, flash_attn_varlen_func, _flash_attn_forward = _flash_attn, _varlen_func, _forward
 
 
 MEMORY_LAYOUT = {
@@ -42,17 +50,14 @@ def get_cu_seqlens(text_mask, img_len):
         torch.Tensor: the calculated cu_seqlens for flash attention
     """
     batch_size = text_mask.shape[0]
-    text_len = text_mask.sum(dim=1)
+    text_len = text_mask.sum(dim=1).to(torch.int32)
     max_len = text_mask.shape[1] + img_len
 
-    cu_seqlens = torch.zeros([2 * batch_size + 1], dtype=torch.int32, device="cuda")
-
-    for i in range(batch_size):
-        s = text_len[i] + img_len
-        s1 = i * max_len + s
-        s2 = (i + 1) * max_len
-        cu_seqlens[2 * i + 1] = s1
-        cu_seqlens[2 * i + 2] = s2
+    # [0, s_0, max_len, max_len + s_1, 2 * max_len, ...], built without host syncs.
+    offsets = torch.arange(batch_size, dtype=torch.int32, device=text_mask.device) * max_len
+    cu_seqlens = torch.zeros([2 * batch_size + 1], dtype=torch.int32, device=text_mask.device)
+    cu_seqlens[1::2] = offsets + text_len + img_len
+    cu_seqlens[2::2] = offsets + max_len
 
     return cu_seqlens
 
@@ -106,6 +111,7 @@ def attention(
             q, k, v, attn_mask=attn_mask, dropout_p=drop_rate, is_causal=causal
         )
     elif mode == "flash":
+        _import_flash_attn()
         x = flash_attn_varlen_func(
             q,
             k,
@@ -217,6 +223,7 @@ def parallel_attention(
         joint_tensor_value=v[:,img_kv_len:cu_seqlens_kv[1]],
         joint_strategy="rear",
     )
+    _import_flash_attn()
     if flash_attn.__version__ >= '2.7.0':
         attn2, *_ = _flash_attn_forward(
             q[:,cu_seqlens_q[1]:],
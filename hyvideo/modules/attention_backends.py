@@ -0,0 +1,102 @@
+"""
+Registry of block-sparse attention backends.
+
+Backends are registered as loaders and only imported when first requested, so importing the
+model code does not pull in triton or flash_attn until attention actually runs.
+"""
+
+_BACKEND_LOADERS = {}
+_BACKENDS = {}
+_LSE_LOADERS = {}
+_LSE_BACKENDS = {}
+
+DEFAULT_ATTENTION_BACKEND = "triton_diffres"
+_default_backend = DEFAULT_ATTENTION_BACKEND
+
+
+def register_attention_backend(name):
+    """Register a loader returning the block-sparse attention function of backend `name`."""
+
+    def decorator(loader):
+        _BACKEND_LOADERS[name] = loader
+        _BACKENDS.pop(name, None)
+        return loader
+
+    return decorator
+
+
+def register_block_sparse_attention_lse(name):
+    """Register a loader returning the masked (output, lse) kernel of backend `name`, used by the sparse ring."""
+
+    def decorator(loader):
+        _LSE_LOADERS[name] = loader
+        _LSE_BACKENDS.pop(name, None)
+        return loader
+
+    return decorator
+
+
+def set_default_attention_backend(name):
+    """Make `name` the backend returned by `get_attention_backend()`, e.g. "reference" on CPU."""
+    global _default_backend
+    if name not in _BACKEND_LOADERS:
+        raise ValueError(f"Unknown attention backend: {name}, available: {list(_BACKEND_LOADERS)}.")
+    _default_backend = name
+
+
+def get_attention_backend(name=None):
+    """Resolve (and import on first use) the block-sparse attention function of backend `name`, or of the default."""
+    if name is None:
+        name = _default_backend
+    backend = _BACKENDS.get(name)
+    if backend is None:
+        if name not in _BACKEND_LOADERS:
+            raise ValueError(
+                f"Unknown attention backend: {name}, available: {list(_BACKEND_LOADERS)}."
+            )
+        backend = _BACKENDS[name] = _BACKEND_LOADERS[name]()
+    return backend
+
+
+def get_block_sparse_attention_lse(name=None):
+    """Resolve the `block_sparse_attention_lse` kernel of backend `name`, or of the default."""
+    if name is None:
+        name = _default_backend
+    kernel = _LSE_BACKENDS.get(name)
+    if kernel is None:
+        if name not in _LSE_LOADERS:
+            raise ValueError(f"Attention backend {name} has no masked lse kernel, available: {list(_LSE_LOADERS)}.")
+        kernel = _LSE_BACKENDS[name] = _LSE_LOADERS[name]()
+    return kernel
+
+
+def list_attention_backends():
+    return list(_BACKEND_LOADERS)
+
+
+@register_attention_backend("triton_diffres")
+def _load_triton_diffres():
+    from .attention_block_triton_diffres import block_sparse_attention
+
+    return block_sparse_attention
+
+
+@register_attention_backend("reference")
+def _load_reference():
+    from .attention_block_reference import block_sparse_attention
+
+    return block_sparse_attention
+
+
+@register_block_sparse_attention_lse("triton_diffres")
+def _load_triton_diffres_lse():
+    from .attention_block_triton_diffres import block_sparse_attention_lse
+
+    return block_sparse_attention_lse
+
+
+@register_block_sparse_attention_lse("reference")
+def _load_reference_lse():
+    from .attention_block_reference import block_sparse_attention_lse
+
+    return block_sparse_attention_lse
@@ -0,0 +1,257 @@
+"""
+Pure PyTorch reference of the Jenga block-sparse attention.
+
+Same block selection and masking as the Triton backend (attention_block_triton_diffres.py): image query
+blocks attend to their selected key blocks plus all text blocks, with `text_amp` added to the text logits,
+and text query rows attend to every key. It runs on any device, without triton or flash_attn, and is meant
+for correctness checks such as the CPU sequence-parallel harness, not for speed.
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+def _build_block_index_with_importance_optimized(
+    query: torch.Tensor,     # [BATCH, N_HEADS, N_CTX, D_HEAD]
+    key: torch.Tensor,       # [BATCH, N_HEADS, N_CTX, D_HEAD]
+    top_k: int,
+    block_size_M: int = 128,
+    block_size_N: int = 128,
+    text_start_block: int = None,  
+    num_blocks: int = None,        
+    prob_threshold: float = 0.7,   
+    text_blocks: int = 2,          
+    block_neighbor_list: torch.Tensor = None,  # [block_num, block_num] one-hot tensor
+):
+    batch_size, num_heads, context_size, head_dim = query.shape
+    
+    # 1. Pool queries and keys
+    query_pool = query.reshape((batch_size, num_heads, -1, block_size_M, head_dim)).mean(dim=-2)
+    key_pool = key.reshape((batch_size, num_heads, -1, block_size_N, head_dim)).mean(dim=-2)
+
+    return _build_block_index_from_pools(
+        query_pool, key_pool, top_k,
+        text_start_block=text_start_block, num_blocks=num_blocks,
+        prob_threshold=prob_threshold,
+        text_blocks=text_blocks,
+        block_neighbor_list=block_neighbor_list,
+    )
+
+
+def _build_block_index_from_pools(
+    query_pool: torch.Tensor,  # [BATCH, N_HEADS, N_QUERY_BLOCKS, D_HEAD]
+    key_pool: torch.Tensor,    # [BATCH, N_HEADS, N_BLOCKS, D_HEAD]
+    top_k: int,
+    text_start_block: int = None,
+    num_blocks: int = None,
+    prob_threshold: float = 0.7,
+    text_blocks: int = 2,
+    block_neighbor_list: torch.Tensor = None,
+    query_block_offset: int = 0,  # row of the first query block in block_neighbor_list, for query shards
+):
+    batch_size, num_heads, num_query_blocks, head_dim = query_pool.shape
+    device = query_pool.device
+
+    # 2. Calculate attention scores - using bmm optimization
+    # Reshape to [batch_size * num_heads, num_query_blocks, head_dim]
+    q_bmm = query_pool.reshape(batch_size * num_heads, query_pool.shape[2], head_dim)
+    
+    # Reshape to [batch_size * num_heads, head_dim, num_key_blocks]
+    k_bmm = key_pool.reshape(batch_size * num_heads, key_pool.shape[2], head_dim).transpose(1, 2)
+    
+    # Use bmm for batch matrix multiplication
+    attention_scores_flat = torch.bmm(q_bmm, k_bmm) * (head_dim ** -0.5)
+    
+    # Reshape back to original dimensions [batch_size, num_heads, num_query_blocks, num_key_blocks]
+    attention_scores = attention_scores_flat.reshape(
+        batch_size, num_heads, query_pool.shape[2], key_pool.shape[2]
+    )
+    
+    # 3. Only process scores for non-text blocks
+    normal_scores = attention_scores[:, :, :, :text_start_block]
+    
+    # 4. Use direct softmax to calculate probability distribution for each query
+    probs = torch.softmax(normal_scores, dim=-1)
+    
+    # 5. Sort probability distribution for each head and query
+    sorted_probs, indices = torch.sort(probs, dim=-1, descending=True)
+    cumsum_probs = torch.cumsum(sorted_probs, dim=-1)
+    
+    # 6. Find number of blocks needed for each (batch, head, query) position
+    mask = cumsum_probs <= prob_threshold
+    num_blocks_needed = mask.sum(dim=-1) + 1  # [batch, heads, queries]
+    num_blocks_needed = torch.maximum(
+        num_blocks_needed,
+        torch.tensor(top_k, device=device)
+    )
+    
+    # Create one-hot output tensor [batch_size, num_heads, num_query_blocks, num_blocks]
+    one_hot_output = torch.zeros(
+        (batch_size, num_heads, num_query_blocks, num_blocks), 
+        dtype=torch.bool, device=device
+    )
+    max_k = indices.shape[-1]
+    # Use einsum-based indexing for reduced memory:
+    batch_idx = torch.arange(batch_size, device=device).view(-1, 1, 1, 1).expand(-1, num_heads, num_query_blocks, max_k)
+    head_idx = torch.arange(num_heads, device=device).view(1, -1, 1, 1).expand(batch_size, -1, num_query_blocks, max_k)
+    query_idx = torch.arange(num_query_blocks, device=device).view(1, 1, -1, 1).expand(batch_size, num_heads, -1, max_k)
+    k_idx = torch.arange(max_k, device=device).view(1, 1, 1, -1).expand(batch_size, num_heads, num_query_blocks, -1)
+
+    # Create mask more efficiently
+    valid_mask = k_idx < num_blocks_needed.unsqueeze(-1)
+    
+    # Find all positions that need to be filled
+    b_indices = batch_idx[valid_mask]
+    h_indices = head_idx[valid_mask]
+    q_indices = query_idx[valid_mask]
+    
+    # Get index values corresponding to these positions
+    flat_indices = indices[b_indices, h_indices, q_indices, k_idx[valid_mask]]
+    
+    # Use scatter and index operations to fill in one go
+    one_hot_output[b_indices, h_indices, q_indices, flat_indices] = True
+    
+    
+    # Add physical neighbors - directly take union
+    if block_neighbor_list is not None:
+        # Ensure block_neighbor_list is on the correct device
+        if block_neighbor_list.device != device:
+            block_neighbor_list = block_neighbor_list.to(device)
+        
+        # Ensure dimensions match and convert to boolean
+        neighbor_mask = block_neighbor_list[
+            query_block_offset:query_block_offset + num_query_blocks, :text_start_block
+        ].bool()
+        
+        # Expand to [batch, heads, q_blocks, blocks] dimension and take union with existing output
+        one_hot_output[:, :, :neighbor_mask.shape[0], :text_start_block] |= neighbor_mask.unsqueeze(0).unsqueeze(0)
+    
+    # Add text blocks - all batches, all heads, all query blocks can see all text blocks
+    if text_blocks > 0 and text_start_block is not None:
+        one_hot_output[:, :, :, text_start_block:min(text_start_block+text_blocks, num_blocks)] = True
+
+    return one_hot_output
+
+
+def block_sparse_attention_lse(
+    query: torch.Tensor,       # [BATCH, N_HEADS, N_Q, D_HEAD]
+    key: torch.Tensor,         # [BATCH, N_HEADS, N_KV, D_HEAD]
+    value: torch.Tensor,       # [BATCH, N_HEADS, N_KV, D_HEAD]
+    block_mask: torch.Tensor,  # [BATCH, N_HEADS, N_Q / block_size_M, N_KV / block_size_N] bool
+    seqlen: int,
+    sm_scale: float,
+    block_size_M: int = 128,
+    block_size_N: int = 128,
+    text_amp: float = 0.0,
+    text_block_start: int = None,
+):
+    """
+    Attention of every query block over its selected key blocks, returning the output and the natural
+    log-sum-exp of each row, -inf for rows without a selected key, for merging partial results.
+
+    Keys at or after `seqlen` are masked and rows at or after it stay zero. Key blocks from `text_block_start`
+    on get `text_amp` added to their logits; the kernel adds it in the log2 domain, i.e. text_amp * ln(2) here.
+    """
+    batch_size, num_heads, num_rows, head_dim = query.shape
+    num_cols = key.shape[2]
+    compute_dtype = torch.promote_types(query.dtype, torch.float32)
+    k = key.to(compute_dtype)
+    v = value.to(compute_dtype)
+    output = torch.zeros(query.shape, dtype=compute_dtype, device=query.device)
+    lse = torch.full((batch_size, num_heads, num_rows), float("-inf"), dtype=compute_dtype, device=query.device)
+
+    cols = torch.arange(num_cols, device=query.device)
+    bias = 0.0
+    if text_block_start is not None:
+        bias = (cols >= text_block_start * block_size_N).to(compute_dtype) * (text_amp * math.log(2))
+    for block_idx in range(block_mask.shape[2]):
+        rows = slice(block_idx * block_size_M, min((block_idx + 1) * block_size_M, seqlen, num_rows))
+        if rows.start >= rows.stop:
+            break
+        key_mask = block_mask[:, :, block_idx].repeat_interleave(block_size_N, dim=-1)[..., :num_cols]
+        key_mask = key_mask & (cols < seqlen)
+        scores = query[:, :, rows].to(compute_dtype) @ k.transpose(-1, -2) * sm_scale + bias
+        scores = scores.masked_fill(~key_mask.unsqueeze(-2), float("-inf"))
+        row_lse = torch.logsumexp(scores, dim=-1)
+        probs = torch.exp(scores - row_lse.unsqueeze(-1)).nan_to_num(0.0)
+        output[:, :, rows] = probs @ v
+        lse[:, :, rows] = row_lse
+    return output, lse
+
+
+def block_sparse_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    top_k: int,
+    block_size_M: int = 128,
+    block_size_N: int = 128,
+    cu_seqlens_q: torch.Tensor = None,
+    cu_seqlens_kv: torch.Tensor = None,
+    max_seqlen_q: int = None,
+    max_seqlen_kv: int = None,
+    text_blocks: int = 2,
+    text_amp: float = 0.0,
+    block_neighbor_list: torch.Tensor = None,
+    shape_xfuse: bool = False,
+    p_remain_rates: float = 0.5,
+    block_stats: dict = None,
+):
+    """
+    Reference of attention_block_triton_diffres.block_sparse_attention, same arguments and output layout.
+
+    Query/key/value are (b, s, h, d), with the `text_blocks` text blocks at the end. Image query blocks are
+    computed one at a time by block_sparse_attention_lse, so memory stays at (b, h, block_size_M, s) scores.
+    If `block_stats` is a dict, block_stats["head_blocks"] gets the selected blocks per head, (h,).
+    """
+    query = query.transpose(1, 2)
+    key = key.transpose(1, 2)
+    value = value.transpose(1, 2)
+    batch_size, num_heads, context_size, head_dim = query.shape
+
+    if cu_seqlens_q is not None and cu_seqlens_kv is not None:
+        seqlen = int(cu_seqlens_q[1])
+    else:
+        seqlen = context_size
+        pad = -context_size % block_size_M
+        query, key, value = (F.pad(x, [0, 0, 0, pad]) for x in (query, key, value))
+
+    sm_scale = head_dim ** -0.5
+    padded_context_size = query.shape[2]
+    num_blocks = (padded_context_size + block_size_M - 1) // block_size_M
+    normal_blocks = num_blocks - text_blocks
+    normal_tokens = normal_blocks * block_size_M
+
+    output = torch.zeros_like(query)
+    if block_stats is not None:
+        block_stats["head_blocks"] = torch.zeros(num_heads, dtype=torch.int64, device=query.device)
+
+    if normal_blocks > 0:
+        block_mask = _build_block_index_with_importance_optimized(
+            query[:, :, :normal_tokens], key, top_k, block_size_M, block_size_N,
+            text_start_block=normal_blocks, num_blocks=num_blocks,
+            prob_threshold=p_remain_rates,
+            text_blocks=text_blocks,
+            block_neighbor_list=block_neighbor_list,
+        )
+        if block_stats is not None:
+            block_stats["head_blocks"] = block_mask.sum(dim=(0, 2, 3))
+        output_normal, _ = block_sparse_attention_lse(
+            query[:, :, :normal_tokens], key, value, block_mask, seqlen, sm_scale, block_size_M, block_size_N,
+            text_amp=text_amp, text_block_start=normal_blocks,
+        )
+        output[:, :, :normal_tokens] = output_normal.to(output.dtype)
+
+    if text_blocks > 0:
+        # Text rows see every key, without text_amp or masking, like the flash attention call of the kernel path.
+        compute_dtype = torch.promote_types(query.dtype, torch.float32)
+        output[:, :, normal_tokens:] = F.scaled_dot_product_attention(
+            query[:, :, normal_tokens:].to(compute_dtype), key.to(compute_dtype), value.to(compute_dtype)
+        ).to(output.dtype)
+
+    output = output[:, :, :context_size]
+    if not shape_xfuse:
+        return output.permute(0, 2, 1, 3).reshape(batch_size, context_size, -1)
+    return output.permute(0, 2, 1, 3)
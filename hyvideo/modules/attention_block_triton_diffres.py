@@ -12,7 +12,13 @@ import time
 
 import torch._dynamo
 torch._dynamo.config.suppress_errors = True
-from flash_attn import flash_attn_func
+try:
+    from flash_attn import flash_attn_func
+except ImportError:
+    flash_attn_func = None
+
+# The block selection is plain PyTorch and shared with the reference backend.
+from .attention_block_reference import _build_block_index_with_importance_optimized
 
 # from flash_attn import flash_attn_varlen_func
 # import pycuda.autoprimaryctx
@@ -40,6 +46,7 @@ def _triton_block_sparse_attn_fwd_kernel_onehot(
     Q, K, V, seqlens, qk_scale, text_amp_runtime, text_block_start_runtime,
     block_mask,  # [BATCH*HEADS, NUM_ROWS, NUM_BLOCKS] one-hot mask
     Out,
+    Lse,  # [BATCH*HEADS, N_CTX] log2-sum-exp of each row, written when RETURN_LSE
     stride_qz, stride_qh, stride_qm, stride_qk,
     stride_kz, stride_kh, stride_kn, stride_kk,
     stride_vz, stride_vh, stride_vn, stride_vk,
@@ -52,6 +59,7 @@ def _triton_block_sparse_attn_fwd_kernel_onehot(
     BLOCK_DMODEL: tl.constexpr,
     dtype: tl.constexpr,
     is_text_block: tl.constexpr,  # indicates whether this is a text block
+    RETURN_LSE: tl.constexpr = False,
 ):
     start_m = tl.program_id(0)  # Current query block being processed
     off_hz = tl.program_id(1)   # batch * head index
@@ -131,9 +139,13 @@ def _triton_block_sparse_attn_fwd_kernel_onehot(
             l_i = l_i * alpha + tl.sum(p, 1)
             m_i = m_i_new
 
-    # write back O
-    acc /= l_i[:, None]
+    # write back O, rows without a selected block (possible for ring hops) stay zero
+    has_keys = l_i > 0
+    acc /= tl.where(has_keys, l_i, 1.0)[:, None]
     tl.store(o_ptrs, acc.to(dtype), mask=m_mask)
+    if RETURN_LSE:
+        lse = tl.where(has_keys, m_i + tl.math.log2(tl.where(has_keys, l_i, 1.0)), float("-inf"))
+        tl.store(Lse + off_hz * N_CTX + offs_m, lse, mask=offs_m < seqlen)
 
 
 def _triton_block_sparse_attention_onehot(
@@ -148,12 +160,16 @@ def _triton_block_sparse_attention_onehot(
     is_text_block=False,  # indicates whether this is a text block
     text_amp=0.0,         # controls scaling of qk values for text blocks
     text_block_start=0,   # starting index of text blocks
+    return_lse=False,     # also return the log2-sum-exp of each row, [BATCH, N_HEADS, N_CTX] float32
 ) -> torch.Tensor:
     # shape constraints
     Lq, Lk, Lv = q.shape[-1], k.shape[-1], v.shape[-1]
     assert Lq == Lk and Lk == Lv
     assert Lk in {16, 32, 64, 128}
     o = torch.zeros_like(q)
+    lse = None
+    if return_lse:
+        lse = torch.full(q.shape[:3], float("-inf"), dtype=torch.float32, device=q.device)
     
     batch_size, n_heads = q.shape[0], q.shape[1]
     num_query_blocks = block_mask.shape[-2]
@@ -181,6 +197,7 @@ def _triton_block_sparse_attention_onehot(
             q, k, v, seqlens, qk_scale, text_amp, text_block_start,
             block_mask_reshaped,
             o,
+            lse if return_lse else o,
             q.stride(0), q.stride(1), q.stride(2), q.stride(3),
             k.stride(0), k.stride(1), k.stride(2), k.stride(3),
             v.stride(0), v.stride(1), v.stride(2), v.stride(3),
@@ -192,107 +209,37 @@ def _triton_block_sparse_attention_onehot(
             BLOCK_DMODEL=Lk,
             dtype=dtype,
             is_text_block=is_text_block,
+            RETURN_LSE=return_lse,
         )
+    if return_lse:
+        return o, lse
     return o
 
-def _build_block_index_with_importance_optimized(
-    query: torch.Tensor,     # [BATCH, N_HEADS, N_CTX, D_HEAD]
-    key: torch.Tensor,       # [BATCH, N_HEADS, N_CTX, D_HEAD]
-    top_k: int,
+
+def block_sparse_attention_lse(
+    query: torch.Tensor,       # [BATCH, N_HEADS, N_Q, D_HEAD]
+    key: torch.Tensor,         # [BATCH, N_HEADS, N_KV, D_HEAD]
+    value: torch.Tensor,       # [BATCH, N_HEADS, N_KV, D_HEAD]
+    block_mask: torch.Tensor,  # [BATCH, N_HEADS, N_Q / block_size_M, N_KV / block_size_N] bool
+    seqlen: int,
+    sm_scale: float,
     block_size_M: int = 128,
     block_size_N: int = 128,
-    text_start_block: int = None,  
-    num_blocks: int = None,        
-    prob_threshold: float = 0.7,   
-    text_blocks: int = 2,          
-    block_neighbor_list: torch.Tensor = None,  # [block_num, block_num] one-hot tensor
+    text_amp: float = 0.0,
+    text_block_start: int = None,
 ):
-    cur_time = time.time()
-    batch_size, num_heads, context_size, head_dim = query.shape
-    num_query_blocks = (context_size + block_size_M - 1) // block_size_M
-    device = query.device
-    
-    # 1. Pool queries and keys
-    query_pool = query.reshape((batch_size, num_heads, -1, block_size_M, head_dim)).mean(dim=-2)
-    key_pool = key.reshape((batch_size, num_heads, -1, block_size_N, head_dim)).mean(dim=-2)
-    
-    # 2. Calculate attention scores - using bmm optimization
-    # Reshape to [batch_size * num_heads, num_query_blocks, head_dim]
-    q_bmm = query_pool.reshape(batch_size * num_heads, query_pool.shape[2], head_dim)
-    
-    # Reshape to [batch_size * num_heads, head_dim, num_key_blocks]
-    k_bmm = key_pool.reshape(batch_size * num_heads, key_pool.shape[2], head_dim).transpose(1, 2)
-    
-    # Use bmm for batch matrix multiplication
-    attention_scores_flat = torch.bmm(q_bmm, k_bmm) * (head_dim ** -0.5)
-    
-    # Reshape back to original dimensions [batch_size, num_heads, num_query_blocks, num_key_blocks]
-    attention_scores = attention_scores_flat.reshape(
-        batch_size, num_heads, query_pool.shape[2], key_pool.shape[2]
-    )
-    
-    # 3. Only process scores for non-text blocks
-    normal_scores = attention_scores[:, :, :, :text_start_block]
-    
-    # 4. Use direct softmax to calculate probability distribution for each query
-    probs = torch.softmax(normal_scores, dim=-1)
-    
-    # 5. Sort probability distribution for each head and query
-    sorted_probs, indices = torch.sort(probs, dim=-1, descending=True)
-    cumsum_probs = torch.cumsum(sorted_probs, dim=-1)
-    
-    # 6. Find number of blocks needed for each (batch, head, query) position
-    mask = cumsum_probs <= prob_threshold
-    num_blocks_needed = mask.sum(dim=-1) + 1  # [batch, heads, queries]
-    num_blocks_needed = torch.maximum(
-        num_blocks_needed,
-        torch.tensor(top_k, device=device)
-    )
-    
-    # Create one-hot output tensor [batch_size, num_heads, num_query_blocks, num_blocks]
-    one_hot_output = torch.zeros(
-        (batch_size, num_heads, num_query_blocks, num_blocks), 
-        dtype=torch.bool, device=device
+    """
+    Block-sparse attention under an explicit block mask, returning the output and the natural log-sum-exp
+    of each row (-inf for rows without a selected key), for merging partial results such as ring hops.
+    """
+    seqlens = torch.full((query.shape[0],), seqlen, dtype=torch.int32, device=query.device)
+    if text_block_start is None:
+        text_block_start = block_mask.shape[-1]
+    output, lse = _triton_block_sparse_attention_onehot(
+        query, key, value, seqlens, block_mask, sm_scale, block_size_M, block_size_N,
+        text_amp=text_amp, text_block_start=text_block_start, return_lse=True,
     )
-    max_k = indices.shape[-1]
-    # Use einsum-based indexing for reduced memory:
-    batch_idx = torch.arange(batch_size, device=device).view(-1, 1, 1, 1).expand(-1, num_heads, num_query_blocks, max_k)
-    head_idx = torch.arange(num_heads, device=device).view(1, -1, 1, 1).expand(batch_size, -1, num_query_blocks, max_k)
-    query_idx = torch.arange(num_query_blocks, device=device).view(1, 1, -1, 1).expand(batch_size, num_heads, -1, max_k)
-    k_idx = torch.arange(max_k, device=device).view(1, 1, 1, -1).expand(batch_size, num_heads, num_query_blocks, -1)
-
-    # Create mask more efficiently
-    valid_mask = k_idx < num_blocks_needed.unsqueeze(-1)
-    
-    # Find all positions that need to be filled
-    b_indices = batch_idx[valid_mask]
-    h_indices = head_idx[valid_mask]
-    q_indices = query_idx[valid_mask]
-    
-    # Get index values corresponding to these positions
-    flat_indices = indices[b_indices, h_indices, q_indices, k_idx[valid_mask]]
-    
-    # Use scatter and index operations to fill in one go
-    one_hot_output[b_indices, h_indices, q_indices, flat_indices] = True
-    
-    
-    # Add physical neighbors - directly take union
-    if block_neighbor_list is not None:
-        # Ensure block_neighbor_list is on the correct device
-        if block_neighbor_list.device != device:
-            block_neighbor_list = block_neighbor_list.to(device)
-        
-        # Ensure dimensions match and convert to boolean
-        neighbor_mask = block_neighbor_list[:num_query_blocks, :text_start_block].bool()
-        
-        # Expand to [batch, heads, q_blocks, blocks] dimension and take union with existing output
-        one_hot_output[:, :, :neighbor_mask.shape[0], :text_start_block] |= neighbor_mask.unsqueeze(0).unsqueeze(0)
-    
-    # Add text blocks - all batches, all heads, all query blocks can see all text blocks
-    if text_blocks > 0 and text_start_block is not None:
-        one_hot_output[:, :, :, text_start_block:min(text_start_block+text_blocks, num_blocks)] = True
-
-    return one_hot_output
+    return output, lse * 0.6931471805599453  # log2 -> natural log
 
 
 def block_sparse_attention_combined(
@@ -311,12 +258,14 @@ def block_sparse_attention_combined(
     prob_threshold: float = 0.5,  # new parameter
     block_neighbor_list: torch.Tensor = None,
     shape_xfuse: bool = False,
+    block_stats: dict = None,
 ):
     """
     Combined attention processing for normal blocks and text blocks:
     1. Normal blocks select top-k blocks based on importance (without causal constraints)
     2. Text blocks get full attention (can see all blocks)
     3. All normal blocks can see all text blocks
+    If `block_stats` is a dict, block_stats["head_blocks"] gets the selected blocks per head, (h,).
     """
     query = query.transpose(1, 2)
     key = key.transpose(1, 2)
@@ -355,6 +304,8 @@ def block_sparse_attention_combined(
             text_blocks=text_blocks,
             block_neighbor_list=block_neighbor_list
         )
+        if block_stats is not None:
+            block_stats["head_blocks"] = block_relation_onehot.sum(dim=(0, 2, 3))
         
         # direct use one-hot version sparse attention
         output_normal = _triton_block_sparse_attention_onehot(
@@ -366,6 +317,8 @@ def block_sparse_attention_combined(
         )
     else:
         output_normal = torch.empty(0, device=query.device)
+        if block_stats is not None:
+            block_stats["head_blocks"] = torch.zeros(num_heads, dtype=torch.int64, device=query.device)
     
     # 2. process text blocks (full attention to all blocks)
     if text_blocks > 0:
@@ -374,6 +327,8 @@ def block_sparse_attention_combined(
         key_text = key  # can see all keys
         value_text = value
         # use Flash Attention
+        if flash_attn_func is None:
+            raise ImportError("flash_attn is required for the text rows of block sparse attention.")
         output_text = flash_attn_func(
             query_text.permute(0, 2, 1, 3), key_text.permute(0, 2, 1, 3), value_text.permute(0, 2, 1, 3),
             causal=False, softmax_scale=sm_scale
@@ -412,6 +367,7 @@ def block_sparse_attention(
     block_neighbor_list: torch.Tensor = None,
     shape_xfuse: bool = False,
     p_remain_rates: float = 0.5,
+    block_stats: dict = None,
 ):
     """
     backward compatible wrapper around block_sparse_attention_combined.
@@ -420,5 +376,5 @@ def block_sparse_attention(
         query, key, value, top_k, block_size_M, block_size_N,
         cu_seqlens_q, cu_seqlens_kv, max_seqlen_q, max_seqlen_kv, 
         text_blocks, text_amp, block_neighbor_list=block_neighbor_list, shape_xfuse=shape_xfuse,
-        prob_threshold=p_remain_rates
+        prob_threshold=p_remain_rates, block_stats=block_stats,
     )
\ No newline at end of file
@@ -1,6 +1,7 @@
 import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from einops import rearrange, repeat
 
 from ..utils.helpers import to_2tuple
@@ -58,6 +59,16 @@ class PatchEmbed(nn.Module):
         x = self.norm(x)
         return x
 
+    def forward_tokens(self, x):
+        """Embed already patchified tokens [B, L, C*prod(patch_size)].
+
+        Since the conv kernel equals its stride, this is the same projection as `forward`,
+        which lets callers keep tokens in any order (e.g. a space-filling curve).
+        """
+        x = F.linear(x, self.proj.weight.flatten(1), self.proj.bias)
+        x = self.norm(x)
+        return x
+
 
 class TextProjection(nn.Module):
     """
@@ -2,6 +2,7 @@ import os
 
 import torch
 import torch.nn as nn
+from loguru import logger
 from torch.nn import functional as F
 
 def get_fp_maxval(bits=8, mantissa_bit=3, sign_bits=1):
@@ -52,38 +53,133 @@ def fp8_activation_dequant(qdq_out, scale, dtype):
     quant_dequant_x = qdq_out * scale.to(dtype)
     return quant_dequant_x
 
-def fp8_linear_forward(cls, original_dtype, input):
-    weight_dtype = cls.weight.dtype
-    #####
+FP8_STRATEGIES = ("dequant_per_call", "dequant_on_load", "stream", "scaled_mm")
+
+# Scratch buffers shared by all streaming fp8 linears, keyed by (device, dtype).
+_FP8_SCRATCH = {}
+
+
+def _get_fp8_scratch(numel, device, dtype):
+    key = (device, dtype)
+    buf = _FP8_SCRATCH.get(key)
+    if buf is None or buf.numel() < numel:
+        buf = torch.empty(numel, device=device, dtype=dtype)
+        _FP8_SCRATCH[key] = buf
+    return buf[:numel]
+
+
+def _supports_scaled_mm(weight):
+    if not hasattr(torch, "_scaled_mm") or weight.device.type != "cuda":
+        return False
+    if torch.cuda.get_device_capability(weight.device) < (8, 9):
+        return False
+    out_features, in_features = weight.shape
+    return out_features % 16 == 0 and in_features % 16 == 0
+
+
+@torch.no_grad()
+def fp8_prepare_linear(cls, original_dtype):
+    """
+    One-time preparation of an fp8 linear, once its weights are loaded (`prepare_fp8_linears`, or else on its
+    first forward). The weight is replaced in place through `.data`, so the Parameter object that block
+    offloading and residency management hold on to stays valid.
+
+    Quantizes non-fp8 weights once, caches the all-zero check, and resolves the strategy:
+    - dequant_per_call: keep fp8 weights and dequantize the whole weight on every call, the original behavior.
+    - dequant_on_load: replace the fp8 weight by its dequantized copy and use the plain linear.
+    - stream: keep fp8 weights, dequantize blocks of rows into a shared scratch buffer per call.
+    - scaled_mm: keep fp8 weights and use torch._scaled_mm, falls back to stream where unsupported.
+
+    Preparation may run on the host, e.g. before block offloading streams the weights in, so the scaled_mm
+    support check and the device of the scale are resolved in the forward, on the compute device.
+    """
     if cls.weight.dtype != torch.float8_e4m3fn:
         maxval = get_fp_maxval()
         scale = torch.max(torch.abs(cls.weight.flatten())) / maxval
         linear_weight, scale, log_scales = fp8_tensor_quant(cls.weight, scale)
-        linear_weight = linear_weight.to(torch.float8_e4m3fn)
-        weight_dtype = linear_weight.dtype
-    else:
-        scale = cls.fp8_scale.to(cls.weight.device)
-        linear_weight = cls.weight
-    #####
-
-    if weight_dtype == torch.float8_e4m3fn and cls.weight.sum() != 0:
-        if True or len(input.shape) == 3:
-            cls_dequant = fp8_activation_dequant(linear_weight, scale, original_dtype)
-            if cls.bias != None:
-                output = F.linear(input, cls_dequant, cls.bias)
-            else:
-                output = F.linear(input, cls_dequant)
-            return output
-        else:
-            return cls.original_forward(input.to(original_dtype))
+        cls.weight.data = linear_weight.to(torch.float8_e4m3fn)
     else:
-        return cls.original_forward(input)
+        scale = cls.fp8_scale
+    cls.fp8_scale = scale.to(device=cls.weight.device, dtype=original_dtype)
+    # The reduction and the host sync happen once instead of on every call.
+    cls.fp8_nonzero = bool(cls.weight.view(torch.uint8).any())
+
+    strategy = cls.fp8_strategy
+    if strategy == "dequant_on_load" or not cls.fp8_nonzero:
+        cls.weight.data = fp8_activation_dequant(cls.weight.data, cls.fp8_scale, original_dtype)
+        strategy = "dequant_on_load"
+    cls.fp8_strategy = strategy
+    cls.fp8_prepared = True
+
+
+def prepare_fp8_linears(module, original_dtype):
+    """Prepare every fp8 linear of `module` now, after loading and before offloading copies the weights."""
+    for layer in module.modules():
+        if getattr(layer, "fp8_prepared", None) is False:
+            fp8_prepare_linear(layer, original_dtype)
+
 
-def convert_fp8_linear(module, dit_weight_path, original_dtype, params_to_keep={}):
+def fp8_stream_linear(input, weight, scale, bias, dtype, block_rows=1024):
+    """Dequantize `block_rows` output rows at a time into a reused scratch buffer."""
+    out_features, in_features = weight.shape
+    input = input.to(dtype)
+    output = input.new_empty(*input.shape[:-1], out_features)
+    block_rows = min(block_rows, out_features)
+    scratch = _get_fp8_scratch(block_rows * in_features, weight.device, dtype).view(block_rows, in_features)
+    for start in range(0, out_features, block_rows):
+        end = min(start + block_rows, out_features)
+        w = scratch[: end - start]
+        w.copy_(weight[start:end])
+        w.mul_(scale)
+        output[..., start:end] = F.linear(input, w, None if bias is None else bias[start:end])
+    return output
+
+
+def fp8_scaled_mm_linear(input, weight, scale, bias, dtype):
+    """Per-tensor scaled fp8 GEMM, the activation is quantized to e4m3 on the fly."""
+    shape = input.shape
+    x = input.reshape(-1, shape[-1])
+    x_scale = (x.abs().amax().float() / get_fp_maxval()).clamp(min=1e-12)
+    x_fp8 = (x.float() / x_scale).clamp(-448.0, 448.0).to(torch.float8_e4m3fn)
+    output = torch._scaled_mm(
+        x_fp8,
+        weight.t(),
+        scale_a=x_scale,
+        scale_b=scale.float().reshape(()),
+        bias=None if bias is None else bias.to(dtype),
+        out_dtype=dtype,
+    )
+    if isinstance(output, tuple):  # torch<2.5 also returns amax.
+        output = output[0]
+    return output.reshape(*shape[:-1], weight.shape[0])
+
+
+def fp8_linear_forward(cls, original_dtype, input):
+    if not getattr(cls, "fp8_prepared", False):
+        fp8_prepare_linear(cls, original_dtype)
+    # The scale is a plain attribute that `.to()` and offloading do not move, the weight is where it computes.
+    if cls.fp8_scale.device != cls.weight.device:
+        cls.fp8_scale = cls.fp8_scale.to(cls.weight.device)
+    if cls.fp8_strategy == "scaled_mm" and not getattr(cls, "fp8_scaled_mm_checked", False):
+        cls.fp8_scaled_mm_checked = True
+        if not _supports_scaled_mm(cls.weight):
+            cls.fp8_strategy = "stream"
+
+    if cls.fp8_strategy == "dequant_on_load":
+        return cls.original_forward(input.to(original_dtype))
+    if cls.fp8_strategy == "dequant_per_call":
+        return F.linear(input, fp8_activation_dequant(cls.weight, cls.fp8_scale, original_dtype), cls.bias)
+    if cls.fp8_strategy == "scaled_mm":
+        return fp8_scaled_mm_linear(input, cls.weight, cls.fp8_scale, cls.bias, original_dtype)
+    return fp8_stream_linear(input, cls.weight, cls.fp8_scale, cls.bias, original_dtype)
+
+def convert_fp8_linear(module, dit_weight_path, original_dtype, params_to_keep={}, strategy="dequant_per_call"):
+    if strategy not in FP8_STRATEGIES:
+        raise ValueError(f"Unsupported fp8 strategy: {strategy}, expected one of {FP8_STRATEGIES}.")
     setattr(module, "fp8_matmul_enabled", True)
 
     # loading fp8 mapping file
-    fp8_map_path = dit_weight_path.replace('.pt', '_map.pt')
+    fp8_map_path = os.path.splitext(str(dit_weight_path))[0] + '_map.pt'
     if os.path.exists(fp8_map_path):
         fp8_map = torch.load(fp8_map_path, map_location=lambda storage, loc: storage)
     else:
@@ -97,6 +193,66 @@ def convert_fp8_linear(module, dit_weight_path, original_dtype, params_to_keep={
             layer.weight = torch.nn.Parameter(layer.weight.to(torch.float8_e4m3fn))
             setattr(layer, "fp8_scale", fp8_map[key].to(dtype=original_dtype))
             setattr(layer, "original_forward", original_forward)
+            setattr(layer, "fp8_strategy", strategy)
+            setattr(layer, "fp8_prepared", False)
             setattr(layer, "forward", lambda input, m=layer: fp8_linear_forward(m, original_dtype, input))
-    
 
+
+def benchmark_fp8_strategies(in_features=3072, out_features=12288, tokens=4096, iters=10, device=None):
+    """
+    Compare the fp8 strategies against a float32 reference of the dequantized weight.
+
+    Runs on CPU too (scaled_mm is skipped there). Reports max abs error, time per call and the weight memory
+    kept by each strategy, and asserts the error stays within `MAX_REL_ERR` of the output magnitude.
+    """
+    import copy
+    import time
+
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    dtype = torch.bfloat16 if device == "cuda" else torch.float32
+    torch.manual_seed(0)
+    base = nn.Linear(in_features, out_features, device=device, dtype=dtype)
+    x = torch.randn(tokens, in_features, device=device, dtype=dtype)
+
+    scale = torch.max(torch.abs(base.weight.flatten())) / get_fp_maxval()
+    qdq, scale, _ = fp8_tensor_quant(base.weight.float(), scale)
+    weight_fp8 = qdq.to(torch.float8_e4m3fn)
+    reference = F.linear(x.float(), weight_fp8.float() * scale.float(), base.bias.float())
+    # float32 only sees summation order, bf16 its output rounding, scaled_mm also the e4m3 activations.
+    max_rel_err = {strategy: 1e-4 if dtype == torch.float32 else 2e-2 for strategy in FP8_STRATEGIES}
+    max_rel_err["scaled_mm"] = 1.5e-1
+    ref_max = reference.abs().max().item()
+
+    for strategy in FP8_STRATEGIES:
+        if strategy == "scaled_mm" and not _supports_scaled_mm(weight_fp8):
+            logger.info(f"{strategy:>16}: unsupported on {device}")
+            continue
+        layer = copy.deepcopy(base)
+        original_forward = layer.forward
+        layer.weight = nn.Parameter(weight_fp8.clone(), requires_grad=False)
+        layer.fp8_scale = scale.reshape(-1)[:1].to(dtype)
+        layer.original_forward = original_forward
+        layer.fp8_strategy = strategy
+        layer.fp8_prepared = False
+        with torch.no_grad():
+            out = fp8_linear_forward(layer, dtype, x)
+            if device == "cuda":
+                torch.cuda.synchronize()
+            start = time.time()
+            for _ in range(iters):
+                out = fp8_linear_forward(layer, dtype, x)
+            if device == "cuda":
+                torch.cuda.synchronize()
+        elapsed = (time.time() - start) / iters * 1000
+        err = (out.float() - reference).abs().max().item()
+        weight_mb = layer.weight.numel() * layer.weight.element_size() / 2**20
+        logger.info(
+            f"{layer.fp8_strategy:>16}: max abs err {err:.4e}, {elapsed:.2f} ms/call, weight {weight_mb:.1f} MB"
+        )
+        assert err <= max_rel_err[strategy] * ref_max, (
+            f"{strategy}: max abs err {err:.4e} exceeds {max_rel_err[strategy]:.0e} x max |reference| {ref_max:.4e}"
+        )
+
+
+if __name__ == "__main__":
+    benchmark_fp8_strategies()
@@ -0,0 +1,124 @@
+"""
+Sparsity-aware head-to-rank assignment for Ulysses attention.
+
+After the all-to-all every rank computes the attention of a slice of the heads. With block-sparse
+attention the work of a head is the number of blocks it selects, which varies a lot between heads, so
+contiguous head slices leave some ranks waiting at the next all-to-all. A `HeadBalancer` per attention
+layer accumulates the selected-block count of every head and, every `interval` calls, re-plans which
+heads each rank owns so that the per-rank block counts are equal. Attention is independent per head, so
+any assignment gives the same output.
+
+The counts are summed over the whole sequence-parallel group, i.e. over the Ulysses group and, with
+`--ring-degree > 1`, over the ring, so every Ulysses group of a ring plans the same assignment and ring peers
+always hold the same heads.
+"""
+
+import torch
+import torch.distributed as dist
+from loguru import logger
+
+
+def plan_head_assignment(head_work, world_size):
+    """
+    Assign an equal number of heads to every rank, balancing the summed work (greedy longest-first).
+
+    Args:
+        head_work (list[float]): Work of each head.
+        world_size (int): Number of ranks, must divide the number of heads.
+
+    Returns:
+        list[int]: Head permutation, rank r owns heads perm[r * H/N : (r + 1) * H/N].
+    """
+    heads_per_rank = len(head_work) // world_size
+    loads = [0.0] * world_size
+    owned = [[] for _ in range(world_size)]
+    for head in sorted(range(len(head_work)), key=lambda h: -head_work[h]):
+        rank = min((r for r in range(world_size) if len(owned[r]) < heads_per_rank), key=lambda r: loads[r])
+        owned[rank].append(head)
+        loads[rank] += head_work[head]
+    return [head for heads in owned for head in sorted(heads)]
+
+
+def rank_loads(head_work, perm, world_size):
+    heads_per_rank = len(perm) // world_size
+    return [sum(head_work[h] for h in perm[r * heads_per_rank:(r + 1) * heads_per_rank]) for r in range(world_size)]
+
+
+def imbalance(loads):
+    """Max over mean of the per-rank loads, 1.0 is perfectly balanced."""
+    mean = sum(loads) / len(loads)
+    return max(loads) / mean if mean > 0 else 1.0
+
+
+class HeadBalancer:
+    """
+    Head ownership of one Ulysses attention layer.
+
+    Args:
+        comm (UlyssesComm): Communicator of the Ulysses group.
+        interval (int): Re-plan every `interval` calls, from the block counts accumulated since the last plan.
+        ring_group (ProcessGroup, optional): Ring group of the Ulysses group, the counts are summed over it.
+    """
+
+    def __init__(self, comm, interval, ring_group=None):
+        self.comm = comm
+        self.interval = interval
+        self.ring_group = ring_group
+        self.perm = None  # None is the contiguous assignment.
+        self.calls = 0
+        self.rebalances = 0
+        self.loads = None  # Per-rank selected blocks of the last window, under the assignment that ran.
+        self.planned_loads = None  # The same blocks under the new assignment.
+        self._head_blocks = None
+
+    def record(self, head_blocks):
+        """Add the selected-block count of each local head, (H/N,) as returned in the backend's block_stats."""
+        if self._head_blocks is None:
+            self._head_blocks = torch.zeros_like(head_blocks, dtype=torch.float64)
+        self._head_blocks += head_blocks
+        self.calls += 1
+        if self.calls % self.interval == 0:
+            self.rebalance()
+
+    @torch.no_grad()
+    def rebalance(self):
+        world_size = self.comm.world_size
+        gathered = [torch.empty_like(self._head_blocks) for _ in range(world_size)]
+        dist.all_gather(gathered, self._head_blocks, group=self.comm.group)
+        self._head_blocks = None
+        # Counts of all heads in assignment order, summed over the ring: the same on every rank of the SP group.
+        gathered = torch.cat(gathered)
+        if self.ring_group is not None and dist.get_world_size(self.ring_group) > 1:
+            dist.all_reduce(gathered, group=self.ring_group)
+
+        perm = self.perm.tolist() if self.perm is not None else list(range(gathered.numel()))
+        head_work = [0.0] * len(perm)
+        for head, work in zip(perm, gathered.tolist()):
+            head_work[head] = work
+
+        self.loads = rank_loads(head_work, perm, world_size)
+        new_perm = plan_head_assignment(head_work, world_size)
+        self.planned_loads = rank_loads(head_work, new_perm, world_size)
+        # Every rank plans from the same gathered counts, so all adopt the same assignment.
+        if max(self.planned_loads) < max(self.loads):
+            self.perm = torch.tensor(new_perm, device=gathered.device)
+            self.rebalances += 1
+        else:
+            self.planned_loads = self.loads
+
+
+def log_head_balance(balancers):
+    """Log the mean per-rank imbalance of the last window over all layers, before and after re-planning."""
+    balancers = [b for b in balancers if b is not None and b.loads is not None]
+    if not balancers:
+        return
+    world_size = balancers[0].comm.world_size
+    before = sum(imbalance(b.loads) for b in balancers) / len(balancers)
+    after = sum(imbalance(b.planned_loads) for b in balancers) / len(balancers)
+    rank_share = [sum(b.loads[r] for b in balancers) for r in range(world_size)]
+    total = sum(rank_share) or 1.0
+    logger.info(
+        f"Head balance over {len(balancers)} layers: imbalance (max/mean blocks per rank) {before:.3f} -> {after:.3f}, "
+        f"{sum(b.rebalances for b in balancers)} re-plans, per-rank share "
+        + " ".join(f"{share / total:.3f}" for share in rank_share)
+    )
@@ -111,8 +111,11 @@ class FinalLayer(nn.Module):
         nn.init.zeros_(self.adaLN_modulation[1].weight)
         nn.init.zeros_(self.adaLN_modulation[1].bias)
 
-    def forward(self, x, c):
-        shift, scale = self.adaLN_modulation(c).chunk(2, dim=1)
+    def forward(self, x, c, mod=None):
+        # mod: optional precomputed adaLN_modulation(c).
+        if mod is None:
+            mod = self.adaLN_modulation(c)
+        shift, scale = mod.chunk(2, dim=1)
         x = modulate(self.norm_final(x), shift=shift, scale=scale)
         x = self.linear(x)
         return x
@@ -2,6 +2,7 @@
 
 from typing import Any, List, Tuple, Optional, Union, Dict
 from einops import rearrange
+import contextlib
 import math
 import torch
 import torch.nn as nn
@@ -22,12 +23,23 @@ from .token_refiner import SingleTokenRefiner
 # from .attenion_block_flex import block_flex_attention, block_sparse_attention
 # from .attention_block_triton import block_sparse_attention
 # from .attention_block_fa import block_sparse_attention
-from .attention_block_triton_diffres import block_sparse_attention
-from xfuser.core.distributed import (
-        get_sequence_parallel_world_size,
-        get_sequence_parallel_rank,
-        get_sp_group,
-    )
+# from .attention_block_triton_diffres import block_sparse_attention
+from .attention_backends import get_attention_backend
+try:
+    from xfuser.core.distributed import (
+            get_sequence_parallel_world_size,
+            get_sequence_parallel_rank,
+            get_sp_group,
+        )
+except ImportError:
+    # Without xfuser the sequence-parallel group is the default process group, see seq_parallel_harness.py.
+    def get_sequence_parallel_world_size():
+        return torch.distributed.get_world_size()
+
+    def get_sequence_parallel_rank():
+        return torch.distributed.get_rank()
+
+    get_sp_group = None
 
 import random
 
@@ -174,7 +186,13 @@ class MMDoubleStreamBlock(nn.Module):
         p_remain_rates: float = 0.5,
         txt_block_num: int = 2,
         per_block_token: int = 128,
+        mod: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # mod: optional precomputed [img_mod(vec), txt_mod(vec)], see precompute_modulations.
+        if mod is None:
+            img_mod_out, txt_mod_out = self.img_mod(vec), self.txt_mod(vec)
+        else:
+            img_mod_out, txt_mod_out = mod.chunk(2, dim=-1)
         (
             img_mod1_shift,
             img_mod1_scale,
@@ -182,7 +200,7 @@ class MMDoubleStreamBlock(nn.Module):
             img_mod2_shift,
             img_mod2_scale,
             img_mod2_gate,
-        ) = self.img_mod(vec).chunk(6, dim=-1)
+        ) = img_mod_out.chunk(6, dim=-1)
         (
             txt_mod1_shift,
             txt_mod1_scale,
@@ -190,7 +208,7 @@ class MMDoubleStreamBlock(nn.Module):
             txt_mod2_shift,
             txt_mod2_scale,
             txt_mod2_gate,
-        ) = self.txt_mod(vec).chunk(6, dim=-1)
+        ) = txt_mod_out.chunk(6, dim=-1)
 
         # Prepare image for attention.
         img_modulated = self.img_norm1(img)
@@ -258,7 +276,7 @@ class MMDoubleStreamBlock(nn.Module):
                 )
             else:
                 # print("block_sparse_attention")
-                attn = block_sparse_attention(
+                attn = get_attention_backend()(
                     q,
                     k,
                     v,
@@ -405,8 +423,12 @@ class MMSingleStreamBlock(nn.Module):
         p_remain_rates: float = 0.5,
         txt_block_num: int = 2,
         per_block_token: int = 128,
+        mod: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
-        mod_shift, mod_scale, mod_gate = self.modulation(vec).chunk(3, dim=-1)
+        # mod: optional precomputed modulation(vec), see precompute_modulations.
+        if mod is None:
+            mod = self.modulation(vec)
+        mod_shift, mod_scale, mod_gate = mod.chunk(3, dim=-1)
         x_mod = modulate(self.pre_norm(x), shift=mod_shift, scale=mod_scale)
 
 
@@ -464,7 +486,7 @@ class MMSingleStreamBlock(nn.Module):
                     q, k, v, mode="flash", drop_rate=0.0, attn_mask=None, causal=True, cu_seqlens_q=cu_seqlens_q, cu_seqlens_kv=cu_seqlens_kv, max_seqlen_q=max_seqlen_q, max_seqlen_kv=max_seqlen_kv, batch_size=img_k.shape[0]
                 )
             else:
-                attn = block_sparse_attention(
+                attn = get_attention_backend()(
                     q,
                     k,
                     v,
@@ -699,6 +721,99 @@ class HYVideoDiffusionTransformer(ModelMixin, ConfigMixin):
         for block in self.single_blocks:
             block.disable_deterministic()
 
+    @torch.no_grad()
+    def precompute_modulations(
+        self,
+        timesteps: torch.Tensor,
+        text_states: torch.Tensor,
+        text_mask: torch.Tensor,
+        text_states_2: torch.Tensor,
+        guidance: torch.Tensor = None,
+    ):
+        """
+        Precompute every timestep-dependent block input for a whole denoising schedule.
+
+        vec only depends on (t, guidance, pooled text), and the refined text only on (t, text),
+        so each modulation layer and the token refiner run once over all scheduled timesteps
+        instead of once per step. Results are kept in `self.modulation_cache`, indexed by step.
+        Rebuild it whenever the schedule changes (e.g. a scheduler re-shift at a stage boundary).
+
+        Args:
+            timesteps (torch.Tensor): [num_steps] scheduled timesteps.
+            text_states (torch.Tensor): [b, s, d] text embeddings (cfg batch included).
+            text_mask (torch.Tensor): [b, s] text mask.
+            text_states_2 (torch.Tensor): [b, d2] pooled text embeddings.
+            guidance (torch.Tensor): [b] embedded guidance, required for guidance distilled models.
+        """
+        num_steps = timesteps.shape[0]
+        batch_size = text_states.shape[0]
+        t = timesteps.repeat_interleave(batch_size)  # step-major [num_steps * b]
+
+        vec = self.time_in(t) + self.vector_in(text_states_2).repeat(num_steps, 1)
+        if self.guidance_embed:
+            if guidance is None:
+                raise ValueError(
+                    "Didn't get guidance strength for guidance distilled model."
+                )
+            vec = vec + self.guidance_in(guidance).repeat(num_steps, 1)
+
+        # Compact layout per (step, sample): [double blocks (img|txt) | single blocks | final layer].
+        hidden_size = self.hidden_size
+        mods = vec.new_empty(
+            num_steps * batch_size,
+            hidden_size * (12 * len(self.double_blocks) + 3 * len(self.single_blocks) + 2),
+        )
+        # The modulation layers bypass the block forward, so offloaded blocks are streamed in explicitly.
+        offloader = getattr(self, "block_offloader", None)
+        on_device = offloader.use if offloader is not None else lambda idx: contextlib.nullcontext()
+        offset = 0
+        for idx, block in enumerate(self.double_blocks):
+            with on_device(idx):
+                mods[:, offset : offset + 6 * hidden_size] = block.img_mod(vec)
+                mods[:, offset + 6 * hidden_size : offset + 12 * hidden_size] = block.txt_mod(vec)
+            offset += 12 * hidden_size
+        for idx, block in enumerate(self.single_blocks, len(self.double_blocks)):
+            with on_device(idx):
+                mods[:, offset : offset + 3 * hidden_size] = block.modulation(vec)
+            offset += 3 * hidden_size
+        mods[:, offset:] = self.final_layer.adaLN_modulation(vec)
+
+        if self.text_projection == "linear":
+            txt = self.txt_in(text_states).unsqueeze(0).expand(num_steps, -1, -1, -1)
+        elif self.text_projection == "single_refiner":
+            txt_mask = text_mask.repeat(num_steps, 1) if self.use_attention_mask else None
+            txt = self.txt_in(text_states.repeat(num_steps, 1, 1), t, txt_mask)
+            txt = txt.view(num_steps, batch_size, *txt.shape[1:])
+        else:
+            raise NotImplementedError(
+                f"Unsupported text_projection: {self.text_projection}"
+            )
+
+        self.modulation_cache = {
+            "timesteps": timesteps,
+            "mods": mods.view(num_steps, batch_size, -1),
+            "txt": txt,
+        }
+
+    def get_step_modulations(self, step: int):
+        """Slice the precomputed modulations of one step, see precompute_modulations."""
+        mods = self.modulation_cache["mods"][step]
+        hidden_size = self.hidden_size
+        double_mods, single_mods = [], []
+        offset = 0
+        for _ in self.double_blocks:
+            double_mods.append(mods[:, offset : offset + 12 * hidden_size])
+            offset += 12 * hidden_size
+        for _ in self.single_blocks:
+            single_mods.append(mods[:, offset : offset + 3 * hidden_size])
+            offset += 3 * hidden_size
+        return {
+            "txt": self.modulation_cache["txt"][step],
+            "double": double_mods,
+            "single": single_mods,
+            "final": mods[:, offset:],
+        }
+
     def forward(
         self,
         x: torch.Tensor,
@@ -711,6 +826,8 @@ class HYVideoDiffusionTransformer(ModelMixin, ConfigMixin):
         guidance: torch.Tensor = None,  # Guidance for modulation, should be cfg_scale x 1000.
         sa_drop_rate: float = 0.0,
         return_dict: bool = True,
+        cu_seqlens: Optional[torch.Tensor] = None,  # Precomputed once per stage by the pipeline.
+        max_seqlen: Optional[int] = None,
     ) -> Union[torch.Tensor, Dict[str, torch.Tensor]]:
         out = {}
         img = x
@@ -753,9 +870,12 @@ class HYVideoDiffusionTransformer(ModelMixin, ConfigMixin):
         img_seq_len = img.shape[1]
 
         # Compute cu_squlens and max_seqlen for flash attention
-        cu_seqlens_q = get_cu_seqlens(text_mask, img_seq_len)
+        if cu_seqlens is None:
+            cu_seqlens = get_cu_seqlens(text_mask, img_seq_len)
+            max_seqlen = img_seq_len + txt_seq_len
+        cu_seqlens_q = cu_seqlens
         cu_seqlens_kv = cu_seqlens_q
-        max_seqlen_q = img_seq_len + txt_seq_len
+        max_seqlen_q = max_seqlen
         max_seqlen_kv = max_seqlen_q
 
         freqs_cis = (freqs_cos, freqs_sin) if freqs_cos is not None else None
@@ -849,22 +969,4 @@ class HYVideoDiffusionTransformer(ModelMixin, ConfigMixin):
 #                             HunyuanVideo Configs                              #
 #################################################################################
 
-HUNYUAN_VIDEO_CONFIG = {
-    "HYVideo-T/2": {
-        "mm_double_blocks_depth": 20,
-        "mm_single_blocks_depth": 40,
-        "rope_dim_list": [16, 56, 56],
-        "hidden_size": 3072,
-        "heads_num": 24,
-        "mlp_width_ratio": 4,
-    },
-    "HYVideo-T/2-cfgdistill": {
-        "mm_double_blocks_depth": 20,
-        "mm_single_blocks_depth": 40,
-        "rope_dim_list": [16, 56, 56],
-        "hidden_size": 3072,
-        "heads_num": 24,
-        "mlp_width_ratio": 4,
-        "guidance_embed": True,
-    },
-}
+from ..constants import HUNYUAN_VIDEO_CONFIG
@@ -0,0 +1,415 @@
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+from loguru import logger
+
+
+def _align(nbytes, alignment=256):
+    return (nbytes + alignment - 1) // alignment * alignment
+
+
+class BlockOffloader:
+    """
+    Stream transformer blocks between pinned host memory and a small ring of device slots.
+
+    Blocks are executed in a fixed cyclic order (double blocks, then single blocks, then the next
+    step). The first `num_resident` blocks stay on the device. Every other block lives in pinned
+    host memory and is copied on a side stream into one of `num_prefetch + 1` device slots,
+    `num_prefetch` blocks ahead of the one being computed, so transfers overlap with compute.
+    Slots are taken from a free list and returned when their block has run, so the prefetch that
+    wraps around to the next step never overwrites a slot a block is still using, whatever the
+    number of offloaded blocks.
+
+    With `device="cpu"` the slots are a second host memory pool and copies are synchronous,
+    which exercises the same bookkeeping without a GPU.
+
+    Args:
+        blocks (list[nn.Module]): Blocks in execution order.
+        device (str or torch.device): Compute device.
+        num_resident (int): Number of leading blocks kept on the device.
+        num_prefetch (int): How many blocks ahead to prefetch.
+    """
+
+    def __init__(self, blocks, device, num_resident=0, num_prefetch=1):
+        self.blocks = list(blocks)
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == "cuda"
+        self.num_prefetch = max(1, num_prefetch)
+        self.resident = list(range(min(num_resident, len(self.blocks))))
+        self.offloaded = list(range(len(self.resident), len(self.blocks)))
+        self.order_pos = {idx: pos for pos, idx in enumerate(self.offloaded)}
+        self.num_slots = min(self.num_prefetch + 1, len(self.offloaded))
+
+        for idx in self.resident:
+            self.blocks[idx].to(self.device)
+
+        # Host copies, plus the byte layout each block takes in a slot.
+        self.tensors = {}
+        self.host = {}
+        self.layouts = {}
+        slot_bytes = 0
+        for idx in self.offloaded:
+            tensors = list(itertools.chain(self.blocks[idx].parameters(), self.blocks[idx].buffers()))
+            host, layout, offset = [], [], 0
+            for tensor in tensors:
+                h = tensor.detach().to("cpu")
+                if self.use_cuda:
+                    h = h.pin_memory()
+                tensor.data = h
+                host.append(h)
+                layout.append(offset)
+                offset += _align(h.numel() * h.element_size())
+            self.tensors[idx], self.host[idx], self.layouts[idx] = tensors, host, layout
+            slot_bytes = max(slot_bytes, offset)
+
+        self.slots = [
+            torch.empty(slot_bytes, dtype=torch.uint8, device=self.device) for _ in range(self.num_slots)
+        ]
+        self.pending = {}  # block index -> slot index, loaded or in flight.
+        self.free_slots = list(range(self.num_slots))
+        if self.use_cuda:
+            self.copy_stream = torch.cuda.Stream(device=self.device)
+            self.ready_events = {idx: torch.cuda.Event() for idx in self.offloaded}
+            self.free_events = [None] * self.num_slots
+
+        self.handles = []
+        for idx in self.offloaded:
+            self.handles.append(
+                self.blocks[idx].register_forward_pre_hook(lambda m, args, idx=idx: self._pre_forward(idx))
+            )
+            self.handles.append(
+                self.blocks[idx].register_forward_hook(lambda m, args, out, idx=idx: self._post_forward(idx))
+            )
+
+    def _load(self, idx):
+        if not self.free_slots:
+            raise RuntimeError(f"No free offload slot for block {idx}, blocks in slots: {sorted(self.pending)}")
+        slot = self.free_slots.pop(0)
+        buf = self.slots[slot]
+        views = []
+        for tensor, h, offset in zip(self.tensors[idx], self.host[idx], self.layouts[idx]):
+            nbytes = h.numel() * h.element_size()
+            views.append(buf[offset : offset + nbytes].view(h.dtype).view(h.shape))
+        if self.use_cuda:
+            with torch.cuda.stream(self.copy_stream):
+                # The slot may still be read by the block that used it last.
+                if self.free_events[slot] is not None:
+                    self.copy_stream.wait_event(self.free_events[slot])
+                for view, h in zip(views, self.host[idx]):
+                    view.copy_(h, non_blocking=True)
+                self.ready_events[idx].record(self.copy_stream)
+        else:
+            for view, h in zip(views, self.host[idx]):
+                view.copy_(h)
+        for tensor, view in zip(self.tensors[idx], views):
+            tensor.data = view
+        self.pending[idx] = slot
+
+    def _pre_forward(self, idx):
+        if idx not in self.pending:
+            self._load(idx)
+        if self.use_cuda:
+            torch.cuda.current_stream(self.device).wait_event(self.ready_events[idx])
+        pos = self.order_pos[idx]
+        for k in range(1, self.num_slots):
+            nxt = self.offloaded[(pos + k) % len(self.offloaded)]
+            if nxt in self.pending:
+                continue
+            if not self.free_slots:
+                break
+            self._load(nxt)
+
+    def _post_forward(self, idx):
+        slot = self.pending.pop(idx)
+        if self.use_cuda:
+            event = torch.cuda.Event()
+            event.record(torch.cuda.current_stream(self.device))
+            self.free_events[slot] = event
+        self.free_slots.append(slot)
+        # Kernels are already enqueued, so the block can point back to its host copy.
+        for tensor, h in zip(self.tensors[idx], self.host[idx]):
+            tensor.data = h
+
+    @contextmanager
+    def use(self, idx):
+        """
+        Keep block `idx` on the device for calls that bypass its forward hooks, e.g. running its
+        modulation layers directly. Blocks must be used in execution order, as with their forward.
+        """
+        if idx in self.order_pos:
+            self._pre_forward(idx)
+        try:
+            yield
+        finally:
+            if idx in self.order_pos:
+                self._post_forward(idx)
+
+    @contextmanager
+    def frozen(self):
+        """Keep offloaded blocks in place while the owning model is moved with `.to()`."""
+        for idx in self.offloaded:
+            for module in self.blocks[idx].modules():
+                module._apply = lambda fn, recurse=True, module=module: module
+        try:
+            yield
+        finally:
+            for idx in self.offloaded:
+                for module in self.blocks[idx].modules():
+                    del module._apply
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+
+def enable_block_offload(model, device, num_resident=0, num_prefetch=1):
+    """
+    Offload the DiT blocks of `model` with a BlockOffloader, everything else goes to `device`.
+
+    The model is expected to be on the host. The offloader is kept as `model.block_offloader`.
+    """
+    blocks = list(model.double_blocks) + list(model.single_blocks)
+    offloader = BlockOffloader(blocks, device, num_resident=num_resident, num_prefetch=num_prefetch)
+    with offloader.frozen():
+        model.to(device)
+    model.block_offloader = offloader
+    return offloader
+
+
+class ResidencyManager:
+    """
+    Keep each pipeline component on the device only during the phase that uses it.
+
+    Components that fit in `memory_budget_gb` (smallest first) are pinned on the device for the
+    whole run. The others keep a pinned host copy of their weights, are uploaded on a side stream
+    when their phase is entered or prefetched, and are released by pointing their parameters
+    back to the host copy. Weights are never written during inference, so releasing is free.
+
+    A component used outside the phases, e.g. the VAE of a background decode worker, is held
+    with `hold`: it stays on the device until released, whatever phase the pipeline enters in
+    the meantime. All methods take the same lock, so they can be called from several threads.
+
+    Args:
+        components (dict[str, nn.Module]): Components by name, e.g. the pipeline's text_encoder,
+            text_encoder_2, transformer and vae.
+        device (str or torch.device): Compute device.
+        memory_budget_gb (float): Device memory available for weights.
+        logger: Logger for the per-prompt timeline.
+    """
+
+    PHASES = {
+        "encode": ("text_encoder", "text_encoder_2"),
+        "denoise": ("transformer",),
+        "decode": ("vae",),
+    }
+
+    def __init__(self, components, device, memory_budget_gb, logger=None):
+        self.components = {name: module for name, module in components.items() if module is not None}
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == "cuda"
+        self.budget = int(memory_budget_gb * 2**30)
+        self.logger = logger
+
+        sizes = {
+            name: sum(t.numel() * t.element_size() for t in itertools.chain(module.parameters(), module.buffers()))
+            for name, module in self.components.items()
+        }
+        self.pinned = set()
+        used = 0
+        for name in sorted(sizes, key=sizes.get):
+            if getattr(self.components[name], "block_offloader", None) is not None:
+                # The block offloader already owns placement of the DiT blocks.
+                self.pinned.add(name)
+            elif used + sizes[name] <= self.budget:
+                self.pinned.add(name)
+                used += sizes[name]
+        self.sizes = sizes
+        self.pinned_bytes = used
+
+        self.tensors, self.host = {}, {}
+        for name, module in self.components.items():
+            if name in self.pinned:
+                if getattr(module, "block_offloader", None) is None:
+                    module.to(self.device)
+                continue
+            tensors = list(itertools.chain(module.parameters(), module.buffers()))
+            host = []
+            for tensor in tensors:
+                h = tensor.detach().to("cpu")
+                if self.use_cuda:
+                    h = h.pin_memory()
+                tensor.data = h
+                host.append(h)
+            self.tensors[name], self.host[name] = tensors, host
+
+        self.resident = set(self.pinned)
+        self.held = {}  # name -> number of `hold` contexts using it
+        self.lock = threading.RLock()
+        self.events = {}
+        if self.use_cuda:
+            self.copy_stream = torch.cuda.Stream(device=self.device)
+        self.timeline = []
+        self.phase = None
+        self.phase_start = None
+
+    def _phase_components(self, phase):
+        return [name for name in self.PHASES[phase] if name in self.components]
+
+    def _resident_bytes(self):
+        return sum(self.sizes[name] for name in self.resident)
+
+    def _upload(self, name):
+        if name in self.resident:
+            return
+        if self.use_cuda:
+            with torch.cuda.stream(self.copy_stream):
+                for tensor, h in zip(self.tensors[name], self.host[name]):
+                    tensor.data = h.to(self.device, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record(self.copy_stream)
+                self.events[name] = event
+        else:
+            for tensor, h in zip(self.tensors[name], self.host[name]):
+                tensor.data = h.to(self.device)
+        self.resident.add(name)
+
+    def _release(self, name):
+        if name in self.pinned or name not in self.resident or self.held.get(name):
+            return
+        for tensor, h in zip(self.tensors[name], self.host[name]):
+            tensor.data = h
+        self.resident.discard(name)
+        self.events.pop(name, None)
+
+    def _wait_upload(self, name):
+        if self.use_cuda and name in self.events:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(self.events.pop(name))
+            # Uploaded on the copy stream, keep the memory alive until compute is done.
+            for tensor in self.tensors[name]:
+                tensor.data.record_stream(stream)
+
+    def prefetch(self, phase):
+        """Start uploading the components of `phase` if they fit next to the current ones."""
+        with self.lock:
+            names = [name for name in self._phase_components(phase) if name not in self.resident]
+            if self._resident_bytes() + sum(self.sizes[name] for name in names) > self.budget:
+                return
+            for name in names:
+                self._upload(name)
+
+    def enter(self, phase):
+        """Make `phase` the active phase, releasing the components it does not use and nobody holds."""
+        with self.lock:
+            now = time.time()
+            if self.phase is not None:
+                self.timeline.append((self.phase, self.phase_start, now))
+            needed = self._phase_components(phase)
+            for name in list(self.resident):
+                if name not in needed:
+                    self._release(name)
+            for name in needed:
+                self._upload(name)
+                self._wait_upload(name)
+            self.phase, self.phase_start = phase, time.time()
+            self.timeline.append((f"upload:{phase}", now, self.phase_start))
+
+    @contextmanager
+    def hold(self, name):
+        """
+        Keep component `name` on the device for the duration of the context, on the current stream.
+
+        Held components count against the budget but are not released by `enter`, so the device may
+        briefly hold more than `memory_budget_gb`. After the last hold, the component stays resident
+        until the next `enter` that does not need it.
+        """
+        if name not in self.components:
+            yield
+            return
+        with self.lock:
+            self._upload(name)
+            self._wait_upload(name)
+            if self.use_cuda and name in self.tensors:
+                # Released later from another thread, keep the memory alive until this stream is done.
+                stream = torch.cuda.current_stream(self.device)
+                for tensor in self.tensors[name]:
+                    tensor.data.record_stream(stream)
+            self.held[name] = self.held.get(name, 0) + 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.held[name] -= 1
+
+    def finish(self):
+        """Close the current phase and log the timeline of this prompt."""
+        with self.lock:
+            self._finish()
+
+    def _finish(self):
+        if self.phase is not None:
+            self.timeline.append((self.phase, self.phase_start, time.time()))
+        if self.timeline and self.logger is not None:
+            origin = self.timeline[0][1]
+            entries = ", ".join(
+                f"{name} {start - origin:.2f}-{end - origin:.2f}s" for name, start, end in self.timeline
+            )
+            self.logger.info(
+                f"Residency timeline (pinned: {sorted(self.pinned)}, "
+                f"{self.pinned_bytes / 2**30:.1f}/{self.budget / 2**30:.1f} GB): {entries}"
+            )
+        self.timeline = []
+        self.phase = None
+        self.phase_start = None
+
+
+# ======================== CPU check ========================
+
+
+def _check_block_offload(num_blocks, num_resident, num_prefetch, steps=3, dim=32):
+    """Compare a stack of blocks run through a BlockOffloader on the host with the same blocks left in place."""
+    torch.manual_seed(0)
+    blocks = nn.ModuleList(
+        nn.Sequential(nn.Linear(dim, dim), nn.GELU(), nn.LayerNorm(dim)) for _ in range(num_blocks)
+    )
+    reference = [{name: t.detach().clone() for name, t in block.state_dict().items()} for block in blocks]
+    x = torch.randn(4, dim)
+
+    def run():
+        h = x
+        for block in blocks:
+            h = block(h)
+        return h
+
+    with torch.no_grad():
+        expected = run()
+        expected_first = [block[0](x) for block in blocks]
+        offloader = BlockOffloader(blocks, "cpu", num_resident=num_resident, num_prefetch=num_prefetch)
+        # Direct calls into every block, as precompute_modulations makes them, before the forward steps.
+        for idx, block in enumerate(blocks):
+            with offloader.use(idx):
+                torch.testing.assert_close(block[0](x), expected_first[idx], msg=lambda m: f"use({idx}): {m}")
+        # Several steps, so the prefetch wraps around from the last block to the first.
+        for step in range(steps):
+            torch.testing.assert_close(run(), expected, msg=lambda m: f"step {step}: {m}")
+    offloader.remove()
+    for idx, (block, state) in enumerate(zip(blocks, reference)):
+        for name, t in block.state_dict().items():
+            torch.testing.assert_close(t, state[name], msg=lambda m: f"block {idx} {name}: {m}")
+    logger.info(
+        f"{num_blocks} blocks, {num_resident} resident, {len(offloader.offloaded)} offloaded into "
+        f"{offloader.num_slots} slots: outputs match the resident blocks over {steps} steps"
+    )
+
+
+if __name__ == "__main__":
+    # Offloaded block counts that the number of slots does not divide.
+    _check_block_offload(num_blocks=5, num_resident=0, num_prefetch=1)
+    _check_block_offload(num_blocks=6, num_resident=1, num_prefetch=2)
+    _check_block_offload(num_blocks=7, num_resident=0, num_prefetch=3)
+    _check_block_offload(num_blocks=4, num_resident=0, num_prefetch=1)
@@ -0,0 +1,256 @@
+"""
+All-to-all communication of the Ulysses sequence-parallel attention.
+
+Q/K/V of the image tokens go through one all-to-all in a single packed buffer. The text tokens are replicated
+on every rank, so their heads are sliced locally instead of being communicated. Image and text outputs go
+back in one all-to-all as well. Send/receive buffers are cached per process group and reused by every block
+and step. Only `torch.distributed.all_to_all_single` is used, which gloo (CPU) supports as well as NCCL.
+
+The collectives are not differentiable, use yunchang's SeqAllToAll4D when gradients are needed.
+
+`UlyssesAttention` runs this path without xfuser/yunchang, see seq_parallel_harness.py.
+"""
+
+import math
+
+import torch
+import torch.distributed as dist
+
+from .head_balance import HeadBalancer
+from .sparse_ring_attention import get_ring_comm, sparse_ring_attention
+
+_COMMS = {}
+
+
+class UlyssesComm:
+    """
+    Packed Ulysses all-to-all over `group`, with reusable buffers.
+
+    `bytes_sent` counts the bytes this rank sent to other ranks, for communication volume reports.
+    """
+
+    def __init__(self, group=None):
+        self.group = group
+        self.world_size = dist.get_world_size(group)
+        self.rank = dist.get_rank(group)
+        self.bytes_sent = 0
+        self._buffers = {}
+
+    def _buffer(self, name, shape, like):
+        key = (name, like.dtype, like.device)
+        numel = math.prod(shape)
+        buf = self._buffers.get(key)
+        if buf is None or buf.numel() < numel:
+            buf = self._buffers[key] = torch.empty(numel, dtype=like.dtype, device=like.device)
+        return buf[:numel].view(shape)
+
+    def _all_to_all(self, recv, send):
+        dist.all_to_all_single(recv, send, group=self.group)
+        self.bytes_sent += send.numel() * send.element_size() * (self.world_size - 1) // self.world_size
+
+    def scatter_qkv(self, q, k, v, txt_q, txt_k, txt_v, head_perm=None):
+        """
+        Gather the sequence and scatter the heads of Q/K/V.
+
+        Args:
+            q, k, v (Tensor): (b, s/N, H, D) image shards of this rank.
+            txt_q, txt_k, txt_v (Tensor): (b, txt, H, D) text tokens, replicated on every rank.
+            head_perm (Tensor): Rank r gets heads head_perm[r * H/N : (r + 1) * H/N], contiguous slices when None.
+
+        Returns:
+            q, k, v (Tensor): (b, s + txt, H/N, D) full sequences with the heads of this rank, text at the rear.
+                They live in a reused buffer and are only valid until the next call.
+        """
+        n = self.world_size
+        b, s_local, num_heads, head_dim = q.shape
+        heads = num_heads // n
+        txt = txt_q.shape[1]
+
+        send = self._buffer("qkv_send", (n, 3, b, s_local, heads, head_dim), q)
+        for i, x in enumerate((q, k, v)):
+            if head_perm is not None:
+                x = x.index_select(2, head_perm)
+            send[:, i].copy_(x.reshape(b, s_local, n, heads, head_dim).permute(2, 0, 1, 3, 4))
+        recv = self._buffer("qkv_recv", send.shape, q)
+        self._all_to_all(recv, send)
+
+        out = self._buffer("qkv_out", (3, b, n * s_local + txt, heads, head_dim), q)
+        out[:, :, : n * s_local].view(3, b, n, s_local, heads, head_dim).copy_(recv.permute(1, 2, 0, 3, 4, 5))
+        rank_heads = slice(self.rank * heads, (self.rank + 1) * heads)
+        if head_perm is not None:
+            rank_heads = head_perm[rank_heads]
+        for i, x in enumerate((txt_q, txt_k, txt_v)):
+            out[i, :, n * s_local :].copy_(x[:, :, rank_heads])
+        return out[0], out[1], out[2]
+
+    def gather_output(self, out, s_local, head_perm=None):
+        """
+        Scatter the sequence and gather the heads of the attention output.
+
+        Args:
+            out (Tensor): (b, N * s_local + txt, H/N, D) attention output of this rank's heads.
+            s_local (int): Image tokens per rank.
+            head_perm (Tensor): The head assignment of `scatter_qkv`, undone here.
+
+        Returns:
+            Tensor: (b, s_local + txt, H, D) image shard of this rank followed by the full text output.
+        """
+        n = self.world_size
+        b, length, heads, head_dim = out.shape
+        txt = length - n * s_local
+
+        # Each rank gets its image chunk plus the text output, for the heads of this rank.
+        send = self._buffer("out_send", (n, b, s_local + txt, heads, head_dim), out)
+        send[:, :, :s_local].copy_(out[:, : n * s_local].view(b, n, s_local, heads, head_dim).permute(1, 0, 2, 3, 4))
+        send[:, :, s_local:].copy_(out[:, n * s_local :])
+        recv = self._buffer("out_recv", send.shape, out)
+        self._all_to_all(recv, send)
+
+        output = out.new_empty((b, s_local + txt, n * heads, head_dim))
+        output.view(b, s_local + txt, n, heads, head_dim).copy_(recv.permute(1, 2, 0, 3, 4))
+        if head_perm is not None:
+            output = output.index_select(2, torch.argsort(head_perm))
+        return output
+
+
+def get_ulysses_comm(group=None):
+    """The shared UlyssesComm of `group`, so all blocks reuse the same buffers."""
+    comm = _COMMS.get(group)
+    if comm is None:
+        comm = _COMMS[group] = UlyssesComm(group)
+    return comm
+
+
+def packed_ulysses_attention(
+    comm,
+    attn_fn,
+    query,
+    key,
+    value,
+    txt_query,
+    txt_key,
+    txt_value,
+    cu_seqlens_q,
+    balancer=None,
+    ring_comm=None,
+    ring_attn_fn=None,
+    **kwargs,
+):
+    """
+    Block-sparse attention of image shards plus replicated text tokens, with the packed all-to-alls of `comm`.
+
+    Args:
+        comm (UlyssesComm): Communicator of the sequence-parallel group.
+        attn_fn (callable): Block-sparse attention backend, see attention_backends.py.
+        query, key, value (Tensor): (b, s/N, H, D) image shards of this rank.
+        txt_query, txt_key, txt_value (Tensor): (b, txt, H, D) text tokens.
+        cu_seqlens_q (Tensor): cu_seqlens over the local image tokens and the text.
+        balancer (HeadBalancer): Head-to-rank assignment of this layer, fed with the per-head block counts.
+            With a ring it must plan over `ring_comm.group`, so all ring peers use the same assignment.
+        ring_comm (SparseRingComm): With a ring of several ranks, each Ulysses group holds one segment of the
+            image tokens and attention runs as a sparse ring, see sparse_ring_attention.py.
+        ring_attn_fn (callable): Masked (output, lse) kernel of the backend, for the ring.
+        **kwargs: Forwarded to `attn_fn` (top_k, text_amp, block_neighbor_list, p_remain_rates).
+
+    Returns:
+        Tensor: (b, s/N + txt, H, D) image shard of this rank followed by the text output.
+    """
+    q_len = query.shape[1]
+    txt_len = cu_seqlens_q[1] - q_len
+    ring = ring_comm is not None and ring_comm.world_size > 1
+    if ring and balancer is not None and balancer.ring_group is not ring_comm.group:
+        # Ring peers exchange K/V and merge text partials per local head, they must hold the same heads.
+        raise ValueError("Head balancing with a ring needs a HeadBalancer planning over the ring group.")
+    head_perm = balancer.perm if balancer is not None else None
+    query_layer, key_layer, value_layer = comm.scatter_qkv(
+        query, key, value, txt_query, txt_key, txt_value, head_perm=head_perm
+    )
+    if balancer is not None:
+        kwargs["block_stats"] = block_stats = {}
+
+    if ring:
+        out = sparse_ring_attention(
+            ring_comm, ring_attn_fn, query_layer, key_layer, value_layer, int(txt_len), **kwargs
+        )
+    else:
+        img_len = comm.world_size * q_len
+        cu_seqlens = torch.tensor([0, txt_len + img_len, query_layer.shape[1]], device=query_layer.device)
+        out = attn_fn(
+            query_layer,
+            key_layer,
+            value_layer,
+            block_size_M=128,
+            block_size_N=128,
+            cu_seqlens_q=cu_seqlens,
+            cu_seqlens_kv=cu_seqlens,
+            shape_xfuse=True,
+            **kwargs,
+        )
+        if isinstance(out, tuple):
+            out = out[0]
+    output = comm.gather_output(out, q_len, head_perm=head_perm)
+    if balancer is not None:
+        balancer.record(block_stats["head_blocks"])
+    return output
+
+
+class UlyssesAttention:
+    """
+    Stand-in for xFuserLongContextAttention as `block.hybrid_seq_parallel_attn`, built only on
+    torch.distributed: the packed path, with any attention backend.
+
+    Args:
+        attn_fn (callable): Block-sparse attention backend, see attention_backends.py.
+        group (ProcessGroup): Ulysses group, the default group when None.
+        ring_group (ProcessGroup): Ring group, the sparse ring runs when it has several ranks.
+        ring_attn_fn (callable): Masked (output, lse) kernel of the backend, needed with a ring.
+        head_balance_interval (int): Re-plan the head-to-rank assignment every this many calls, 0 disables it.
+    """
+
+    def __init__(self, attn_fn, group=None, ring_group=None, ring_attn_fn=None, head_balance_interval=0):
+        self.attn_fn = attn_fn
+        self.comm = get_ulysses_comm(group)
+        self.ring_comm = get_ring_comm(ring_group) if ring_group is not None else None
+        self.ring_attn_fn = ring_attn_fn
+        self.balancer = (
+            HeadBalancer(self.comm, head_balance_interval, ring_group=ring_group) if head_balance_interval > 0 else None
+        )
+
+    def __call__(
+        self,
+        attn,
+        query,
+        key,
+        value,
+        *,
+        joint_tensor_query=None,
+        joint_tensor_key=None,
+        joint_tensor_value=None,
+        joint_strategy="rear",
+        top_k=0,
+        text_amp=0.0,
+        block_neighbor_list=None,
+        p_remain_rates=0.0,
+        cu_seqlens_q=None,
+        **kwargs,
+    ):
+        if joint_strategy != "rear" or joint_tensor_query is None:
+            raise ValueError(f"Packed qkv only supports joint_strategy 'rear', got {joint_strategy}.")
+        return packed_ulysses_attention(
+            self.comm,
+            self.attn_fn,
+            query,
+            key,
+            value,
+            joint_tensor_query,
+            joint_tensor_key,
+            joint_tensor_value,
+            cu_seqlens_q,
+            balancer=self.balancer,
+            ring_comm=self.ring_comm,
+            ring_attn_fn=self.ring_attn_fn,
+            top_k=top_k,
+            text_amp=text_amp,
+            block_neighbor_list=block_neighbor_list,
+            p_remain_rates=p_remain_rates,
+        )
@@ -0,0 +1,414 @@
+"""
+CPU harness for the Ulysses sequence-parallel path.
+
+Spawns N CPU processes on the gloo backend and runs a tiny stack of the DiT blocks of
+models_mul_block_gc_ha_multigpu.py through the sequence-parallel forward of jenga_hyvideo_multigpu.py:
+image tokens split over the ranks, text replicated, attention through `my_parallel_attention` with the
+packed all-to-all of seq_parallel_comm.py and the reference block-sparse backend. Every rank checks the
+gathered outputs against the single-process forward of the same blocks, and rank 0 reports the all-to-all
+volume and time per step. Communication changes can be validated without NCCL or GPUs:
+
+    python -m hyvideo.modules.seq_parallel_harness --world-size 4
+
+With `--head-balance-interval 1` the head-to-rank assignment is re-planned after every step, and the later
+steps must still match. With `--ring-degree R` the ranks form Ulysses groups of world_size / R contiguous
+ranks and ring groups of R strided ranks, and attention runs as the sparse ring of sparse_ring_attention.py.
+Both together also check that every rank adopted the same head assignment.
+
+With `--entry transformer` the harness goes through the real multi-GPU entry point instead: a tiny
+`HYVideoDiffusionTransformer` is configured like `jenga_hyvideo_multigpu.main` (Jenga sub-forward, Gilbert
+curve, block neighbours), `parallelize_transformer_prores` installs its forward and the blocks attend through
+`xFuserLongContextAttention`. This needs the multi-GPU stack (xfuser, yunchang, flash_attn) importable, the
+attention itself still runs the reference backend on gloo. The output is checked against the single-process
+forward of the same model:
+
+    python -m hyvideo.modules.seq_parallel_harness --world-size 4 --entry transformer
+
+A mismatch raises, so the exit code can gate regressions.
+"""
+
+import argparse
+import importlib.util
+import os
+import time
+from types import SimpleNamespace
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from loguru import logger
+
+TOKENS_PER_BLOCK = 128
+
+
+def _init_xfuser(rank, world_size, ring_degree):
+    try:
+        from xfuser.core.distributed import init_distributed_environment, initialize_model_parallel
+    except ImportError:
+        return  # The blocks fall back to the default process group.
+    init_distributed_environment(rank=rank, world_size=world_size, backend="gloo")
+    initialize_model_parallel(
+        sequence_parallel_degree=world_size, ulysses_degree=world_size // ring_degree, ring_degree=ring_degree
+    )
+
+
+def new_sequence_parallel_groups(world_size, ring_degree):
+    """Ulysses groups of contiguous ranks and ring groups of strided ranks, so ring rank r holds segment r."""
+    rank = dist.get_rank()
+    ulysses_degree = world_size // ring_degree
+    ulysses_group = ring_group = None
+    # Every rank has to create every group.
+    for start in range(0, world_size, ulysses_degree):
+        group = dist.new_group(list(range(start, start + ulysses_degree)))
+        if start <= rank < start + ulysses_degree:
+            ulysses_group = group
+    for offset in range(ulysses_degree):
+        group = dist.new_group(list(range(offset, world_size, ulysses_degree)))
+        if rank % ulysses_degree == offset:
+            ring_group = group
+    return ulysses_group, ring_group
+
+
+def build_blocks(args, hidden_size, dtype):
+    from .models_mul_block_gc_ha_multigpu import MMDoubleStreamBlock, MMSingleStreamBlock
+
+    double_blocks = [
+        MMDoubleStreamBlock(hidden_size, args.heads, mlp_width_ratio=2.0, qkv_bias=True, dtype=dtype)
+        for _ in range(args.double_blocks)
+    ]
+    single_blocks = [
+        MMSingleStreamBlock(hidden_size, args.heads, mlp_width_ratio=2.0, dtype=dtype)
+        for _ in range(args.single_blocks)
+    ]
+    for block in double_blocks + single_blocks:
+        block.eval()
+        # Modulations are zero-initialized, which would gate the attention out of the result.
+        for param in block.parameters():
+            if not param.any():
+                torch.nn.init.normal_(param, std=0.1)
+    return double_blocks, single_blocks
+
+
+def blocks_forward(double_blocks, single_blocks, img, txt, vec, freqs_cis, cu_seqlens, max_seqlen, curve_sel, args):
+    """The double and single block loop of `transformer_sub_forward`, returns image and text tokens."""
+    txt_len = txt.shape[1]
+    block_args = (
+        cu_seqlens,
+        cu_seqlens,
+        max_seqlen,
+        max_seqlen,
+        freqs_cis,
+        args.sa_drop_rate,
+        args.text_amp,
+        curve_sel,
+        args.p_remain_rate,
+    )
+    for block in double_blocks:
+        img, txt = block(img, txt, vec, *block_args)
+    x = torch.cat((img, txt), 1)
+    for block in single_blocks:
+        x = block(x, vec, txt_len, *block_args)
+    return x
+
+
+def check_head_assignment(balancers, num_heads):
+    """Ring peers must hold the same heads, so the assignment has to agree over the whole group."""
+    if not balancers or balancers[0] is None:
+        return
+    perms = torch.stack([b.perm if b.perm is not None else torch.arange(num_heads) for b in balancers])
+    all_perms = [torch.empty_like(perms) for _ in range(dist.get_world_size())]
+    dist.all_gather(all_perms, perms)
+    if any(not torch.equal(p, perms) for p in all_perms):
+        raise AssertionError("Ranks adopted different head assignments")
+
+
+def check_inputs(args, world_size, img_len):
+    if args.text_len % TOKENS_PER_BLOCK:
+        raise ValueError(f"--text-len must be a multiple of {TOKENS_PER_BLOCK}, got {args.text_len}")
+    if img_len % (world_size * TOKENS_PER_BLOCK):
+        raise ValueError(f"{img_len} image tokens do not split into {TOKENS_PER_BLOCK}-token blocks per rank")
+    num_img_blocks = img_len // TOKENS_PER_BLOCK
+    # The blocks scale the local top_k by the world size, which only matches one process when it divides evenly.
+    keep_rate = 1 - args.sa_drop_rate
+    if int(keep_rate * (num_img_blocks // world_size)) * world_size != int(keep_rate * num_img_blocks):
+        raise ValueError(f"--sa-drop-rate {args.sa_drop_rate} gives a different top_k per rank than in one process")
+    return num_img_blocks
+
+
+def build_transformer(args, hidden_size, dtype):
+    """A tiny HYVideoDiffusionTransformer, configured for the Jenga forward like jenga_hyvideo_multigpu.main."""
+    from jenga_hyvideo_multigpu import build_multi_curve, transformer_sub_forward
+
+    from .models_mul_block_gc_ha_multigpu import HYVideoDiffusionTransformer
+
+    model_args = argparse.Namespace(text_states_dim=args.text_states_dim, text_states_dim_2=args.text_states_dim_2)
+    transformer = HYVideoDiffusionTransformer(
+        model_args,
+        in_channels=args.latent_channels,
+        hidden_size=hidden_size,
+        heads_num=args.heads,
+        mlp_width_ratio=2.0,
+        mm_double_blocks_depth=args.double_blocks,
+        mm_single_blocks_depth=args.single_blocks,
+        rope_dim_list=args.rope_dim_list,
+        text_projection="linear",
+        dtype=dtype,
+    )
+    transformer.eval()
+    # Modulations and the final layer are zero-initialized, which would gate everything out of the result.
+    for param in transformer.parameters():
+        if not param.any():
+            torch.nn.init.normal_(param, std=0.1)
+
+    cls = type(transformer)
+    cls.forward = transformer_sub_forward
+    cls.transformer_sub_forward = transformer_sub_forward
+    world_size = dist.get_world_size()
+    curve_sel = build_multi_curve(world_size * args.frames_per_rank, args.latent_size, args.latent_size, [1.0])[0]
+    transformer.enable_skip = False
+    transformer.cnt = 0
+    transformer.num_steps = args.steps
+    transformer.sa_drop_rate = args.sa_drop_rate
+    transformer.text_amp = args.text_amp
+    transformer.p_remain_rates = args.p_remain_rate
+    transformer.curve_sel = curve_sel
+    transformer.linear_to_hilbert, transformer.hilbert_order = curve_sel[0][0], curve_sel[0][1]
+    return transformer
+
+
+def transformer_reference(transformer, x, t, txt, text_mask, txt_2, freqs_cos, freqs_sin):
+    """`new_forward` of parallelize_transformer_prores in one process: no split, no gather."""
+    _, _, ot, oh, ow = x.shape
+    pt, ph, pw = transformer.patch_size
+    vec = transformer.time_in(t) + transformer.vector_in(txt_2)
+    order = transformer.hilbert_order
+    img = transformer.img_in(x)[:, order]
+    img = transformer.transformer_sub_forward(
+        img, vec, transformer.txt_in(txt), text_mask, freqs_cos[order], freqs_sin[order], return_dict=False
+    )
+    img = transformer.final_layer(img[:, transformer.linear_to_hilbert], vec)
+    return transformer.unpatchify(img, ot // pt, oh // ph, ow // pw)
+
+
+@torch.no_grad()
+def run_transformer(rank, args):
+    from jenga_hyvideo_multigpu import parallelize_transformer_prores
+
+    from .attention_backends import set_default_attention_backend
+    from .head_balance import log_head_balance
+    from .posemb_layers import get_nd_rotary_pos_embed
+
+    set_default_attention_backend(args.attention_backend)
+    world_size = dist.get_world_size()
+    dtype = getattr(torch, args.dtype)
+    hidden_size = args.heads * sum(args.rope_dim_list)
+    rope_sizes = (world_size * args.frames_per_rank, args.latent_size, args.latent_size)
+    img_len = rope_sizes[0] * rope_sizes[1] * rope_sizes[2]
+    check_inputs(args, world_size, img_len)
+
+    # Same seed on every rank: identical weights and inputs.
+    torch.manual_seed(args.seed)
+    transformer = build_transformer(args, hidden_size, dtype)
+    x = torch.randn(1, args.latent_channels, rope_sizes[0], 2 * args.latent_size, 2 * args.latent_size, dtype=dtype)
+    t = torch.full((1,), 500.0, dtype=dtype)
+    txt = torch.randn(1, args.text_len, args.text_states_dim, dtype=dtype)
+    text_mask = torch.zeros(1, args.text_len, dtype=torch.int64)
+    text_mask[:, : args.text_valid] = 1
+    txt_2 = torch.randn(1, args.text_states_dim_2, dtype=dtype)
+    freqs_cos, freqs_sin = get_nd_rotary_pos_embed(args.rope_dim_list, rope_sizes, theta=256, use_real=True)
+    freqs_cos, freqs_sin = freqs_cos.to(dtype), freqs_sin.to(dtype)
+
+    # Before parallelizing: the blocks have no sequence-parallel attention yet and run in one process.
+    reference = transformer_reference(transformer, x, t, txt, text_mask, txt_2, freqs_cos, freqs_sin)
+
+    pipe = SimpleNamespace(
+        transformer=transformer,
+        args=argparse.Namespace(unpacked_qkv_all_to_all=False, head_balance_interval=args.head_balance_interval),
+    )
+    parallelize_transformer_prores(pipe)
+    step_times = []
+    for _ in range(args.steps):
+        dist.barrier()
+        start_time = time.perf_counter()
+        parallel = transformer(x, t, txt, text_mask, txt_2, freqs_cos, freqs_sin, sa_drop_rate=args.sa_drop_rate)["x"]
+        dist.barrier()
+        step_times.append(time.perf_counter() - start_time)
+
+    max_diff = (parallel - reference).abs().max()
+    torch.testing.assert_close(parallel, reference, atol=args.atol, rtol=args.rtol)
+    blocks = list(transformer.double_blocks) + list(transformer.single_blocks)
+    balancers = [block.hybrid_seq_parallel_attn.balancer for block in blocks]
+    check_head_assignment(balancers, args.heads)
+
+    if rank == 0:
+        logger.info(
+            f"parallelize_transformer_prores matches single process on {world_size} ranks (ring degree "
+            f"{args.ring_degree}), max abs diff {max_diff.item():.3e} ({img_len} image + {args.text_len} text "
+            f"tokens, {len(blocks)} blocks, {args.attention_backend} backend); step time "
+            f"{min(step_times) * 1000:.1f} ms (min of {args.steps})"
+        )
+        log_head_balance(balancers)
+
+
+@torch.no_grad()
+def run(rank, args):
+    from .attenion import get_cu_seqlens
+    from .attention_backends import (
+        get_attention_backend,
+        get_block_sparse_attention_lse,
+        set_default_attention_backend,
+    )
+    from .posemb_layers import get_nd_rotary_pos_embed
+    from .head_balance import log_head_balance
+    from .seq_parallel_comm import UlyssesAttention, get_ulysses_comm
+    from .sparse_ring_attention import get_ring_comm
+
+    set_default_attention_backend(args.attention_backend)
+    world_size = dist.get_world_size()
+    dtype = getattr(torch, args.dtype)
+    head_dim = sum(args.rope_dim_list)
+    hidden_size = args.heads * head_dim
+    rope_sizes = (world_size * args.frames_per_rank, args.latent_size, args.latent_size)
+    img_len = rope_sizes[0] * rope_sizes[1] * rope_sizes[2]
+    num_img_blocks = check_inputs(args, world_size, img_len)
+
+    # Same seed on every rank: identical weights and inputs.
+    torch.manual_seed(args.seed)
+    double_blocks, single_blocks = build_blocks(args, hidden_size, dtype)
+
+    # Per-block offsets, so the pooled block scores and hence the selected blocks differ.
+    img = torch.randn(1, img_len, hidden_size, dtype=dtype)
+    img += torch.randn(1, num_img_blocks, 1, hidden_size, dtype=dtype).repeat_interleave(TOKENS_PER_BLOCK, dim=2).flatten(1, 2)
+    txt = torch.randn(1, args.text_len, hidden_size, dtype=dtype)
+    text_mask = torch.zeros(1, args.text_len, dtype=torch.int64)
+    text_mask[:, : args.text_valid] = 1
+    vec = torch.randn(1, hidden_size, dtype=dtype)
+    freqs_cos, freqs_sin = get_nd_rotary_pos_embed(args.rope_dim_list, rope_sizes, theta=256, use_real=True)
+    freqs_cos, freqs_sin = freqs_cos.to(dtype), freqs_sin.to(dtype)
+    block_idx = torch.arange(num_img_blocks)
+    block_neighbor_list = (block_idx[:, None] - block_idx[None, :]).abs() <= 1
+    curve_sel = [(None, None, block_neighbor_list)]
+
+    # Single-process reference.
+    reference = blocks_forward(
+        double_blocks, single_blocks, img, txt, vec, (freqs_cos, freqs_sin),
+        get_cu_seqlens(text_mask, img_len), img_len + args.text_len, curve_sel, args,
+    )
+
+    # Sequence-parallel forward, image tokens split like in jenga_hyvideo_multigpu.py.
+    ulysses_group, ring_group = None, None
+    if args.ring_degree > 1:
+        ulysses_group, ring_group = new_sequence_parallel_groups(world_size, args.ring_degree)
+    for block in double_blocks + single_blocks:
+        block.hybrid_seq_parallel_attn = UlyssesAttention(
+            get_attention_backend(),
+            group=ulysses_group,
+            ring_group=ring_group,
+            ring_attn_fn=get_block_sparse_attention_lse() if ring_group is not None else None,
+            head_balance_interval=args.head_balance_interval,
+        )
+    comms = [get_ulysses_comm(ulysses_group)]
+    if ring_group is not None:
+        comms.append(get_ring_comm(ring_group))
+    s_local = img_len // world_size
+    img_local = torch.chunk(img, world_size, dim=1)[rank]
+    freqs_local = (torch.chunk(freqs_cos, world_size, dim=0)[rank], torch.chunk(freqs_sin, world_size, dim=0)[rank])
+    cu_seqlens = get_cu_seqlens(text_mask, s_local)
+
+    step_times = []
+    bytes_start = sum(comm.bytes_sent for comm in comms)
+    for _ in range(args.steps):
+        dist.barrier()
+        start_time = time.perf_counter()
+        output = blocks_forward(
+            double_blocks, single_blocks, img_local, txt, vec, freqs_local,
+            cu_seqlens, s_local + args.text_len, curve_sel, args,
+        )
+        dist.barrier()
+        step_times.append(time.perf_counter() - start_time)
+    bytes_sent = sum(comm.bytes_sent for comm in comms) - bytes_start
+    bytes_per_step = torch.tensor([bytes_sent / args.steps], dtype=torch.float64)
+    dist.all_reduce(bytes_per_step)
+
+    img_shards = [torch.empty_like(output[:, :s_local]) for _ in range(world_size)]
+    dist.all_gather(img_shards, output[:, :s_local].contiguous())
+    parallel = torch.cat([torch.cat(img_shards, dim=1), output[:, s_local:]], dim=1)
+    max_diff = (parallel - reference).abs().max()
+    torch.testing.assert_close(parallel, reference, atol=args.atol, rtol=args.rtol)
+    balancers = [block.hybrid_seq_parallel_attn.balancer for block in double_blocks + single_blocks]
+    check_head_assignment(balancers, args.heads)
+
+    if rank == 0:
+        num_blocks = len(double_blocks) + len(single_blocks)
+        total_mib = bytes_per_step.item() / 2**20
+        logger.info(
+            f"Sequence parallel matches single process on {world_size} ranks (ring degree {args.ring_degree}), max abs diff {max_diff.item():.3e} "
+            f"({img_len} image + {args.text_len} text tokens, {num_blocks} blocks, {args.attention_backend} backend)"
+        )
+        logger.info(
+            f"Communication per step: {total_mib:.3f} MiB over all ranks, {total_mib / world_size:.3f} MiB per rank, "
+            f"{total_mib / num_blocks:.3f} MiB per block; step time {min(step_times) * 1000:.1f} ms (min of {args.steps})"
+        )
+        log_head_balance(balancers)
+
+
+def _worker(rank, args):
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", str(args.port))
+    dist.init_process_group("gloo", rank=rank, world_size=args.world_size)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.world_size))
+    try:
+        _init_xfuser(rank, args.world_size, args.ring_degree)
+        if args.entry == "transformer":
+            run_transformer(rank, args)
+        else:
+            run(rank, args)
+    finally:
+        dist.destroy_process_group()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CPU check of the Ulysses sequence-parallel DiT forward.")
+    parser.add_argument("--world-size", type=int, default=2)
+    parser.add_argument("--entry", type=str, default="blocks", choices=["blocks", "transformer"],
+                        help="blocks: the DiT blocks with UlyssesAttention. transformer: a tiny model through "
+                             "parallelize_transformer_prores and xFuserLongContextAttention, needs xfuser.")
+    parser.add_argument("--port", type=int, default=29513)
+    parser.add_argument("--steps", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dtype", type=str, default="float64", choices=["float64", "float32", "bfloat16"])
+    parser.add_argument("--atol", type=float, default=1e-6)
+    parser.add_argument("--rtol", type=float, default=1e-6)
+    parser.add_argument("--attention-backend", type=str, default="reference")
+    parser.add_argument("--heads", type=int, default=4, help="Must be divisible by the Ulysses degree.")
+    parser.add_argument("--ring-degree", type=int, default=1, help="Ranks per ring group, must divide the world size.")
+    parser.add_argument("--rope-dim-list", type=int, nargs=3, default=[4, 6, 6], help="Sums to the head dim.")
+    parser.add_argument("--double-blocks", type=int, default=2)
+    parser.add_argument("--single-blocks", type=int, default=2)
+    parser.add_argument("--frames-per-rank", type=int, default=2, help="Latent frames of image tokens per rank.")
+    parser.add_argument("--latent-size", type=int, default=16, help="Latent height and width in tokens.")
+    parser.add_argument("--text-len", type=int, default=256)
+    parser.add_argument("--text-valid", type=int, default=77)
+    parser.add_argument("--text-states-dim", type=int, default=32, help="Text encoder width, --entry transformer.")
+    parser.add_argument("--text-states-dim-2", type=int, default=16, help="Pooled text width, --entry transformer.")
+    parser.add_argument("--latent-channels", type=int, default=4, help="VAE latent channels, --entry transformer.")
+    parser.add_argument("--sa-drop-rate", type=float, default=0.5)
+    parser.add_argument("--p-remain-rate", type=float, default=0.3)
+    parser.add_argument("--text-amp", type=float, default=1.0)
+    parser.add_argument("--head-balance-interval", type=int, default=0, help="Re-plan head ownership every N steps.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.world_size % args.ring_degree:
+        raise ValueError(f"--ring-degree {args.ring_degree} does not divide --world-size {args.world_size}")
+    if args.heads % (args.world_size // args.ring_degree):
+        raise ValueError(f"--heads {args.heads} is not divisible by the Ulysses degree")
+    if args.entry == "transformer" and importlib.util.find_spec("xfuser") is None:
+        raise SystemExit("--entry transformer runs parallelize_transformer_prores, which needs xfuser.")
+    mp.spawn(_worker, args=(args,), nprocs=args.world_size, join=True)
+
+
+if __name__ == "__main__":
+    main()
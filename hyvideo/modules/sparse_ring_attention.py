@@ -0,0 +1,186 @@
+"""
+Sparse ring attention for `--ring-degree > 1`.
+
+Every ring rank holds one contiguous segment of the image tokens (after the Ulysses all-to-all within its
+ring slot) plus the replicated text tokens. Instead of dense attention per hop:
+
+1. The block mask of the local query blocks is computed once, from pooled queries and the pooled keys of
+   all segments, whose all-gather is cheap (one vector per 128 tokens).
+2. K/V segments travel around the ring. Each hop runs the block-sparse kernel on the selected blocks of the
+   segment it holds, and skips the compute when no query block selected any of them.
+3. Partial outputs are merged with their log-sum-exp. Text query rows attend to every key; each rank computes
+   them against its own segment and the partials are merged across the ring.
+
+Ring peers exchange K/V and merge text partials per local head, so they must own the same heads after the
+Ulysses all-to-all. With head balancing, the HeadBalancer sums its counts over the ring and every Ulysses
+group of the ring adopts the same head permutation.
+
+Only torch.distributed point-to-point ops and all-gathers are used, so gloo works as well as NCCL.
+"""
+
+import torch
+import torch.distributed as dist
+
+from .attention_block_reference import _build_block_index_from_pools
+
+_COMMS = {}
+
+
+def merge_attention_partials(out, lse, block_out, block_lse):
+    """Merge two attention partials over disjoint keys: out (b, h, s, d) in float32, lse (b, h, s) natural log."""
+    new_lse = torch.logaddexp(lse, block_lse)
+    # Rows without keys in either partial keep a zero output and -inf.
+    old_scale = torch.exp(lse - new_lse).nan_to_num(0.0)
+    block_scale = torch.exp(block_lse - new_lse).nan_to_num(0.0)
+    out = out * old_scale.unsqueeze(-1) + block_out.float() * block_scale.unsqueeze(-1)
+    return out, new_lse
+
+
+class SparseRingComm:
+    """
+    Ring exchange and all-gathers of the sparse ring over `group`.
+
+    `bytes_sent` counts the bytes this rank sent, for communication volume reports.
+    """
+
+    def __init__(self, group):
+        self.group = group
+        self.world_size = dist.get_world_size(group)
+        self.rank = dist.get_rank(group)
+        self.send_rank = dist.get_global_rank(group, (self.rank + 1) % self.world_size)
+        self.recv_rank = dist.get_global_rank(group, (self.rank - 1) % self.world_size)
+        self.bytes_sent = 0
+        self._reqs = []
+
+    def start_exchange(self, send, recv):
+        """Send `send` to the next rank and receive the previous rank's into `recv`, asynchronously."""
+        self._reqs = [
+            dist.isend(send, self.send_rank, group=self.group),
+            dist.irecv(recv, self.recv_rank, group=self.group),
+        ]
+        self.bytes_sent += send.numel() * send.element_size()
+
+    def wait(self):
+        for req in self._reqs:
+            req.wait()
+        self._reqs = []
+
+    def all_gather(self, tensor):
+        tensor = tensor.contiguous()
+        gathered = [torch.empty_like(tensor) for _ in range(self.world_size)]
+        dist.all_gather(gathered, tensor, group=self.group)
+        self.bytes_sent += tensor.numel() * tensor.element_size() * (self.world_size - 1)
+        return gathered
+
+
+def get_ring_comm(group):
+    """The shared SparseRingComm of `group`."""
+    comm = _COMMS.get(group)
+    if comm is None:
+        comm = _COMMS[group] = SparseRingComm(group)
+    return comm
+
+
+def sparse_ring_attention(
+    comm,
+    masked_attn_fn,
+    query,
+    key,
+    value,
+    txt_len,
+    top_k,
+    text_amp=0.0,
+    block_neighbor_list=None,
+    p_remain_rates=0.5,
+    text_blocks=2,
+    block_size=128,
+    block_stats=None,
+):
+    """
+    Block-sparse attention over the image segments of all ring ranks plus the replicated text.
+
+    Args:
+        comm (SparseRingComm): Communicator of the ring group, ring rank r holds image segment r.
+        masked_attn_fn (callable): `block_sparse_attention_lse` of the attention backend.
+        query, key, value (Tensor): (b, S + T, h, d) local image segment followed by the T text tokens.
+        txt_len (int): Valid text tokens, later text keys are masked for image queries.
+        top_k, text_amp, block_neighbor_list, p_remain_rates, text_blocks: As in block_sparse_attention,
+            top_k and block_neighbor_list refer to the blocks of the whole sequence.
+        block_stats (dict): If given, block_stats["head_blocks"] gets the selected blocks per head, (h,).
+
+    Returns:
+        Tensor: (b, S + T, h, d) attention output.
+    """
+    ring_size, ring_rank = comm.world_size, comm.rank
+    query, key, value = (x.transpose(1, 2) for x in (query, key, value))
+    batch_size, num_heads, context_size, head_dim = query.shape
+    txt_tokens = text_blocks * block_size
+    img_tokens = context_size - txt_tokens
+    local_blocks = img_tokens // block_size
+    img_blocks = ring_size * local_blocks
+    sm_scale = head_dim ** -0.5
+
+    q_img = query[:, :, :img_tokens].contiguous()
+    q_txt = query[:, :, img_tokens:].contiguous()
+    current = torch.stack((key[:, :, :img_tokens], value[:, :, :img_tokens]))
+    incoming = torch.empty_like(current)
+
+    # 1. Block mask of the local query blocks over the whole sequence, from pooled queries and keys.
+    query_pool = q_img.view(batch_size, num_heads, local_blocks, block_size, head_dim).mean(dim=-2)
+    key_pool = current[0].view(batch_size, num_heads, local_blocks, block_size, head_dim).mean(dim=-2)
+    txt_key_pool = key[:, :, img_tokens:].reshape(batch_size, num_heads, text_blocks, block_size, head_dim).mean(dim=-2)
+    block_mask = _build_block_index_from_pools(
+        query_pool, torch.cat(comm.all_gather(key_pool) + [txt_key_pool], dim=2), top_k,
+        text_start_block=img_blocks, num_blocks=img_blocks + text_blocks,
+        prob_threshold=p_remain_rates,
+        text_blocks=text_blocks,
+        block_neighbor_list=block_neighbor_list,
+        query_block_offset=ring_rank * local_blocks,
+    )
+    if block_stats is not None:
+        block_stats["head_blocks"] = block_mask.sum(dim=(0, 2, 3))
+    segment_masks = block_mask[..., :img_blocks].split(local_blocks, dim=-1)
+    # One host sync for the whole ring instead of one per hop.
+    segment_needed = torch.stack([mask.any() for mask in segment_masks]).tolist()
+
+    # 2. Image rows: the local segment, with the text keys which are always selected, while the first
+    # segment is in flight, then one hop per remote segment.
+    if ring_size > 1:
+        comm.start_exchange(current, incoming)
+    local_mask = torch.cat([segment_masks[ring_rank], block_mask[..., img_blocks:]], dim=-1)
+    out, lse = masked_attn_fn(
+        q_img, key, value, local_mask, img_tokens + txt_len, sm_scale, block_size, block_size,
+        text_amp=text_amp, text_block_start=local_blocks,
+    )
+    out = out.float()
+
+    # Text rows see every key: the local segment here, plus the text keys on ring rank 0.
+    txt_tokens_kv = context_size if ring_rank == 0 else img_tokens
+    txt_out, txt_lse = masked_attn_fn(
+        q_txt, key[:, :, :txt_tokens_kv], value[:, :, :txt_tokens_kv],
+        torch.ones((batch_size, num_heads, text_blocks, txt_tokens_kv // block_size), dtype=torch.bool, device=query.device),
+        txt_tokens_kv, sm_scale, block_size, block_size,
+    )
+
+    for step in range(1, ring_size):
+        comm.wait()
+        # The buffer just sent is free to receive the next segment.
+        current, incoming = incoming, current
+        if step + 1 < ring_size:
+            comm.start_exchange(current, incoming)
+        source = (ring_rank - step) % ring_size
+        if not segment_needed[source]:
+            continue
+        block_out, block_lse = masked_attn_fn(
+            q_img, current[0], current[1], segment_masks[source], img_tokens, sm_scale, block_size, block_size,
+        )
+        out, lse = merge_attention_partials(out, lse, block_out, block_lse)
+
+    # 3. Merge the text partials of all ring ranks.
+    txt_outs, txt_lses = comm.all_gather(txt_out), comm.all_gather(txt_lse)
+    merged_txt, merged_lse = txt_outs[0].float(), txt_lses[0]
+    for block_out, block_lse in zip(txt_outs[1:], txt_lses[1:]):
+        merged_txt, merged_lse = merge_attention_partials(merged_txt, merged_lse, block_out, block_lse)
+
+    output = torch.cat([out, merged_txt], dim=2).to(query.dtype)
+    return output.transpose(1, 2)
@@ -13,7 +13,10 @@ from yunchang.comm.all_to_all import SeqAllToAll4D
 
 # functions for xfuser ring attention
 from xfuser.logger import init_logger
-from hyvideo.modules.attention_block_triton_diffres import block_sparse_attention
+from hyvideo.modules.attention_backends import get_attention_backend, get_block_sparse_attention_lse
+from hyvideo.modules.head_balance import HeadBalancer
+from hyvideo.modules.seq_parallel_comm import get_ulysses_comm, packed_ulysses_attention
+from hyvideo.modules.sparse_ring_attention import get_ring_comm
 
 
 logger = init_logger(__name__)
@@ -29,14 +32,16 @@ class xFuserLongContextAttention(LongContextAttention):
         ring_impl_type: str = "basic",
         use_pack_qkv: bool = False,
         use_kv_cache: bool = False,
+        head_balance_interval: int = 0,
     ) -> None:
         """
         Arguments:
             scatter_idx: int = 2, the scatter dimension index for Ulysses All2All
             gather_idx: int = 1, the gather dimension index for Ulysses All2All
             ring_impl_type: str = "basic", the ring implementation type, currently only support "basic"
-            use_pack_qkv: bool = False, whether to use pack qkv in the input
+            use_pack_qkv: bool = False, whether to send q/k/v in one packed all-to-all, without autograd
             use_kv_cache: bool = False, whether to use kv cache in the attention layer, which is applied in PipeFusion.
+            head_balance_interval: int = 0, re-plan the head-to-rank assignment from the block-sparse work every this many calls, packed qkv only, 0 disables it.
         """
         super().__init__(
             scatter_idx=scatter_idx,
@@ -55,7 +60,21 @@ class xFuserLongContextAttention(LongContextAttention):
         # from xfuser.core.long_ctx_attention.ring import xdit_ring_flash_attn_func
         # JULIAN: actually, we don't need to use this function, we only require a multi-gpu attention, not multi-machine.
         self.ring_attn_fn = xdit_ring_flash_attn_func
-        self.attn_fn = block_sparse_attention
+        self.attn_fn = get_attention_backend()
+        self.comm = get_ulysses_comm(self.ulysses_pg)
+        # JENGA: with ring degree > 1, the ring runs block-sparse per hop and skips segments without selected blocks.
+        self.ring_comm = None
+        self.ring_lse_fn = None
+        if self.ring_pg is not None and torch.distributed.get_world_size(self.ring_pg) > 1:
+            if not use_pack_qkv:
+                raise ValueError("Ring degree > 1 needs the packed q/k/v all-to-all, drop --unpacked-qkv-all-to-all.")
+            self.ring_comm = get_ring_comm(self.ring_pg)
+            self.ring_lse_fn = get_block_sparse_attention_lse()
+        self.balancer = (
+            HeadBalancer(self.comm, head_balance_interval, ring_group=self.ring_pg)
+            if use_pack_qkv and head_balance_interval > 0
+            else None
+        )
 
     @torch.compiler.disable
     def forward(
@@ -100,35 +119,40 @@ class xFuserLongContextAttention(LongContextAttention):
         Returns:
             * output (Tensor): context output
         """
+        if self.use_pack_qkv and not torch.is_grad_enabled():
+            return self.packed_forward(
+                query,
+                key,
+                value,
+                joint_tensor_query,
+                joint_tensor_key,
+                joint_tensor_value,
+                joint_strategy=joint_strategy,
+                top_k=top_k,
+                text_amp=text_amp,
+                block_neighbor_list=block_neighbor_list,
+                p_remain_rates=p_remain_rates,
+                cu_seqlens_q=cu_seqlens_q,
+            )
+
         is_joint = False
         q_len = query.shape[1]
         txt_len = cu_seqlens_q[1] - query.shape[1]
         # 3 X (bs, seq_len/N, head_cnt, head_size) -> 3 X (bs, seq_len, head_cnt/N, head_size)
         # scatter 2, gather 1
-        if self.use_pack_qkv:
-            # (3*bs, seq_len/N, head_cnt, head_size)
-            qkv = torch.cat([query, key, value]).continous()
-            # (3*bs, seq_len, head_cnt/N, head_size)
-            qkv = SeqAllToAll4D.apply(
-                self.ulysses_pg, qkv, self.scatter_idx, self.gather_idx
-            )
-            qkv = torch.chunk(qkv, 3, dim=0)
-            query_layer, key_layer, value_layer = qkv
-
-        else:
-            txt_block_len = joint_tensor_query.shape[1]
-            query_layer = SeqAllToAll4D.apply(
-                self.ulysses_pg, query, self.scatter_idx, self.gather_idx
-            )
-            key_layer = SeqAllToAll4D.apply(
-                self.ulysses_pg, key, self.scatter_idx, self.gather_idx
-            )
-            value_layer = SeqAllToAll4D.apply(
-                self.ulysses_pg, value, self.scatter_idx, self.gather_idx
-            )
-            joint_tensor_layer = SeqAllToAll4D.apply(
-                self.ulysses_pg, joint_tensor_query, self.scatter_idx, self.gather_idx
-            )[:, :txt_block_len]
+        txt_block_len = joint_tensor_query.shape[1]
+        query_layer = SeqAllToAll4D.apply(
+            self.ulysses_pg, query, self.scatter_idx, self.gather_idx
+        )
+        key_layer = SeqAllToAll4D.apply(
+            self.ulysses_pg, key, self.scatter_idx, self.gather_idx
+        )
+        value_layer = SeqAllToAll4D.apply(
+            self.ulysses_pg, value, self.scatter_idx, self.gather_idx
+        )
+        joint_tensor_layer = SeqAllToAll4D.apply(
+            self.ulysses_pg, joint_tensor_query, self.scatter_idx, self.gather_idx
+        )[:, :txt_block_len]
 
         if (joint_tensor_query is not None and 
             joint_tensor_key is not None and 
@@ -221,6 +245,48 @@ class xFuserLongContextAttention(LongContextAttention):
         # out e.g., [s/p::h]
         return output
 
+    def packed_forward(
+        self,
+        query,
+        key,
+        value,
+        joint_tensor_query,
+        joint_tensor_key,
+        joint_tensor_value,
+        *,
+        joint_strategy="rear",
+        top_k=0,
+        text_amp=0.0,
+        block_neighbor_list=None,
+        p_remain_rates=0.0,
+        cu_seqlens_q=None,
+    ) -> Tensor:
+        """
+        Same result as `forward` with one all-to-all for the image q/k/v and one for the image and text
+        outputs. The replicated text q/k/v are sliced by head locally and all buffers are reused, see
+        hyvideo/modules/seq_parallel_comm.py.
+        """
+        if joint_strategy != "rear" or joint_tensor_query is None:
+            raise ValueError(f"Packed qkv only supports joint_strategy 'rear', got {joint_strategy}.")
+        return packed_ulysses_attention(
+            self.comm,
+            self.attn_fn,
+            query,
+            key,
+            value,
+            joint_tensor_query,
+            joint_tensor_key,
+            joint_tensor_value,
+            cu_seqlens_q,
+            balancer=self.balancer,
+            ring_comm=self.ring_comm,
+            ring_attn_fn=self.ring_lse_fn,
+            top_k=top_k,
+            text_amp=text_amp,
+            block_neighbor_list=block_neighbor_list,
+            p_remain_rates=p_remain_rates,
+        )
+
 # functions for ring attention
 
 def xdit_ring_flash_attn_forward(
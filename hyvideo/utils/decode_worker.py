@@ -0,0 +1,224 @@
+"""
+VAE decode and video saving decoupled from the DiT.
+
+The DiT returns raw latents (`output_type="latent"`) and hands them to a decode worker through a bounded
+queue, so the DiT of prompt N+1 overlaps the decode and save of prompt N.
+
+- `DecodeWorker` is a thread in the sampling process that shares its VAE.
+- `LatentSpool` is the multi-process variant: any number of DiT processes spool latents into a directory
+  and a single decode process (`python -m hyvideo.utils.decode_worker`) serves all of them.
+"""
+
+import contextlib
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+import torch
+from loguru import logger
+
+from .file_utils import write_video
+
+
+def iter_decoded_video(vae, latents, vae_dtype, enable_tiling=True, stream_chunk=0):
+    """
+    Decode raw DiT latents like the pipeline's decode branch and yield the video in [0, 1] as
+    (b, c, t, h, w) chunks: one chunk, or one per `stream_chunk` latent frames with streaming decode.
+    """
+    if latents.dim() == 4:
+        latents = latents.unsqueeze(2)
+    latents = latents.to(vae.device)
+    if getattr(vae.config, "shift_factor", None):
+        latents = latents / vae.config.scaling_factor + vae.config.shift_factor
+    else:
+        latents = latents / vae.config.scaling_factor
+
+    with torch.no_grad(), torch.autocast(
+        device_type="cuda", dtype=vae_dtype, enabled=vae_dtype != torch.float32
+    ):
+        if enable_tiling:
+            vae.enable_tiling()
+        if stream_chunk > 0:
+            for chunk in vae.streaming_decode(latents, chunk_size=stream_chunk):
+                yield (chunk / 2 + 0.5).clamp(0, 1)
+        else:
+            video = vae.decode(latents, return_dict=False)[0]
+            yield (video / 2 + 0.5).clamp(0, 1)
+
+
+class DecodeWorker:
+    """
+    Decode and save latents in a background thread, on its own CUDA stream.
+
+    `submit` blocks once `max_pending` latents are waiting, which bounds the memory held by the queue.
+
+    Args:
+        vae (AutoencoderKLCausal3D): The VAE, shared with the pipeline.
+        vae_dtype (torch.dtype): Autocast dtype of the decode.
+        max_pending (int): Size of the latent queue.
+        enable_tiling (bool): Use tiled decode.
+        stream_chunk (int): Streaming decode chunk in latent frames, 0 disables it.
+        fps (int): Video fps.
+        residency (ResidencyManager, optional): Residency manager of the pipeline. The VAE is held on the
+            device for each whole decode, so the pipeline entering its next phase cannot release it.
+    """
+
+    def __init__(self, vae, vae_dtype, max_pending=2, enable_tiling=True, stream_chunk=0, fps=24, residency=None):
+        self.vae = vae
+        self.residency = residency
+        self.vae_dtype = vae_dtype
+        self.enable_tiling = enable_tiling
+        self.stream_chunk = stream_chunk
+        self.fps = fps
+        self.completed = []
+        self.errors = []
+        self._queue = queue.Queue(maxsize=max(1, max_pending))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, latents, path):
+        event = None
+        if latents.is_cuda:
+            event = torch.cuda.Event()
+            event.record(torch.cuda.current_stream(latents.device))
+        self._queue.put((latents, path, event))
+
+    def _run(self):
+        stream = None
+        for latents, path, event in iter(self._queue.get, None):
+            start_time = time.time()
+            try:
+                if latents.is_cuda:
+                    if stream is None:
+                        stream = torch.cuda.Stream(device=latents.device)
+                    stream.wait_event(event)
+                    latents.record_stream(stream)
+                    ctx = torch.cuda.stream(stream)
+                else:
+                    ctx = contextlib.nullcontext()
+                hold = self.residency.hold("vae") if self.residency is not None else contextlib.nullcontext()
+                with ctx, hold:
+                    write_video(
+                        iter_decoded_video(self.vae, latents, self.vae_dtype, self.enable_tiling, self.stream_chunk),
+                        path,
+                        fps=self.fps,
+                    )
+                self.completed.append(path)
+                logger.info(f"Decoded in {time.time() - start_time:.2f}s, saved to: {path}")
+            except Exception as e:
+                self.errors.append((path, e))
+                logger.exception(f"Failed to decode {path}")
+
+    def close(self):
+        """Wait until every submitted latent is decoded and saved."""
+        self._queue.put(None)
+        self._thread.join()
+        if self.errors:
+            raise RuntimeError(f"{len(self.errors)} videos failed to decode, first: {self.errors[0][0]}")
+
+
+class LatentSpool:
+    """
+    Hand latents to an external decode worker through `spool_dir`.
+
+    Latents are written atomically as `<id>.pt`. `submit` waits while `max_pending` files are queued,
+    counted over all DiT workers sharing the directory.
+    """
+
+    def __init__(self, spool_dir, max_pending=2, poll_interval=1.0):
+        self.spool_dir = Path(spool_dir)
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self.max_pending = max(1, max_pending)
+        self.poll_interval = poll_interval
+
+    def submit(self, latents, path):
+        while len(list(self.spool_dir.glob("*.pt"))) >= self.max_pending:
+            time.sleep(self.poll_interval)
+        name = f"{time.time_ns()}_{os.getpid()}"
+        tmp_path = self.spool_dir / f"{name}.tmp"
+        torch.save({"latents": latents.cpu(), "path": str(path)}, tmp_path)
+        os.replace(tmp_path, self.spool_dir / f"{name}.pt")
+
+    def close(self):
+        pass
+
+
+def serve_spool(vae, vae_dtype, spool_dir, enable_tiling=True, stream_chunk=0, fps=24,
+                poll_interval=1.0, idle_timeout=0.0):
+    """
+    Decode spooled latents until `spool_dir/STOP` exists and the spool is empty, or nothing arrived
+    for `idle_timeout` seconds (0 waits forever). Files are claimed by renaming, so several decode
+    workers can share one spool. A job that fails is renamed to `<id>.error` and skipped; a job
+    interrupted by the worker shutting down goes back to the spool.
+    """
+    spool_dir = Path(spool_dir)
+    spool_dir.mkdir(parents=True, exist_ok=True)
+    num_videos, num_failed, serve_start, last_seen = 0, 0, time.time(), time.time()
+    while True:
+        files = sorted(spool_dir.glob("*.pt"))
+        if not files:
+            if (spool_dir / "STOP").exists():
+                break
+            if idle_timeout > 0 and time.time() - last_seen > idle_timeout:
+                break
+            time.sleep(poll_interval)
+            continue
+        for file in files:
+            claimed = file.with_suffix(".decoding")
+            try:
+                os.rename(file, claimed)
+            except OSError:
+                continue  # Claimed by another decode worker.
+            start_time = time.time()
+            try:
+                item = torch.load(claimed, map_location="cpu")
+                write_video(
+                    iter_decoded_video(vae, item["latents"], vae_dtype, enable_tiling, stream_chunk),
+                    item["path"],
+                    fps=fps,
+                )
+            except Exception:
+                failed = claimed.with_suffix(".error")
+                os.replace(claimed, failed)
+                num_failed += 1
+                last_seen = time.time()
+                logger.exception(f"Failed to decode {file.name}, moved to {failed}")
+                continue
+            except BaseException:
+                os.replace(claimed, file)
+                raise
+            claimed.unlink()
+            num_videos += 1
+            last_seen = time.time()
+            logger.info(f"Decoded in {last_seen - start_time:.2f}s, saved to: {item['path']}")
+    elapsed = time.time() - serve_start
+    logger.info(
+        f"Decode worker: {num_videos} videos in {elapsed:.1f}s ({num_videos * 3600 / max(elapsed, 1e-6):.1f} "
+        f"videos/hour), {num_failed} failed"
+    )
+
+
+def main():
+    from ..config import parse_args
+    from ..constants import PRECISION_TO_TYPE
+    from ..vae import load_vae
+
+    args = parse_args()
+    spool_dir = args.latent_spool_dir or os.path.join(args.save_path, "latent_spool")
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    vae, _, _, _ = load_vae(args.vae, args.vae_precision, logger=logger, device=device)
+    vae.enable_tile_batching(args.vae_tile_batch_size)
+    serve_spool(
+        vae,
+        PRECISION_TO_TYPE[args.vae_precision],
+        spool_dir,
+        enable_tiling=args.vae_tiling,
+        stream_chunk=args.vae_stream_chunk,
+        idle_timeout=args.decode_idle_timeout,
+    )
+
+
+if __name__ == "__main__":
+    main()
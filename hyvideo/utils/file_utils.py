@@ -1,4 +1,6 @@
 import os
+import queue
+import threading
 from pathlib import Path
 from einops import rearrange
 
@@ -44,6 +46,145 @@ def safe_file(path):
     path.parent.mkdir(exist_ok=True, parents=True)
     return path
 
+def video_to_uint8(videos: torch.Tensor, rescale=False, n_rows=1):
+    """Convert a (b, c, t, h, w) video in [0, 1] to (t, h, w, c) uint8 grid frames on its own device."""
+    if rescale:
+        videos = (videos + 1.0) / 2.0  # -1,1 -> 0,1
+    videos = (torch.clamp(videos, 0, 1) * 255).to(torch.uint8)
+    videos = rearrange(videos, "b c t h w -> t b c h w")
+    if videos.shape[1] == 1:
+        frames = videos[:, 0]
+    else:
+        frames = torch.stack([torchvision.utils.make_grid(x, nrow=n_rows) for x in videos])
+    return frames.permute(0, 2, 3, 1).contiguous()
+
+
+class VideoWriter:
+    """
+    Encode a video with imageio/ffmpeg in a background thread.
+
+    `write` only enqueues uint8 frames. The writer thread copies them to the host in chunks of
+    `chunk_frames` frames through two pinned buffers on a side stream, so the copy of the next chunk
+    overlaps the encoding of the current one, and the caller can go on with the next prompt.
+
+    Args:
+        path (str): Path of the video file.
+        fps (int): Video fps.
+        chunk_frames (int): Frames per host transfer.
+        codec (str): ffmpeg codec.
+    """
+
+    def __init__(self, path, fps=24, chunk_frames=16, codec="libx264"):
+        self.path = path
+        self.fps = fps
+        self.chunk_frames = chunk_frames
+        self.codec = codec
+        self.error = None
+        self._queue = queue.Queue()
+        self._buffers = None
+        self._copy_stream = None
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, frames: torch.Tensor):
+        """Enqueue (t, h, w, c) uint8 frames, on any device."""
+        for start in range(0, frames.shape[0], self.chunk_frames):
+            chunk = frames[start: start + self.chunk_frames]
+            event = None
+            if chunk.is_cuda:
+                # The chunk is produced on the caller's stream, the copy waits for it.
+                event = torch.cuda.Event()
+                event.record(torch.cuda.current_stream(chunk.device))
+            self._queue.put((chunk, event))
+
+    def _stage(self, chunk, event, slot):
+        if not chunk.is_cuda:
+            return chunk.numpy(), None
+        if self._buffers is None:
+            self._copy_stream = torch.cuda.Stream(device=chunk.device)
+            shape = (self.chunk_frames,) + tuple(chunk.shape[1:])
+            self._buffers = [torch.empty(shape, dtype=torch.uint8, pin_memory=True) for _ in range(2)]
+        buf = self._buffers[slot][: chunk.shape[0]]
+        with torch.cuda.stream(self._copy_stream):
+            self._copy_stream.wait_event(event)
+            buf.copy_(chunk, non_blocking=True)
+            chunk.record_stream(self._copy_stream)
+            done = torch.cuda.Event()
+            done.record(self._copy_stream)
+        return buf, done
+
+    def _run(self):
+        writer = None
+        staged = None
+        slot = 0
+        for chunk, event in iter(self._queue.get, None):
+            if self.error is not None:
+                continue
+            try:
+                if writer is None:
+                    writer = imageio.get_writer(self.path, fps=self.fps, codec=self.codec)
+                # Start the copy of this chunk before encoding the previous one.
+                current = self._stage(chunk, event, slot)
+                slot = 1 - slot
+                if staged is not None:
+                    self._append(writer, *staged)
+                staged = current
+            except Exception as e:
+                self.error = e
+        try:
+            if staged is not None and self.error is None:
+                self._append(writer, *staged)
+        except Exception as e:
+            self.error = e
+        finally:
+            if writer is not None:
+                writer.close()
+
+    @staticmethod
+    def _append(writer, frames, done):
+        if done is not None:
+            done.synchronize()
+            frames = frames.numpy()
+        for frame in frames:
+            writer.append_data(frame)
+
+    def close(self):
+        """Wait until every enqueued frame is encoded."""
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_video(videos, path: str, rescale=False, n_rows=1, fps=24, background=False):
+    """
+    Save a (b, c, t, h, w) video, or an iterable of such temporal chunks (e.g. a chunked VAE decode).
+
+    Frames are converted to uint8 on their device and encoded by a VideoWriter. With `background=True`
+    the writer is returned right away and must be closed by the caller.
+    """
+    if isinstance(videos, torch.Tensor):
+        videos = [videos]
+    writer = VideoWriter(path, fps=fps)
+    try:
+        for chunk in videos:
+            writer.write(video_to_uint8(chunk, rescale=rescale, n_rows=n_rows))
+    except BaseException:
+        writer.close()
+        raise
+    if background:
+        return writer
+    writer.close()
+    return None
+
+
 def save_videos_grid(videos: torch.Tensor, path: str, rescale=False, n_rows=1, fps=24):
     """save videos by video tensor
        copy from https://github.com/guoyww/AnimateDiff/blob/e92bd5671ba62c0d774a32951453e328018b7c5b/animatediff/utils/util.py#L61
@@ -55,16 +196,4 @@ def save_videos_grid(videos: torch.Tensor, path: str, rescale=False, n_rows=1, f
         n_rows (int, optional): Defaults to 1.
         fps (int, optional): video save fps. Defaults to 8.
     """
-    videos = rearrange(videos, "b c t h w -> t b c h w")
-    outputs = []
-    for x in videos:
-        x = torchvision.utils.make_grid(x, nrow=n_rows)
-        x = x.transpose(0, 1).transpose(1, 2).squeeze(-1)
-        if rescale:
-            x = (x + 1.0) / 2.0  # -1,1 -> 0,1
-        x = torch.clamp(x, 0, 1)
-        x = (x * 255).numpy().astype(np.uint8)
-        outputs.append(x)
-
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    imageio.mimsave(path, outputs, fps=fps, codec='libx264')
+    write_video(videos, path, rescale=rescale, n_rows=n_rows, fps=fps)
@@ -0,0 +1,164 @@
+"""
+Work-stealing prompt queue for running a prompt file on several workers.
+
+Instead of the static `prompts[cur_id::chunk_num]` shards, every worker claims the next free prompt from an
+SQLite database in the save directory. Claims are leases, renewed in the background while the prompt runs,
+so the prompts of a crashed worker are claimed again once their lease expires. Finished prompts record their
+outputs and are skipped by later runs, unless an output file has gone missing.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+
+class PromptQueue:
+    """
+    Args:
+        db_path (str): SQLite database, shared by all workers of a run.
+        items (list[dict]): JSON-serializable work items in order, e.g. `{"prompt": ...}`.
+        lease_seconds (float): Lease of a claim. Renewed every third of it while the item runs.
+        max_attempts (int): Items claimed this many times without finishing are marked failed.
+    """
+
+    def __init__(self, db_path, items, lease_seconds=600.0, max_attempts=3):
+        self.db_path = str(db_path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.current = None
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS items ("
+                "key TEXT PRIMARY KEY, idx INTEGER, payload TEXT, status TEXT DEFAULT 'pending', "
+                "worker TEXT, lease_until REAL DEFAULT 0, attempts INTEGER DEFAULT 0, outputs TEXT, "
+                "finished_at REAL)"
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO items (key, idx, payload) VALUES (?, ?, ?)",
+                [(self._key(idx, item), idx, json.dumps(item)) for idx, item in enumerate(items)],
+            )
+            # Requeue finished items whose outputs were deleted since.
+            for key, outputs in conn.execute("SELECT key, outputs FROM items WHERE status = 'done'").fetchall():
+                if not all(os.path.exists(path) for path in json.loads(outputs or "[]")):
+                    conn.execute("UPDATE items SET status = 'pending', attempts = 0 WHERE key = ?", (key,))
+
+    @staticmethod
+    def _key(idx, item):
+        digest = hashlib.sha1(json.dumps(item, sort_keys=True).encode()).hexdigest()[:16]
+        return f"{idx:06d}-{digest}"
+
+    def _connect(self):
+        # One connection per call, the heartbeat thread renews leases concurrently.
+        return sqlite3.connect(self.db_path, timeout=60.0)
+
+    def claim(self):
+        """Claim the next pending or expired item, return its payload or None when nothing is left."""
+        conn = self._connect()
+        try:
+            conn.isolation_level = None
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            conn.execute(
+                "UPDATE items SET status = 'failed' WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            row = conn.execute(
+                "SELECT key, payload FROM items WHERE status = 'pending' "
+                "OR (status = 'running' AND lease_until < ?) ORDER BY idx LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE items SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                    "WHERE key = ?",
+                    (self.worker, now + self.lease_seconds, row[0]),
+                )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        if row is None:
+            self.current = None
+            return None
+        self.current = row[0]
+        return json.loads(row[1])
+
+    def renew(self):
+        key = self.current
+        if key is None:
+            return
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE items SET lease_until = ? WHERE key = ? AND worker = ? AND status = 'running'",
+                (time.time() + self.lease_seconds, key, self.worker),
+            )
+
+    def complete(self, outputs=()):
+        """Mark the current item done and record its output paths."""
+        key, self.current = self.current, None
+        if key is None:
+            return
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE items SET status = 'done', outputs = ?, finished_at = ? WHERE key = ?",
+                (json.dumps(list(outputs)), time.time(), key),
+            )
+
+    def release(self):
+        """Give the current item back, e.g. after an error."""
+        key, self.current = self.current, None
+        if key is None:
+            return
+        with closing(self._connect()) as conn, conn:
+            conn.execute("UPDATE items SET status = 'pending', lease_until = 0 WHERE key = ?", (key,))
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            self.renew()
+
+    def claims(self, broadcast=False):
+        """
+        Yield claimed items until the queue is empty. The caller calls `complete` after each item; an item
+        left incomplete when the loop exits with an error is released.
+
+        With `broadcast=True` and torch.distributed initialized, rank 0 claims and broadcasts every item
+        so all ranks of a sequence-parallel group run the same prompt.
+        """
+        dist = None
+        if broadcast:
+            import torch.distributed as dist
+
+            if not dist.is_initialized():
+                dist = None
+        is_claimer = dist is None or dist.get_rank() == 0
+        if is_claimer:
+            self._stop.clear()
+            self._heartbeat = threading.Thread(target=self._renew_loop, daemon=True)
+            self._heartbeat.start()
+        try:
+            while True:
+                item = self.claim() if is_claimer else None
+                if dist is not None:
+                    obj = [item]
+                    dist.broadcast_object_list(obj, src=0)
+                    item = obj[0]
+                if item is None:
+                    break
+                yield item
+        finally:
+            if is_claimer:
+                self.release()
+                self._stop.set()
+                self._heartbeat.join()
+
+    def summary(self):
+        with closing(self._connect()) as conn, conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM items GROUP BY status").fetchall())
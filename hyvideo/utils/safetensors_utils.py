@@ -0,0 +1,144 @@
+import argparse
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+from loguru import logger
+
+
+def find_safetensors(model_path):
+    """
+    Find the safetensors counterpart of a checkpoint.
+
+    Args:
+        model_path (str or Path): Path to a `.pt` or `.safetensors` checkpoint.
+
+    Returns:
+        path (Path or None): The `.safetensors` file if it exists, otherwise None.
+    """
+    model_path = Path(model_path)
+    if model_path.suffix == ".safetensors":
+        return model_path if model_path.exists() else None
+    candidate = model_path.with_suffix(".safetensors")
+    return candidate if candidate.exists() else None
+
+
+def convert_pt_to_safetensors(pt_path, out_path=None, load_key="module"):
+    """
+    One-time conversion of a torch checkpoint into a flat safetensors file.
+
+    Args:
+        pt_path (str or Path): Path to the `.pt` checkpoint.
+        out_path (str or Path): Output path. Default is `pt_path` with a `.safetensors` suffix.
+        load_key (str): Key of the model states in deepspeed-style checkpoints, e.g. 'module' or 'ema'.
+
+    Returns:
+        out_path (Path): Path to the written file.
+    """
+    from safetensors.torch import save_file
+
+    pt_path = Path(pt_path)
+    out_path = Path(out_path) if out_path is not None else pt_path.with_suffix(".safetensors")
+    state_dict = torch.load(pt_path, map_location="cpu", mmap=True)
+    if load_key in state_dict:
+        state_dict = state_dict[load_key]
+    elif "ema" in state_dict or "module" in state_dict:
+        raise KeyError(
+            f"Missing key: `{load_key}` in the checkpoint: {pt_path}. The keys in the checkpoint "
+            f"are: {list(state_dict.keys())}."
+        )
+    state_dict = {k: v.contiguous() for k, v in state_dict.items()}
+    save_file(state_dict, str(out_path), metadata={"format": "pt", "load_key": load_key})
+    logger.info(f"Saved {len(state_dict)} tensors to {out_path}")
+    return out_path
+
+
+def _load_key_prefix(path, metadata, keys, load_key):
+    """The tensor name prefix of the `load_key` states, raising if the file holds other states."""
+    if load_key is None:
+        return ""
+    converted_key = metadata.get("load_key")
+    if converted_key is not None:
+        if converted_key != load_key:
+            raise KeyError(f"{path} holds the `{converted_key}` states, but `{load_key}` was requested.")
+        return ""
+    state_keys = {key.split(".", 1)[0] for key in keys} & {"module", "ema"}
+    if not state_keys:
+        return ""  # a bare model state dict, like `pytorch_model_*.pt`
+    if load_key not in state_keys:
+        raise KeyError(
+            f"Missing key: `{load_key}` in the checkpoint: {path}. The states in it are: {sorted(state_keys)}."
+        )
+    return f"{load_key}."
+
+
+def load_safetensors_into_model(model, path, device, strict=True, load_key=None):
+    """
+    Stream a safetensors checkpoint into a (possibly meta-device) model.
+
+    The file is memory-mapped and each tensor is read, cast to the dtype of the parameter it
+    replaces and placed on `device` one at a time, so the host never holds a full copy of the
+    checkpoint and the model never needs to be materialized before loading.
+
+    Args:
+        model (nn.Module): The model. Parameters may live on the meta device.
+        path (str or Path): Path to the `.safetensors` file.
+        device (str or torch.device): Target device of the weights.
+        strict (bool): Raise if the checkpoint and the model keys do not match.
+        load_key (str): Model states to load, 'module' or 'ema', like the `.pt` path. Checked against the key the
+            file was converted from, or selects the `<load_key>.` prefixed tensors of a file holding several.
+
+    Returns:
+        model (nn.Module): The model with loaded weights.
+    """
+    from safetensors import safe_open
+
+    device = torch.device(device)
+    targets = dict(model.named_parameters())
+    targets.update(dict(model.named_buffers()))
+    loaded = set()
+    unexpected = []
+    # safetensors reads directly into device memory for cuda targets.
+    with safe_open(str(path), framework="pt", device=str(device)) as f:
+        file_keys = list(f.keys())
+        prefix = _load_key_prefix(path, f.metadata() or {}, file_keys, load_key)
+        for file_key in file_keys:
+            if not file_key.startswith(prefix):
+                continue
+            key = file_key[len(prefix):]
+            if key not in targets:
+                unexpected.append(key)
+                continue
+            target = targets[key]
+            tensor = f.get_tensor(file_key).to(device=device, dtype=target.dtype)
+            if tuple(tensor.shape) != tuple(target.shape):
+                raise ValueError(
+                    f"Shape mismatch for {key}: checkpoint {tuple(tensor.shape)}, model {tuple(target.shape)}."
+                )
+            module_name, _, name = key.rpartition(".")
+            module = model.get_submodule(module_name) if module_name else model
+            if name in module._parameters:
+                module._parameters[name] = nn.Parameter(tensor, requires_grad=target.requires_grad)
+            else:
+                module._buffers[name] = tensor
+            loaded.add(key)
+
+    missing = [k for k in targets if k not in loaded]
+    if strict and (missing or unexpected):
+        raise RuntimeError(
+            f"Error(s) in loading state_dict from {path}: missing keys {missing}, unexpected keys {unexpected}."
+        )
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a HunyuanVideo `.pt` checkpoint to safetensors.")
+    parser.add_argument("pt_path", type=str, help="Path to the `.pt` checkpoint.")
+    parser.add_argument("--out-path", type=str, default=None, help="Default is next to the `.pt` file.")
+    parser.add_argument("--load-key", type=str, default="module", help="'module' or 'ema'.")
+    args = parser.parse_args()
+    convert_pt_to_safetensors(args.pt_path, args.out_path, args.load_key)
+
+
+if __name__ == "__main__":
+    main()
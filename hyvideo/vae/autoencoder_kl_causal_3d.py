@@ -16,7 +16,7 @@
 # Modified from diffusers==0.29.2
 #
 # ==============================================================================
-from typing import Dict, Optional, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 from dataclasses import dataclass
 
 import torch
@@ -130,6 +130,8 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
         )
         self.tile_latent_min_size = int(sample_size / (2 ** (len(self.config.block_out_channels) - 1)))
         self.tile_overlap_factor = 0.25
+        # Max number of same-shape tiles encoded/decoded in one call.
+        self.tile_batch_size = 1
 
     def _set_gradient_checkpointing(self, module, value=False):
         if isinstance(module, (EncoderCausal3D, DecoderCausal3D)):
@@ -164,6 +166,24 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
         self.disable_spatial_tiling()
         self.disable_temporal_tiling()
 
+    def enable_tile_batching(self, tile_batch_size: int = 4):
+        r"""
+        Run same-shape tiles of the tiled encode/decode as micro-batches of up to `tile_batch_size` tiles.
+
+        Finished tiles are accumulated into the output canvas (see `_tiled_blend`), so peak memory is the
+        canvas plus the activations and output of one micro-batch, which grow linearly with the batch size;
+        this acts as the memory budget of tiled execution. Batching does change allocation: a micro-batch
+        concatenates its input tiles into a new tensor, and tiles run grouped by shape instead of row-major.
+        With `tile_batch_size=1` no input is copied and one tile runs at a time.
+        """
+        self.tile_batch_size = max(1, tile_batch_size)
+
+    def disable_tile_batching(self):
+        r"""
+        Run the tiles of the tiled encode/decode one by one.
+        """
+        self.tile_batch_size = 1
+
     def enable_slicing(self):
         r"""
         Enable sliced VAE decoding. When this option is enabled, the VAE will split the input tensor in slices to
@@ -340,6 +360,92 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
 
         return DecoderOutput(sample=decoded)
 
+    def _decoder_streaming_modules(self) -> List[nn.Module]:
+        return [module for module in self.decoder.modules() if hasattr(module, "set_streaming")]
+
+    def _set_decoder_streaming(self, streaming: bool, kv_window: Optional[int] = None):
+        for module in self._decoder_streaming_modules():
+            module.set_streaming(streaming)
+            if hasattr(module, "stream_kv_window"):
+                module.stream_kv_window = kv_window
+
+    @staticmethod
+    def _copy_stream_value(value):
+        # Lists (the kv cache) are updated in place, tensors and flags are replaced.
+        return list(value) if isinstance(value, list) else value
+
+    def _save_stream_state(self, modules: List[nn.Module]) -> List[dict]:
+        return [
+            {name: self._copy_stream_value(getattr(module, name)) for name in module.stream_state_names}
+            for module in modules
+        ]
+
+    def _load_stream_state(self, modules: List[nn.Module], state: Optional[List[dict]]):
+        """Restore a state of `_save_stream_state`, or start a new stream if `state` is None."""
+        for k, module in enumerate(modules):
+            if state is None:
+                module.set_streaming(True)
+            else:
+                for name, value in state[k].items():
+                    setattr(module, name, self._copy_stream_value(value))
+
+    @torch.no_grad()
+    def streaming_decode(self, z: torch.FloatTensor, chunk_size: int = 4, kv_window: Optional[int] = None):
+        r"""
+        Decode `z` in chunks of `chunk_size` latent frames and yield the pixel frames of each chunk.
+
+        Every causal conv keeps the last `kernel_size - 1` input frames of the previous chunk and the
+        mid-block attention keeps the keys/values of the last `kv_window` latent frames, so each latent frame
+        is decoded exactly once without temporal overlap or blending. `kv_window` defaults to
+        `tile_latent_min_tsize`, the context a temporal tile sees, so memory does not grow with the video
+        length; pass a larger window for more context. GroupNorm statistics are computed per chunk, the same
+        approximation temporal tiling makes. The first chunk yields
+        `1 + time_compression_ratio * (chunk_size - 1)` frames, the following ones
+        `time_compression_ratio * chunk_size`.
+
+        With spatial tiling enabled and a large enough `z`, every chunk is split into the overlapping
+        spatial tiles of `spatial_tiled_decode`. Each tile position keeps its own stream state, and the
+        decoded tiles of a chunk are blended as in `spatial_tiled_decode`.
+        """
+        assert len(z.shape) == 5, "The input tensor should have 5 dimensions."
+        if kv_window is None:
+            kv_window = self.tile_latent_min_tsize
+        spatial_tiling = self.use_spatial_tiling and (
+            z.shape[-1] > self.tile_latent_min_size or z.shape[-2] > self.tile_latent_min_size
+        )
+        self._set_decoder_streaming(True, kv_window=kv_window)
+        try:
+            if not spatial_tiling:
+                for start in range(0, z.shape[2], chunk_size):
+                    chunk = self.post_quant_conv(z[:, :, start: start + chunk_size])
+                    yield self.decoder(chunk)
+                return
+
+            overlap_size = int(self.tile_latent_min_size * (1 - self.tile_overlap_factor))
+            blend_extent = int(self.tile_sample_min_size * self.tile_overlap_factor)
+            modules = self._decoder_streaming_modules()
+            states = {}  # tile position -> stream state
+            for start in range(0, z.shape[2], chunk_size):
+                tiles, num_rows = self._split_spatial_tiles(
+                    z[:, :, start: start + chunk_size], self.tile_latent_min_size, overlap_size
+                )
+                # Unbatched, `_iter_tiles` passes every tile as is, so its position can be looked up.
+                positions = {id(tile): k for k, tile in enumerate(tiles)}
+
+                def decode_tile(tile):
+                    k = positions[id(tile)]
+                    self._load_stream_state(modules, states.get(k))
+                    decoded = self.decoder(self.post_quant_conv(tile))
+                    states[k] = self._save_stream_state(modules)
+                    return decoded
+
+                yield self._tiled_blend(
+                    tiles, (1, num_rows, len(tiles) // num_rows), decode_tile, (0, blend_extent, blend_extent),
+                    batch_size=1,
+                )
+        finally:
+            self._set_decoder_streaming(False)
+
     def blend_v(self, a: torch.Tensor, b: torch.Tensor, blend_extent: int) -> torch.Tensor:
         blend_extent = min(a.shape[-2], b.shape[-2], blend_extent)
         for y in range(blend_extent):
@@ -358,6 +464,107 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
             b[:, :, x, :, :] = a[:, :, -blend_extent + x, :, :] * (1 - x / blend_extent) + b[:, :, x, :, :] * (x / blend_extent)
         return b
 
+    def _iter_tiles(self, tiles: List[torch.Tensor], fn, batch_size: Optional[int] = None):
+        """
+        Apply `fn` to every tile and yield `(index, output)` as soon as each output is ready. Tiles of the
+        same shape are concatenated along the batch dimension into micro-batches of up to `batch_size`
+        (default `self.tile_batch_size`) tiles, edge tiles form their own groups.
+        """
+        batch_size = batch_size or self.tile_batch_size
+        groups = {}
+        for idx, tile in enumerate(tiles):
+            groups.setdefault(tuple(tile.shape), []).append(idx)
+        for indices in groups.values():
+            for start in range(0, len(indices), batch_size):
+                chunk = indices[start: start + batch_size]
+                if len(chunk) == 1:
+                    yield chunk[0], fn(tiles[chunk[0]])
+                    continue
+                tile_batch = tiles[chunk[0]].shape[0]
+                out = fn(torch.cat([tiles[k] for k in chunk], dim=0))
+                for k, tile_out in zip(chunk, out.split(tile_batch, dim=0)):
+                    yield k, tile_out
+
+    @staticmethod
+    def _tile_layout(sizes: List[int], blend_extent: int, device, dtype):
+        """
+        Lay out overlapping tiles along one axis, each tile overlapping the last `blend_extent` elements of
+        the previous one. Returns the tile offsets, their blend weights (linear ramps over the overlaps,
+        summing to one) and the total length.
+        """
+        offsets, weights = [], []
+        for k, size in enumerate(sizes):
+            weight = torch.ones(size, device=device, dtype=dtype)
+            offset = 0
+            if k > 0:
+                extent = min(blend_extent, sizes[k - 1], size)
+                offset = offsets[-1] + sizes[k - 1] - extent
+                weight[:extent] = torch.arange(extent, device=device, dtype=dtype) / extent
+            if k + 1 < len(sizes):
+                extent = min(blend_extent, size, sizes[k + 1])
+                weight[size - extent:] *= 1 - torch.arange(extent, device=device, dtype=dtype) / extent
+            offsets.append(offset)
+            weights.append(weight)
+        return offsets, weights, offsets[-1] + sizes[-1]
+
+    def _tiled_blend(self, tiles: List[torch.Tensor], grid: Tuple[int, int, int], fn, blend_extents: Tuple[int, int, int],
+                     trim_first_frame: bool = False, batch_size: Optional[int] = None) -> torch.Tensor:
+        """
+        Run `fn` over `tiles`, a row-major (time, rows, cols) `grid` of overlapping tiles, and blend the
+        outputs into a canvas that is allocated once. `blend_extents` are the (time, height, width) overlaps
+        in output elements. Each output tile is weighted with linear ramps, accumulated in place and
+        dropped, so peak memory is the canvas plus one micro-batch of tiles. With `trim_first_frame`, the
+        first output frame of every temporal tile but the first is dropped. `batch_size` overrides
+        `self.tile_batch_size`.
+
+        Along the temporal axis and along edges shared by two tiles this matches blending each tile with its
+        previous/top/left neighbour and cropping the overlap. Where a height overlap meets a width overlap, the
+        product of the ramps weights the four tiles bilinearly and symmetrically, which differs from the
+        sequential `blend_v`-then-`blend_h` weights of the per-tile path inside those corner regions.
+        """
+        nt, nr, nc = grid
+        in_sizes = (
+            [tiles[t * nr * nc].shape[2] for t in range(nt)],
+            [tiles[r * nc].shape[3] for r in range(nr)],
+            [tiles[c].shape[4] for c in range(nc)],
+        )
+        canvas, layouts = None, None
+        for idx, out in self._iter_tiles(tiles, fn, batch_size=batch_size):
+            pos = (idx // (nr * nc), idx // nc % nr, idx % nc)
+            if canvas is None:
+                # Output tile sizes follow from the compression ratios seen on the first output.
+                layouts = []
+                for axis, (sizes, extent) in enumerate(zip(in_sizes, blend_extents)):
+                    i0, o0 = sizes[pos[axis]], out.shape[2 + axis]
+                    if axis > 0:
+                        out_sizes = [size * o0 // i0 for size in sizes]
+                    elif i0 > 1:
+                        out_sizes = [1 + (size - 1) * (o0 - 1) // (i0 - 1) for size in sizes]
+                    else:
+                        out_sizes = [o0] * len(sizes)
+                    if axis == 0 and trim_first_frame:
+                        out_sizes = [size if k == 0 else size - 1 for k, size in enumerate(out_sizes)]
+                    layouts.append(self._tile_layout(out_sizes, extent, out.device, out.dtype))
+                canvas = out.new_zeros(out.shape[:2] + tuple(layout[2] for layout in layouts))
+            if trim_first_frame and pos[0] > 0:
+                out = out[:, :, 1:]
+            (t0, h0, w0), (wt, wh, ww) = zip(*[(layout[0][k], layout[1][k]) for layout, k in zip(layouts, pos)])
+            out = out.mul_(wt[:, None, None]).mul_(wh[:, None]).mul_(ww)
+            canvas[:, :, t0: t0 + out.shape[2], h0: h0 + out.shape[3], w0: w0 + out.shape[4]] += out
+            del out
+        return canvas
+
+    @staticmethod
+    def _split_spatial_tiles(x: torch.Tensor, tile_size: int, overlap_size: int):
+        """Split `x` into overlapping spatial tiles, returned row-major with the number of rows."""
+        tiles = []
+        num_rows = 0
+        for i in range(0, x.shape[-2], overlap_size):
+            num_rows += 1
+            for j in range(0, x.shape[-1], overlap_size):
+                tiles.append(x[:, :, :, i: i + tile_size, j: j + tile_size])
+        return tiles, num_rows
+
     def spatial_tiled_encode(self, x: torch.FloatTensor, return_dict: bool = True, return_moments: bool = False) -> AutoencoderKLOutput:
         r"""Encode a batch of images/videos using a tiled encoder.
 
@@ -379,32 +586,13 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
         """
         overlap_size = int(self.tile_sample_min_size * (1 - self.tile_overlap_factor))
         blend_extent = int(self.tile_latent_min_size * self.tile_overlap_factor)
-        row_limit = self.tile_latent_min_size - blend_extent
 
         # Split video into tiles and encode them separately.
-        rows = []
-        for i in range(0, x.shape[-2], overlap_size):
-            row = []
-            for j in range(0, x.shape[-1], overlap_size):
-                tile = x[:, :, :, i: i + self.tile_sample_min_size, j: j + self.tile_sample_min_size]
-                tile = self.encoder(tile)
-                tile = self.quant_conv(tile)
-                row.append(tile)
-            rows.append(row)
-        result_rows = []
-        for i, row in enumerate(rows):
-            result_row = []
-            for j, tile in enumerate(row):
-                # blend the above tile and the left tile
-                # to the current tile and add the current tile to the result row
-                if i > 0:
-                    tile = self.blend_v(rows[i - 1][j], tile, blend_extent)
-                if j > 0:
-                    tile = self.blend_h(row[j - 1], tile, blend_extent)
-                result_row.append(tile[:, :, :, :row_limit, :row_limit])
-            result_rows.append(torch.cat(result_row, dim=-1))
-
-        moments = torch.cat(result_rows, dim=-2)
+        tiles, num_rows = self._split_spatial_tiles(x, self.tile_sample_min_size, overlap_size)
+        moments = self._tiled_blend(
+            tiles, (1, num_rows, len(tiles) // num_rows), lambda tile: self.quant_conv(self.encoder(tile)),
+            (0, blend_extent, blend_extent),
+        )
         if return_moments:
             return moments
 
@@ -430,33 +618,14 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
         """
         overlap_size = int(self.tile_latent_min_size * (1 - self.tile_overlap_factor))
         blend_extent = int(self.tile_sample_min_size * self.tile_overlap_factor)
-        row_limit = self.tile_sample_min_size - blend_extent
 
         # Split z into overlapping tiles and decode them separately.
         # The tiles have an overlap to avoid seams between tiles.
-        rows = []
-        for i in range(0, z.shape[-2], overlap_size):
-            row = []
-            for j in range(0, z.shape[-1], overlap_size):
-                tile = z[:, :, :, i: i + self.tile_latent_min_size, j: j + self.tile_latent_min_size]
-                tile = self.post_quant_conv(tile)
-                decoded = self.decoder(tile)
-                row.append(decoded)
-            rows.append(row)
-        result_rows = []
-        for i, row in enumerate(rows):
-            result_row = []
-            for j, tile in enumerate(row):
-                # blend the above tile and the left tile
-                # to the current tile and add the current tile to the result row
-                if i > 0:
-                    tile = self.blend_v(rows[i - 1][j], tile, blend_extent)
-                if j > 0:
-                    tile = self.blend_h(row[j - 1], tile, blend_extent)
-                result_row.append(tile[:, :, :, :row_limit, :row_limit])
-            result_rows.append(torch.cat(result_row, dim=-1))
-
-        dec = torch.cat(result_rows, dim=-2)
+        tiles, num_rows = self._split_spatial_tiles(z, self.tile_latent_min_size, overlap_size)
+        dec = self._tiled_blend(
+            tiles, (1, num_rows, len(tiles) // num_rows), lambda tile: self.decoder(self.post_quant_conv(tile)),
+            (0, blend_extent, blend_extent),
+        )
         if not return_dict:
             return (dec,)
 
@@ -503,28 +672,23 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
         B, C, T, H, W = z.shape
         overlap_size = int(self.tile_latent_min_tsize * (1 - self.tile_overlap_factor))
         blend_extent = int(self.tile_sample_min_tsize * self.tile_overlap_factor)
-        t_limit = self.tile_sample_min_tsize - blend_extent
-
-        row = []
-        for i in range(0, T, overlap_size):
-            tile = z[:, :, i: i + self.tile_latent_min_tsize + 1, :, :]
-            if self.use_spatial_tiling and (tile.shape[-1] > self.tile_latent_min_size or tile.shape[-2] > self.tile_latent_min_size):
-                decoded = self.spatial_tiled_decode(tile, return_dict=True).sample
-            else:
-                tile = self.post_quant_conv(tile)
-                decoded = self.decoder(tile)
-            if i > 0:
-                decoded = decoded[:, :, 1:, :, :]
-            row.append(decoded)
-        result_row = []
-        for i, tile in enumerate(row):
-            if i > 0:
-                tile = self.blend_t(row[i - 1], tile, blend_extent)
-                result_row.append(tile[:, :, :t_limit, :, :])
-            else:
-                result_row.append(tile[:, :, :t_limit + 1, :, :])
 
-        dec = torch.cat(result_row, dim=2)
+        time_tiles = [z[:, :, i: i + self.tile_latent_min_tsize + 1, :, :] for i in range(0, T, overlap_size)]
+        if self.use_spatial_tiling and (W > self.tile_latent_min_size or H > self.tile_latent_min_size):
+            # Decode the spatial tiles of all temporal tiles together so same-shape tiles share micro-batches.
+            spatial_overlap_size = int(self.tile_latent_min_size * (1 - self.tile_overlap_factor))
+            spatial_blend_extent = int(self.tile_sample_min_size * self.tile_overlap_factor)
+            tiles, num_rows = [], 0
+            for tile in time_tiles:
+                spatial_tiles, num_rows = self._split_spatial_tiles(tile, self.tile_latent_min_size, spatial_overlap_size)
+                tiles.extend(spatial_tiles)
+            grid = (len(time_tiles), num_rows, len(tiles) // len(time_tiles) // num_rows)
+        else:
+            tiles, grid, spatial_blend_extent = time_tiles, (len(time_tiles), 1, 1), 0
+        dec = self._tiled_blend(
+            tiles, grid, lambda tile: self.decoder(self.post_quant_conv(tile)),
+            (blend_extent, spatial_blend_extent, spatial_blend_extent), trim_first_frame=True,
+        )
         if not return_dict:
             return (dec,)
 
@@ -601,3 +765,27 @@ class AutoencoderKLCausal3D(ModelMixin, ConfigMixin, FromOriginalVAEMixin):
         """
         if self.original_attn_processors is not None:
             self.set_attn_processor(self.original_attn_processors)
+
+
+def _check_iter_tiles():
+    """Every tile comes out of `_iter_tiles` exactly once and unchanged, for micro-batches of 1 to 5 tiles."""
+    from types import SimpleNamespace
+
+    for tile_batch in (1, 2):
+        # Ten interior tiles, three edge tiles of another shape and a lone corner tile.
+        shapes = [(4, 8, 8)] * 10 + [(4, 8, 5)] * 3 + [(4, 3, 5)]
+        tiles = [torch.randn(tile_batch, 2, *shape) for shape in shapes]
+        for tile_batch_size in range(1, 6):
+            vae = SimpleNamespace(tile_batch_size=tile_batch_size)
+            seen = []
+            for idx, out in AutoencoderKLCausal3D._iter_tiles(vae, tiles, lambda x: x * 2):
+                assert torch.equal(out, tiles[idx] * 2), f"tile {idx} mismatched at tile_batch_size {tile_batch_size}"
+                seen.append(idx)
+            assert sorted(seen) == list(range(len(tiles))), (
+                f"tile_batch_size {tile_batch_size}, batch {tile_batch}: tiles {sorted(seen)} came out"
+            )
+    print("_iter_tiles yields every tile exactly once")
+
+
+if __name__ == "__main__":
+    _check_iter_tiles()
@@ -69,8 +69,28 @@ class CausalConv3d(nn.Module):
 
         self.conv = nn.Conv3d(chan_in, chan_out, kernel_size, stride=stride, dilation=dilation, **kwargs)
 
+        # Streaming decode: the last `kernel_size - 1` input frames of the previous chunk.
+        self.stream_state_names = ("stream_cache",)
+        self.streaming = False
+        self.stream_cache = None
+
+    def set_streaming(self, streaming: bool):
+        self.streaming = streaming
+        self.stream_cache = None
+
     def forward(self, x):
-        x = F.pad(x, self.time_causal_padding, mode=self.pad_mode)
+        t_pad = self.time_causal_padding[4]
+        if not self.streaming or t_pad == 0:
+            x = F.pad(x, self.time_causal_padding, mode=self.pad_mode)
+            return self.conv(x)
+
+        # The first chunk is padded by replicating its first frame, like the non-streaming path.
+        if self.stream_cache is None:
+            x = torch.cat([x[:, :, :1]] * t_pad + [x], dim=2)
+        else:
+            x = torch.cat([self.stream_cache, x], dim=2)
+        self.stream_cache = x[:, :, -t_pad:].clone()
+        x = F.pad(x, self.time_causal_padding[:4] + (0, 0), mode=self.pad_mode)
         return self.conv(x)
 
 
@@ -126,6 +146,15 @@ class UpsampleCausal3D(nn.Module):
         else:
             self.Conv2d_0 = conv
 
+        # Streaming decode: only the first frame of the first chunk is upsampled spatially only.
+        self.stream_state_names = ("stream_started",)
+        self.streaming = False
+        self.stream_started = False
+
+    def set_streaming(self, streaming: bool):
+        self.streaming = streaming
+        self.stream_started = False
+
     def forward(
         self,
         hidden_states: torch.FloatTensor,
@@ -151,7 +180,10 @@ class UpsampleCausal3D(nn.Module):
 
         # if `output_size` is passed we force the interpolation output
         # size and do not make use of `scale_factor=2`
-        if self.interpolate:
+        if self.interpolate and self.streaming and self.stream_started:
+            hidden_states = F.interpolate(hidden_states, scale_factor=self.upsample_factor, mode="nearest")
+        elif self.interpolate:
+            self.stream_started = self.streaming
             B, C, T, H, W = hidden_states.shape
             first_h, other_h = hidden_states.split((1, T - 1), dim=2)
             if output_size is None:
@@ -612,16 +644,68 @@ class UNetMidBlockCausal3D(nn.Module):
         self.attentions = nn.ModuleList(attentions)
         self.resnets = nn.ModuleList(resnets)
 
+        # Streaming decode: keys/values of the last `stream_kv_window` frames (all if None), per attention layer.
+        self.stream_state_names = ("stream_kv_cache",)
+        self.streaming = False
+        self.stream_kv_window = None
+        self.stream_kv_cache = [None] * len(self.attentions)
+
+    def set_streaming(self, streaming: bool):
+        self.streaming = streaming
+        self.stream_kv_cache = [None] * len(self.attentions)
+
+    def _streaming_attention(self, idx: int, attn: Attention, hidden_states: torch.FloatTensor, T: int, HW: int) -> torch.FloatTensor:
+        """
+        Causal attention of the current chunk over the cached keys/values of the previous chunks.
+
+        Cached frames are all in the past and fully visible, so only the chunk itself is causal: every frame
+        of the chunk attends to the cache and the chunk frames up to itself in one unmasked call, and no
+        mask is ever built.
+        """
+        residual = hidden_states
+        B = hidden_states.shape[0]
+        if attn.group_norm is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
+        query = attn.to_q(hidden_states)
+        key = attn.to_k(hidden_states)
+        value = attn.to_v(hidden_states)
+        if self.stream_kv_cache[idx] is not None:
+            key = torch.cat([self.stream_kv_cache[idx][0], key], dim=1)
+            value = torch.cat([self.stream_kv_cache[idx][1], value], dim=1)
+        n_past = key.shape[1] // HW - T
+        keep = key.shape[1] if self.stream_kv_window is None else min(key.shape[1], self.stream_kv_window * HW)
+        self.stream_kv_cache[idx] = (key[:, key.shape[1] - keep:], value[:, value.shape[1] - keep:])
+
+        head_dim = query.shape[-1] // attn.heads
+        query, key, value = (
+            t.view(B, -1, attn.heads, head_dim).transpose(1, 2) for t in (query, key, value)
+        )
+        frames = []
+        for f in range(T):
+            end = (n_past + f + 1) * HW
+            frame_query = query[:, :, f * HW: (f + 1) * HW]
+            frames.append(F.scaled_dot_product_attention(frame_query, key[:, :, :end], value[:, :, :end]))
+        hidden_states = torch.cat(frames, dim=2)
+        hidden_states = hidden_states.transpose(1, 2).reshape(B, -1, attn.heads * head_dim)
+        hidden_states = attn.to_out[0](hidden_states)
+        hidden_states = attn.to_out[1](hidden_states)
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+        return hidden_states / attn.rescale_output_factor
+
     def forward(self, hidden_states: torch.FloatTensor, temb: Optional[torch.FloatTensor] = None) -> torch.FloatTensor:
         hidden_states = self.resnets[0](hidden_states, temb)
-        for attn, resnet in zip(self.attentions, self.resnets[1:]):
+        for idx, (attn, resnet) in enumerate(zip(self.attentions, self.resnets[1:])):
             if attn is not None:
                 B, C, T, H, W = hidden_states.shape
                 hidden_states = rearrange(hidden_states, "b c f h w -> b (f h w) c")
-                attention_mask = prepare_causal_attention_mask(
-                    T, H * W, hidden_states.dtype, hidden_states.device, batch_size=B
-                )
-                hidden_states = attn(hidden_states, temb=temb, attention_mask=attention_mask)
+                if self.streaming:
+                    hidden_states = self._streaming_attention(idx, attn, hidden_states, T, H * W)
+                else:
+                    attention_mask = prepare_causal_attention_mask(
+                        T, H * W, hidden_states.dtype, hidden_states.device, batch_size=B
+                    )
+                    hidden_states = attn(hidden_states, temb=temb, attention_mask=attention_mask)
                 hidden_states = rearrange(hidden_states, "b (f h w) c -> b c f h w", f=T, h=H, w=W)
             hidden_states = resnet(hidden_states, temb)
 
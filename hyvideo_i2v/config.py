@@ -58,6 +58,20 @@ def add_data_args(parser: argparse.ArgumentParser):
 
     group.add_argument("--data-type", type=str, default="image", choices=DATA_TYPE, help="Type of the dataset.")
     group.add_argument("--data-jsons-path", type=str, default=None, help="Dataset path for training.")
+    group.add_argument("--data-index-path", type=str, default=None,
+                       help="Parquet index of --data-jsons-path built by `python -m hyvideo_i2v.dataset.video_index`, "
+                            "memory-mapped instead of parsing every JSON on start.")
+    group.add_argument("--text-cache-path", type=str, default=None,
+                       help="Text cache built by `python -m hyvideo_i2v.dataset.text_cache`. The dataset returns "
+                            "its tokens, and its text encoder outputs when it has them. Text encoder outputs are "
+                            "conditioned on the first frame and cannot be used with --random-temporal-offset.")
+    group.add_argument("--cond-cache", action="store_true",
+                       help="Load the conditioning latents and semantic images cached by "
+                            "`python -m hyvideo_i2v.dataset.cond_cache` instead of a VAE decode and encode per step. "
+                            "Clips without a cache are replaced by others; not compatible with "
+                            "--random-temporal-offset.")
+    group.add_argument("--random-temporal-offset", action="store_true",
+                       help="Sample the training latent window at a random temporal offset instead of the first frames.")
     group.add_argument("--sample-n-frames", type=int, default=65,
                        help="How many frames to sample from a video. if using 3d vae, the number should be 4n+1")
     group.add_argument("--sample-stride", type=int, default=1,
@@ -65,6 +79,12 @@ def add_data_args(parser: argparse.ArgumentParser):
     group.add_argument("--num-workers", type=int, default=4, help="Number of workers for data loading.")
     group.add_argument("--prefetch-factor", type=int, default=2, help="Prefetch factor for data loading.")
     group.add_argument("--same-data-batch", action="store_true", help="Use same data type for all rank in a batch for training.")
+    group.add_argument("--bucket-batch", action="store_true",
+                       help="Batch clips of the same latent shape with `hyvideo_i2v.dataset.bucket_sampler`, all ranks "
+                            "on the same bucket at every step. Read by `bucket_sampler.build_dataloader`.")
+    group.add_argument("--bucket-max-tokens", type=int, default=None,
+                       help="Token budget of a bucketed micro batch: each bucket gets min(--micro-batch-size, "
+                            "budget // tokens) clips. Defaults to --micro-batch-size for every bucket.")
     group.add_argument("--uncond-p", type=float, default=0.1,
                        help="Probability of randomly dropping video description.")
     group.add_argument("--sematic-cond-drop-p", type=float, default=0.1,
@@ -89,6 +109,10 @@ def add_training_args(parser: argparse.ArgumentParser):
     group.add_argument("--gradient-accumulation-steps", type=int, default=1,
                        help="Number of steps to accumulate gradients over before performing an update.")
     group.add_argument("--global-seed", type=int, default=42, help="Global seed for reproducibility.")
+    group.add_argument("--train-sa-drop-rate", type=float, default=0.0,
+                       help="Jenga self-attention drop rate of the training forward: the share of image key blocks "
+                            "each query block skips, in the forward and the block-sparse backward. 0 keeps all. "
+                            "Above 0, tokens are blocked along the space curve of inference, which needs gilbert.py.")
 
     group.add_argument("--resume", type=str, default=None,
                        help="Path to the checkpoint to resume training. It can be an experiment index to resume from "
@@ -421,6 +445,19 @@ def add_inference_args(parser: argparse.ArgumentParser):
         default=0,
         help="current gpu thread id",
     )
+    # --- dynamic prompt distribution ---
+    group.add_argument(
+        "--prompt-queue",
+        action="store_true",
+        help="Claim prompts dynamically from a queue in the save directory shared by all workers, instead of "
+        "the static --cur-id/--chunk-num shards. Finished prompts are skipped when the run is restarted.",
+    )
+    group.add_argument(
+        "--prompt-lease-seconds",
+        type=float,
+        default=600.0,
+        help="Lease of a claimed prompt. Prompts of a crashed worker are claimed again after it expires.",
+    )
     group.add_argument(
         "--res-rate-list",
         type=float,
@@ -657,4 +694,7 @@ def sanity_check_args(args):
         raise ValueError(
             f"Latent channels ({args.latent_channels}) must match the VAE channels ({vae_channels})."
         )
+    train_sa_drop_rate = getattr(args, "train_sa_drop_rate", 0.0)
+    if not 0.0 <= train_sa_drop_rate < 1.0:
+        raise ValueError(f"--train-sa-drop-rate must be in [0, 1), got {train_sa_drop_rate}.")
     return args
@@ -0,0 +1,291 @@
+"""
+Shape-bucketed batches for multi-resolution I2V training.
+
+Clips of different latent resolutions cannot be collated, so mixed-resolution training used to run at a
+micro batch size of 1. `BucketBatchSampler` groups the clips by the shape of their training window
+(`sample_n_latent` latent frames at the clip's latent height and width) and only forms full batches inside a
+bucket. With `max_tokens` every bucket gets its own batch size, so low-resolution buckets fill the same
+token budget as high-resolution ones.
+
+Every rank draws the same sequence of global batches from a seed shared by all ranks and takes its own
+slice of each, so at every step all ranks are on the same bucket: sequence lengths, sequence-parallel
+splits and the Jenga curve caches agree across ranks.
+
+`build_dataloader` sets up the training loader from `--bucket-batch` / `--bucket-max-tokens`.
+`python -m hyvideo_i2v.dataset.bucket_sampler` benchmarks it against per-sample loading on a synthetic latent
+dataset.
+"""
+
+import argparse
+import math
+import random
+import time
+from collections import defaultdict
+
+import torch
+import torch.distributed as dist
+from loguru import logger
+from torch.utils.data import DataLoader, Dataset, DistributedSampler, Sampler
+
+
+def window_shape(latent_shape, sample_n_latent):
+    """The (T, H, W) latent shape of a training window of a clip, None if the clip is too short."""
+    if latent_shape[-3] < sample_n_latent:
+        return None
+    return sample_n_latent, latent_shape[-2], latent_shape[-1]
+
+
+def shape_buckets(latent_shapes, sample_n_latent):
+    """Clip indices grouped by window shape, in index order."""
+    buckets = defaultdict(list)
+    for idx, latent_shape in enumerate(latent_shapes):
+        shape = window_shape(latent_shape, sample_n_latent)
+        if shape is not None:
+            buckets[shape].append(idx)
+    return dict(buckets)
+
+
+def num_tokens(shape, patch_size=(1, 2, 2)):
+    """Video tokens of a (T, H, W) latent window after patchify."""
+    return math.prod(size // patch for size, patch in zip(shape, patch_size))
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler yielding this rank's indices of one bucket per step.
+
+    Args:
+        latent_shapes (list): Latent shape of every clip, (C, T, H, W) or (1, C, T, H, W).
+        sample_n_latent (int): Latent frames of a training window, clips with fewer are skipped.
+        batch_size (int): Micro batch size per rank, the largest one when `max_tokens` is set.
+        max_tokens (int, optional): Token budget of a micro batch. A bucket gets
+            `min(batch_size, max_tokens // tokens)` clips per rank, at least 1. Defaults to None (`batch_size`).
+        num_replicas (int, optional): Data-parallel ranks. Defaults to the world size. Under sequence
+            parallelism pass the data-parallel size, so a sequence-parallel group reads the same batch.
+        rank (int, optional): Data-parallel rank. Defaults to the global rank.
+        shuffle (bool): Shuffle the clips of each bucket and the order of the batches every epoch.
+        seed (int): Shared by all ranks, so they draw the same batches.
+        drop_last (bool): Drop the incomplete last global batch of each bucket, otherwise fill it up with
+            clips of the same bucket from its start.
+        patch_size (tuple): Patch size of the DiT, to count tokens.
+    """
+
+    def __init__(self,
+                 latent_shapes,
+                 sample_n_latent,
+                 batch_size,
+                 max_tokens=None,
+                 num_replicas=None,
+                 rank=None,
+                 shuffle=True,
+                 seed=0,
+                 drop_last=True,
+                 patch_size=(1, 2, 2),
+                 ):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        if not 0 <= rank < num_replicas:
+            raise ValueError(f"Invalid rank {rank}, expected in [0, {num_replicas})")
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        self.buckets = shape_buckets(latent_shapes, sample_n_latent)
+        self.bucket_batch_sizes = {}
+        for shape in self.buckets:
+            size = batch_size
+            if max_tokens is not None:
+                size = max(1, min(batch_size, max_tokens // num_tokens(shape, patch_size)))
+            self.bucket_batch_sizes[shape] = size
+        self._num_batches = sum(self._bucket_num_batches(shape) for shape in self.buckets)
+
+    @classmethod
+    def from_dataset(cls, dataset, batch_size, **kwargs):
+        """A sampler over the index of a `VideoDataset`, with its training window length."""
+        sample_n_latent = (dataset.sample_n_frames - 1) // 4 + 1
+        return cls(dataset.table['latent_shape'].to_pylist(), sample_n_latent, batch_size, **kwargs)
+
+    def _bucket_num_batches(self, shape):
+        global_batch = self.bucket_batch_sizes[shape] * self.num_replicas
+        if self.drop_last:
+            return len(self.buckets[shape]) // global_batch
+        return math.ceil(len(self.buckets[shape]) / global_batch)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def global_batches(self):
+        """The (shape, global batch indices) of every step of the epoch, the same on every rank."""
+        rng = random.Random(self.seed + self.epoch)
+        batches = []
+        for shape in sorted(self.buckets):
+            indices = list(self.buckets[shape])
+            if self.shuffle:
+                rng.shuffle(indices)
+            global_batch = self.bucket_batch_sizes[shape] * self.num_replicas
+            num_batches = self._bucket_num_batches(shape)
+            # Fill the last global batch up with the first clips of the bucket (repeated for tiny buckets).
+            padded = (indices * math.ceil(num_batches * global_batch / len(indices)))[:num_batches * global_batch]
+            for start in range(0, len(padded), global_batch):
+                batches.append((shape, padded[start:start + global_batch]))
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        for shape, indices in self.global_batches():
+            size = self.bucket_batch_sizes[shape]
+            yield indices[self.rank * size:(self.rank + 1) * size]
+
+    def __len__(self):
+        return self._num_batches
+
+
+def build_dataloader(args, dataset, num_replicas=None, rank=None):
+    """
+    The training loader of a `VideoDataset` from the data arguments of hyvideo_i2v/config.py.
+
+    With `--bucket-batch`, batches come from a `BucketBatchSampler` capped by `--bucket-max-tokens`; otherwise
+    from a `DistributedSampler`, which needs clips of a single window shape for micro batches above 1.
+    `num_replicas` / `rank` default to the world; under sequence parallelism pass the data-parallel ones.
+    """
+    batch_size = args.micro_batch_size
+    if isinstance(batch_size, (list, tuple)):
+        batch_size = batch_size[0]
+    if num_replicas is None:
+        num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+    if rank is None:
+        rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+    loader_kwargs = dict(num_workers=args.num_workers, pin_memory=True)
+    if args.num_workers > 0:
+        loader_kwargs["prefetch_factor"] = args.prefetch_factor
+
+    if args.bucket_batch:
+        sampler = BucketBatchSampler.from_dataset(
+            dataset, batch_size, max_tokens=args.bucket_max_tokens, num_replicas=num_replicas, rank=rank,
+            seed=args.global_seed,
+        )
+        return DataLoader(dataset, batch_sampler=sampler, **loader_kwargs)
+    if args.bucket_max_tokens is not None:
+        raise ValueError("--bucket-max-tokens needs --bucket-batch")
+    sampler = DistributedSampler(dataset, num_replicas=num_replicas, rank=rank, seed=args.global_seed)
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, drop_last=True, **loader_kwargs)
+
+
+# ======================== Benchmark ========================
+
+
+class SyntheticLatentDataset(Dataset):
+    """Latent windows of random shapes from a few resolutions, copied from one buffer per shape."""
+
+    def __init__(self, num_clips, sample_n_latent, resolutions, channels=16, seed=0):
+        rng = random.Random(seed)
+        self.latent_shapes = [
+            [channels, sample_n_latent + rng.randint(0, 4), *rng.choice(resolutions)] for _ in range(num_clips)
+        ]
+        self.sample_n_latent = sample_n_latent
+        self.buffers = {
+            tuple(hw): torch.randn(channels, sample_n_latent, *hw) for hw in {tuple(hw) for hw in resolutions}
+        }
+
+    def __len__(self):
+        return len(self.latent_shapes)
+
+    def __getitem__(self, idx):
+        latent_shape = self.latent_shapes[idx]
+        return self.buffers[tuple(latent_shape[-2:])].clone(), {"index": torch.tensor(idx)}
+
+
+def _padding_efficiency(latent_shapes, sample_n_latent, batch_size, seed, patch_size=(1, 2, 2)):
+    """
+    Real over computed tokens of random `batch_size` batches padded to their largest clip, the alternative to
+    bucketing for micro batches above 1. Bucketed batches need no padding.
+    """
+    rng = random.Random(seed)
+    shapes = [window_shape(shape, sample_n_latent) for shape in latent_shapes]
+    tokens = [num_tokens(shape, patch_size) for shape in shapes if shape is not None]
+    rng.shuffle(tokens)
+    real, padded = 0, 0
+    for start in range(0, len(tokens) - batch_size + 1, batch_size):
+        batch = tokens[start:start + batch_size]
+        real += sum(batch)
+        padded += max(batch) * len(batch)
+    return real / padded
+
+
+def _run(name, loader, weight, max_steps):
+    """Measured loading plus a per-token matmul: samples, latent positions and step time."""
+    samples, tokens, steps = 0, 0, 0
+    start_time = time.perf_counter()
+    for latents, _ in loader:
+        torch.matmul(latents.flatten(2).transpose(1, 2), weight)
+        samples += latents.shape[0]
+        tokens += latents[:, 0].numel()
+        steps += 1
+        if steps == max_steps:
+            break
+    elapsed = time.perf_counter() - start_time
+    logger.info(
+        f"{name}: {steps} steps, {elapsed / steps * 1e3:.2f} ms/step, {samples / elapsed:.1f} samples/s, "
+        f"{tokens / elapsed / 1e6:.2f} M latent positions/s, {samples / steps:.2f} samples/step"
+    )
+
+
+def _check_lockstep(latent_shapes, sample_n_latent, args):
+    samplers = [
+        BucketBatchSampler(latent_shapes, sample_n_latent, args.batch_size, max_tokens=args.max_tokens,
+                           num_replicas=args.num_replicas, rank=rank, seed=args.seed)
+        for rank in range(args.num_replicas)
+    ]
+    seen = set()
+    for step_batches in zip(*samplers):
+        shapes = {window_shape(latent_shapes[idx], sample_n_latent) for batch in step_batches for idx in batch}
+        assert len(shapes) == 1, f"ranks on different buckets: {shapes}"
+        seen.update(idx for batch in step_batches for idx in batch)
+    sampler = samplers[0]
+    logger.info(
+        f"{args.num_replicas} ranks in lockstep over {len(sampler)} steps, {len(seen)} distinct clips, "
+        f"batch sizes per bucket: { {shape: sampler.bucket_batch_sizes[shape] for shape in sorted(sampler.buckets)} }"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of shape-bucketed batches on synthetic latents.")
+    parser.add_argument("--num-clips", type=int, default=2048)
+    parser.add_argument("--sample-n-latent", type=int, default=9)
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[30, 40, 45, 80, 68, 120],
+                        help="Latent (height, width) pairs.")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-tokens", type=int, default=32400)
+    parser.add_argument("--num-replicas", type=int, default=8, help="Simulated ranks of the lockstep check.")
+    parser.add_argument("--num-workers", type=int, default=2)
+    parser.add_argument("--max-steps", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    resolutions = list(zip(args.resolutions[::2], args.resolutions[1::2]))
+    dataset = SyntheticLatentDataset(args.num_clips, args.sample_n_latent, resolutions, seed=args.seed)
+    _check_lockstep(dataset.latent_shapes, args.sample_n_latent, args)
+
+    efficiency = _padding_efficiency(dataset.latent_shapes, args.sample_n_latent, args.batch_size, args.seed)
+    logger.info(
+        f"Padded batches of {args.batch_size}: {efficiency:.1%} of the computed tokens are real "
+        f"({1 / efficiency:.2f}x the tokens of bucketed batches)"
+    )
+
+    weight = torch.randn(16, 64)
+    _run("Per sample", DataLoader(dataset, batch_size=1, shuffle=True, num_workers=args.num_workers),
+         weight, args.max_steps)
+    sampler = BucketBatchSampler(dataset.latent_shapes, args.sample_n_latent, args.batch_size,
+                                 max_tokens=args.max_tokens, num_replicas=1, rank=0, seed=args.seed)
+    _run("Bucketed", DataLoader(dataset, batch_sampler=sampler, num_workers=args.num_workers),
+         weight, args.max_steps)
+
+
+if __name__ == "__main__":
+    main()
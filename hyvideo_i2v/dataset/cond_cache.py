@@ -0,0 +1,100 @@
+"""
+Cached I2V conditioning inputs.
+
+Every I2V training step decoded the first latent frame with the VAE, re-encoded it into the conditioning
+latent and handed it to the text encoder as the semantic image. Both only depend on the clip, so this
+preprocessing pass stores them next to the clip's latent cache (`<npy stem>_cond_latents.npy` and
+`<npy stem>_semantic_image.npy`):
+
+- the (mean, std) of the conditioning latent's VAE distribution, (2, C, 1, h, w) float32, so training still
+  samples a fresh latent every step,
+- the decoded first frame as the (H, W, 3) uint8 semantic image.
+
+With `--cond-cache` the dataset memory-maps them, which rules out `--random-temporal-offset`, and replaces
+clips without them; without `--cond-cache` training falls back to the on-device decode in
+hyvideo_i2v/utils/train_utils.py.
+
+    python -m hyvideo_i2v.dataset.cond_cache --data-index-path index.parquet --model-base ckpts
+"""
+
+import argparse
+import os
+
+import numpy as np
+import torch
+from loguru import logger
+
+COND_LATENTS_SUFFIX = "_cond_latents.npy"
+SEMANTIC_IMAGE_SUFFIX = "_semantic_image.npy"
+
+
+def cond_cache_paths(npy_save_path):
+    """Paths of the cached conditioning latents and semantic image of a clip."""
+    stem = os.path.splitext(npy_save_path)[0]
+    return stem + COND_LATENTS_SUFFIX, stem + SEMANTIC_IMAGE_SUFFIX
+
+
+def load_cond_cache(npy_save_path):
+    """The cached (cond latent moments, semantic image) tensors of a clip, or None if not cached."""
+    cond_latents_path, semantic_image_path = cond_cache_paths(npy_save_path)
+    if not (os.path.exists(cond_latents_path) and os.path.exists(semantic_image_path)):
+        return None
+    return (
+        torch.from_numpy(np.array(np.load(cond_latents_path, mmap_mode="r"))),
+        torch.from_numpy(np.array(np.load(semantic_image_path, mmap_mode="r"))),
+    )
+
+
+@torch.no_grad()
+def build_cond_cache(args, device="cuda"):
+    from hyvideo_i2v.utils.train_utils import decode_first_frame, encode_cond_latent_dist
+    from hyvideo_i2v.vae import load_vae
+
+    from .video_loader import VideoDataset
+
+    dataset = VideoDataset(args.data_jsons_path, args=args, data_index_path=args.data_index_path)
+    vae = load_vae(args.vae, args.vae_precision, logger=logger, device=device)[0]
+    npy_paths = dataset.table["npy_save_path"].to_pylist()
+    written = 0
+    for idx in range(args.shard_id, len(npy_paths), args.num_shards):
+        cond_latents_path, semantic_image_path = cond_cache_paths(npy_paths[idx])
+        if not args.overwrite and os.path.exists(cond_latents_path) and os.path.exists(semantic_image_path):
+            continue
+        latent_shape = dataset.table["latent_shape"][idx].as_py()
+        # The cache holds unscaled latents, the training path scales them first.
+        latents = dataset.read_latents(idx, latent_shape, 0, 1).unsqueeze(0).to(device)
+        first_images = decode_first_frame(latents * vae.config.scaling_factor, vae)
+        latent_dist = encode_cond_latent_dist(args, first_images, vae)
+        moments = torch.stack([latent_dist.mean, latent_dist.std], dim=1)[0]
+        np.save(cond_latents_path, moments.float().cpu().numpy())
+        np.save(semantic_image_path, first_images[0].permute(1, 2, 0).to(torch.uint8).cpu().numpy())
+        written += 1
+        if written % 100 == 0:
+            logger.info(f"Conditioning cache: {written} clips written")
+    logger.info(f"Conditioning cache: {written} clips written")
+
+
+def main():
+    from hyvideo_i2v.config import (
+        add_data_args,
+        add_extra_models_args,
+        add_inference_args,
+        add_network_args,
+        sanity_check_args,
+    )
+
+    parser = argparse.ArgumentParser(description="Cache the I2V conditioning latents and semantic images.")
+    parser = add_network_args(parser)
+    parser = add_extra_models_args(parser)
+    parser = add_inference_args(parser)
+    parser = add_data_args(parser)
+    group = parser.add_argument_group(title="Conditioning cache")
+    group.add_argument("--num-shards", type=int, default=1, help="Split the clips over this many processes.")
+    group.add_argument("--shard-id", type=int, default=0, help="The clips idx % num_shards == shard_id.")
+    group.add_argument("--overwrite", action="store_true", help="Rewrite clips that are already cached.")
+    args = sanity_check_args(parser.parse_args())
+    build_cond_cache(args)
+
+
+if __name__ == "__main__":
+    main()
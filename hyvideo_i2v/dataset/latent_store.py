@@ -0,0 +1,121 @@
+"""
+Windowed reads of cached latents.
+
+A training sample only needs `sample_n_latent` latent frames of a clip, so latents are memory-mapped and
+only the frames of the window are copied out, instead of loading the whole `.npy`.
+
+Latents can also be packed into a few large shard files (`python -m hyvideo_i2v.dataset.latent_store`),
+which avoids opening one small file per sample on network filesystems. A packed clip is located by the
+`shard_path`, `shard_offset` and `latent_dtype` columns of the Parquet index (see video_index.py). Clips
+added to the index after packing keep reading their `.npy` until the next pack.
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pyarrow as pa
+import torch
+from loguru import logger
+
+from .video_index import load_index, write_index
+
+# Shard offsets are page aligned, so every packed latent starts on its own page.
+SHARD_ALIGNMENT = 4096
+
+
+def _window(latents, start, length):
+    """Frames [start, start + length) of (1, C, T, H, W) or (C, T, H, W) latents, as a contiguous copy."""
+    if latents.ndim == 5:
+        latents = latents[0]
+    return np.ascontiguousarray(latents[:, start:start + length])
+
+
+def read_latent_window(npy_path, start, length):
+    """Latent frames [start, start + length) of a `.npy` cache, (C, length, H, W)."""
+    return _window(np.load(npy_path, mmap_mode="r"), start, length)
+
+
+def read_shard_window(shard_path, offset, dtype, shape, start, length):
+    """Latent frames [start, start + length) of a latent packed at `offset` of a shard, (C, length, H, W)."""
+    latents = np.memmap(shard_path, dtype=np.dtype(dtype), mode="r", offset=offset, shape=tuple(shape))
+    return _window(latents, start, length)
+
+
+def to_tensor(window, pin_memory=False):
+    """
+    The window as a tensor. With `pin_memory` outside of dataloader workers it is copied straight into page-
+    locked memory; in workers, leave pinning to `DataLoader(pin_memory=True)`.
+    """
+    tensor = torch.from_numpy(window)
+    if pin_memory and torch.cuda.is_available() and torch.utils.data.get_worker_info() is None:
+        pinned = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        pinned.copy_(tensor)
+        return pinned
+    return tensor
+
+
+def pack_latents(index_path, out_dir, out_index_path=None, shard_size_gb=4.0):
+    """
+    Pack the `.npy` latents of every not yet packed clip of an index into shard files.
+
+    Args:
+        index_path (str): Parquet index from video_index.py.
+        out_dir (str): Directory of the shard files, new shards never overwrite existing ones.
+        out_index_path (str): Index with the shard columns filled, `index_path` when None.
+        shard_size_gb (float): Start a new shard once the current one exceeds this size.
+
+    Returns:
+        pa.Table: The written index.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    table = load_index(index_path)
+    rows = table.to_pylist()
+    shard_limit = int(shard_size_gb * 2**30)
+    shard_id = len([name for name in os.listdir(out_dir) if name.endswith(".lshard")])
+    shard_file, shard_path, packed = None, None, 0
+
+    try:
+        for row in rows:
+            if row["shard_path"] is not None:
+                continue
+            if shard_file is None or shard_file.tell() >= shard_limit:
+                if shard_file is not None:
+                    shard_file.close()
+                shard_path = os.path.join(out_dir, f"latents-{shard_id:05d}.lshard")
+                shard_file = open(shard_path, "xb")
+                shard_id += 1
+            latents = np.load(row["npy_save_path"], mmap_mode="r")
+            offset = shard_file.tell()
+            offset += -offset % SHARD_ALIGNMENT
+            shard_file.seek(offset)
+            shard_file.write(np.ascontiguousarray(latents).tobytes())
+            row.update(
+                shard_path=os.path.abspath(shard_path),
+                shard_offset=offset,
+                latent_dtype=latents.dtype.str,
+                latent_shape=list(latents.shape),
+            )
+            packed += 1
+    finally:
+        if shard_file is not None:
+            shard_file.close()
+
+    table = pa.Table.from_pylist(rows, schema=table.schema)
+    write_index(table, out_index_path or index_path)
+    logger.info(f"Packed {packed} latents into {out_dir}, {len(table)} clips in the index")
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack the .npy latents of a Parquet index into shard files.")
+    parser.add_argument("--index", type=str, required=True, help="Parquet index from video_index.py.")
+    parser.add_argument("--out-dir", type=str, required=True, help="Directory of the shard files.")
+    parser.add_argument("--out-index", type=str, default=None, help="Output index, --index when not given.")
+    parser.add_argument("--shard-size-gb", type=float, default=4.0)
+    args = parser.parse_args()
+    pack_latents(args.index, args.out_dir, args.out_index, args.shard_size_gb)
+
+
+if __name__ == "__main__":
+    main()
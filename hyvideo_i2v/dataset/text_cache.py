@@ -0,0 +1,267 @@
+"""
+Offline text cache for I2V training.
+
+Tokenizing every sample in every epoch, and running the LLM text encoder every training step, gives the
+same result for a fixed clip. This module stores, per row of the dataset index:
+
+- the token ids and masks of both tokenizers (`text_ids`, `text_mask`, `text_ids_2`, `text_mask_2`),
+- with `--encode-text`, the final encoder outputs: `prompt_embeds` / `prompt_mask` of the LLM, which also
+  sees the clip's semantic image (its first frame), and `prompt_embeds_2` of the second encoder. They only
+  match training windows starting at the first frame, so VideoDataset rejects them with a random temporal
+  offset.
+
+The same fields of the empty prompt are kept for text dropout; the LLM one is encoded with a black semantic
+image, i.e. the null condition. With embeddings cached, training needs no text encoder at all.
+
+Each field is split into `.npy` shards of `shard_rows` rows that readers memory-map:
+
+    python -m hyvideo_i2v.dataset.text_cache --data-index-path index.parquet --text-cache-path text_cache \\
+        --encode-text --model-base ckpts
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+from loguru import logger
+
+META_FILE = "meta.json"
+
+
+class TextCacheWriter:
+    """Writes fields of `num_rows` rows into memory-mapped `.npy` shards of `shard_rows` rows."""
+
+    def __init__(self, path, num_rows, shard_rows=4096):
+        self.path = path
+        self.num_rows = num_rows
+        self.shard_rows = shard_rows
+        self.fields = {}
+        self._shards = {}
+        os.makedirs(os.path.join(path, "empty"), exist_ok=True)
+
+    def _shard(self, name, shard_id, array):
+        key = (name, shard_id)
+        if key not in self._shards:
+            if name not in self.fields:
+                self.fields[name] = {"dtype": array.dtype.str, "row_shape": list(array.shape[1:])}
+            rows = min(self.shard_rows, self.num_rows - shard_id * self.shard_rows)
+            self._shards[key] = np.lib.format.open_memmap(
+                os.path.join(self.path, f"{name}-{shard_id:05d}.npy"),
+                mode="w+",
+                dtype=array.dtype,
+                shape=(rows, *array.shape[1:]),
+            )
+        return self._shards[key]
+
+    def write(self, name, start, array):
+        """Rows [start, start + len(array)) of field `name`, which may span shards."""
+        offset = 0
+        while offset < len(array):
+            row = start + offset
+            shard_id, shard_row = divmod(row, self.shard_rows)
+            shard = self._shard(name, shard_id, array)
+            count = min(len(array) - offset, shard.shape[0] - shard_row)
+            shard[shard_row:shard_row + count] = array[offset:offset + count]
+            offset += count
+            if shard_row + count == shard.shape[0]:
+                shard.flush()
+                del self._shards[(name, shard_id)]
+
+    def write_empty(self, name, array):
+        """The field `name` of the empty prompt, one row."""
+        np.save(os.path.join(self.path, "empty", f"{name}.npy"), array)
+
+    def close(self):
+        for shard in self._shards.values():
+            shard.flush()
+        self._shards.clear()
+        with open(os.path.join(self.path, META_FILE), "w") as f:
+            json.dump({"num_rows": self.num_rows, "shard_rows": self.shard_rows, "fields": self.fields}, f)
+
+
+class TextCache:
+    """
+    Read side of the cache. Shards are memory-mapped on first use, so every dataloader worker maps its own.
+
+    Args:
+        path (str): Cache directory written by `TextCacheWriter`.
+        num_rows (int): Rows of the dataset index, checked against the cache.
+    """
+
+    def __init__(self, path, num_rows=None):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        self.num_rows = meta["num_rows"]
+        self.shard_rows = meta["shard_rows"]
+        self.fields = meta["fields"]
+        if num_rows is not None and num_rows != self.num_rows:
+            raise ValueError(f"Text cache {path} has {self.num_rows} rows, the dataset {num_rows}; rebuild it.")
+        self._shards = {}
+        self._empty = {}
+
+    def has(self, name):
+        return name in self.fields
+
+    def get(self, name, idx):
+        """Field `name` of index row `idx`, or of the empty prompt when `idx` is None, as a tensor."""
+        if idx is None:
+            if name not in self._empty:
+                self._empty[name] = torch.from_numpy(np.load(os.path.join(self.path, "empty", f"{name}.npy")))
+            return self._empty[name].clone()
+        shard_id, shard_row = divmod(idx, self.shard_rows)
+        key = (name, shard_id)
+        if key not in self._shards:
+            self._shards[key] = np.load(os.path.join(self.path, f"{name}-{shard_id:05d}.npy"), mmap_mode="r")
+        return torch.from_numpy(np.array(self._shards[key][shard_row]))
+
+
+# ======================== Offline pass ========================
+
+
+def build_text_encoders(args, device):
+    """The text encoders of I2V training, set up like hyvideo_i2v/inference.py."""
+    from hyvideo_i2v.constants import PROMPT_TEMPLATE
+    from hyvideo_i2v.text_encoder import TextEncoder
+
+    if args.i2v_mode:
+        args.text_encoder = "llm-i2v"
+        args.tokenizer = "llm-i2v"
+        args.prompt_template = "dit-llm-encode-i2v"
+        args.prompt_template_video = "dit-llm-encode-video-i2v"
+    image_embed_interleave = {"latent_concat": 2, "token_replace": 4}.get(args.i2v_condition_type, 1)
+    if not args.i2v_mode:
+        image_embed_interleave = 1
+    crop_start = PROMPT_TEMPLATE[args.prompt_template_video].get("crop_start", 0)
+
+    text_encoder = TextEncoder(
+        text_encoder_type=args.text_encoder,
+        max_length=args.text_len + crop_start,
+        text_encoder_precision=args.text_encoder_precision,
+        tokenizer_type=args.tokenizer,
+        i2v_mode=args.i2v_mode,
+        prompt_template=PROMPT_TEMPLATE[args.prompt_template],
+        prompt_template_video=PROMPT_TEMPLATE[args.prompt_template_video],
+        hidden_state_skip_layer=args.hidden_state_skip_layer,
+        apply_final_norm=args.apply_final_norm,
+        reproduce=args.reproduce,
+        logger=logger,
+        device=device,
+        image_embed_interleave=image_embed_interleave,
+    )
+    text_encoder_2 = None
+    if args.text_encoder_2 is not None:
+        text_encoder_2 = TextEncoder(
+            text_encoder_type=args.text_encoder_2,
+            max_length=args.text_len_2,
+            text_encoder_precision=args.text_encoder_precision_2,
+            tokenizer_type=args.tokenizer_2,
+            reproduce=args.reproduce,
+            logger=logger,
+            device=device,
+        )
+    return text_encoder, text_encoder_2
+
+
+def _tokens(text_encoder, prompts):
+    tokens = text_encoder.text2tokens(prompts, data_type="video")
+    return tokens["input_ids"], tokens["attention_mask"]
+
+
+@torch.no_grad()
+def build_text_cache(args, device="cuda"):
+    from hyvideo_i2v.utils.train_utils import get_cond_images
+    from hyvideo_i2v.vae import load_vae
+
+    from .video_loader import VideoDataset
+
+    dataset = VideoDataset(args.data_jsons_path, args=args, data_index_path=args.data_index_path)
+    prompts = dataset.table["prompt"].to_pylist()
+    text_encoder, text_encoder_2 = build_text_encoders(args, device)
+    vae = None
+    if args.encode_text:
+        vae = load_vae(args.vae, args.vae_precision, logger=logger, device=device)[0]
+    embed_dtype = np.dtype(args.text_cache_dtype)
+    writer = TextCacheWriter(args.text_cache_path, len(prompts), args.text_cache_shard_rows)
+
+    def write(start, batch_prompts, semantic_images):
+        text_ids, text_mask = _tokens(text_encoder, batch_prompts)
+        fields = {"text_ids": text_ids.int(), "text_mask": text_mask.to(torch.int8)}
+        if text_encoder_2 is not None:
+            text_ids_2, text_mask_2 = _tokens(text_encoder_2, batch_prompts)
+            fields.update(text_ids_2=text_ids_2.int(), text_mask_2=text_mask_2.to(torch.int8))
+        if args.encode_text:
+            outputs = text_encoder.encode(
+                {"input_ids": text_ids, "attention_mask": text_mask},
+                data_type="video",
+                semantic_images=semantic_images,
+            )
+            fields.update(prompt_embeds=outputs.hidden_state, prompt_mask=outputs.attention_mask.to(torch.int8))
+            if text_encoder_2 is not None:
+                fields["prompt_embeds_2"] = text_encoder_2.encode(
+                    {"input_ids": text_ids_2, "attention_mask": text_mask_2}, data_type="video"
+                ).hidden_state
+        for name, value in fields.items():
+            array = value.cpu().numpy()
+            if value.is_floating_point():
+                array = value.float().cpu().numpy().astype(embed_dtype)
+            if start is None:
+                writer.write_empty(name, array[0])
+            else:
+                writer.write(name, start, array)
+
+    def first_frame_image(idx):
+        # Always latent frame 0: VideoDataset rejects random_temporal_offset with these outputs.
+        latent_shape = dataset.table["latent_shape"][idx].as_py()
+        latents = dataset.read_latents(idx, latent_shape, 0, 1).unsqueeze(0).to(device)
+        return get_cond_images(args, latents * vae.config.scaling_factor, vae)[0]
+
+    semantic_images = None
+    for start in range(0, len(prompts), args.text_cache_batch_size):
+        batch_prompts = prompts[start:start + args.text_cache_batch_size]
+        if args.encode_text:
+            # Clips differ in shape, so the first frames are decoded one by one.
+            semantic_images = [first_frame_image(idx) for idx in range(start, start + len(batch_prompts))]
+        write(start, batch_prompts, semantic_images)
+        logger.info(f"Text cache: {start + len(batch_prompts)}/{len(prompts)}")
+
+    # The null condition: the empty prompt, with a black semantic image for the LLM.
+    if args.encode_text:
+        semantic_images = [np.zeros_like(semantic_images[0])]
+    write(None, [""], semantic_images)
+    writer.close()
+    logger.info(f"Text cache of {len(prompts)} clips written to {args.text_cache_path}")
+
+
+def main():
+    from hyvideo_i2v.config import (
+        add_data_args,
+        add_extra_models_args,
+        add_i2v_args,
+        add_inference_args,
+        add_network_args,
+        sanity_check_args,
+    )
+
+    parser = argparse.ArgumentParser(description="Pre-tokenize and pre-encode the prompts of an I2V dataset.")
+    parser = add_network_args(parser)
+    parser = add_extra_models_args(parser)
+    parser = add_inference_args(parser)
+    parser = add_i2v_args(parser)
+    parser = add_data_args(parser)
+    group = parser.add_argument_group(title="Text cache")
+    group.add_argument("--encode-text", action="store_true",
+                       help="Also store the text encoder outputs, so training does not load the text encoders.")
+    group.add_argument("--text-cache-dtype", type=str, default="float16", choices=["float16", "float32"])
+    group.add_argument("--text-cache-batch-size", type=int, default=8)
+    group.add_argument("--text-cache-shard-rows", type=int, default=4096)
+    args = sanity_check_args(parser.parse_args())
+    if args.text_cache_path is None:
+        parser.error("--text-cache-path is required.")
+    build_text_cache(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Parquet index of a training clip directory.
+
+`VideoDataset` used to list the metadata directory and parse every clip JSON on start, on every DDP rank and
+in every dataloader worker. The index compiles the JSONs once into one Parquet file with the columns the
+dataset reads, which it memory-maps instead:
+
+    python -m hyvideo_i2v.dataset.video_index --data-jsons-path <dir> --index <dir>/../index.parquet
+
+With `--append`, only the JSON files not yet in the index are parsed and added, so new clips can be indexed
+without rescanning the directory contents.
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from loguru import logger
+
+INDEX_SCHEMA = pa.schema([
+    ('video_id', pa.string()),
+    ('latent_shape', pa.list_(pa.int64())),
+    ('prompt', pa.string()),
+    ('npy_save_path', pa.string()),
+    ('height', pa.int64()),
+    ('width', pa.int64()),
+    ('json_file', pa.string()),
+    # Location in a packed latent shard, null until packed, see latent_store.py.
+    ('shard_path', pa.string()),
+    ('shard_offset', pa.int64()),
+    ('latent_dtype', pa.string()),
+])
+
+
+def read_clip_json(data_jsons_path, json_file):
+    """One index row from the metadata JSON of a clip."""
+    with open(os.path.join(data_jsons_path, json_file), 'r', encoding='utf-8-sig') as file:
+        data = json.load(file)
+    latent_shape = data.get('latent_shape')
+    return {
+        'video_id': data.get('video_id'),
+        'latent_shape': latent_shape,
+        'prompt': data.get('prompt'),
+        'npy_save_path': data.get('npy_save_path'),
+        'height': latent_shape[3],
+        'width': latent_shape[4],
+        'json_file': json_file,
+        'shard_path': None,
+        'shard_offset': None,
+        'latent_dtype': None,
+    }
+
+
+def read_clip_jsons(data_jsons_path, json_files, num_workers=16):
+    """Index table of `json_files`, parsed by a thread pool (the reads dominate on network filesystems)."""
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+        rows = list(pool.map(lambda json_file: read_clip_json(data_jsons_path, json_file), json_files))
+    return pa.Table.from_pylist(rows, schema=INDEX_SCHEMA)
+
+
+def build_index(data_jsons_path, index_path, append=False, num_workers=16):
+    """
+    Write the Parquet index of `data_jsons_path` to `index_path`.
+
+    Args:
+        data_jsons_path (str): Directory of clip metadata JSONs.
+        index_path (str): Parquet file, replaced atomically.
+        append (bool): Keep the rows of an existing index and only parse the JSON files it does not have.
+        num_workers (int): Threads parsing JSON files.
+
+    Returns:
+        pa.Table: The written index.
+    """
+    json_files = sorted(os.listdir(data_jsons_path))
+    table = None
+    if append and os.path.exists(index_path):
+        table = load_index(index_path)
+        indexed = set(table['json_file'].to_pylist())
+        json_files = [json_file for json_file in json_files if json_file not in indexed]
+
+    new_rows = read_clip_jsons(data_jsons_path, json_files, num_workers)
+    table = pa.concat_tables([table, new_rows]) if table is not None else new_rows
+
+    write_index(table, index_path)
+    logger.info(f"Indexed {len(new_rows)} new clips into {index_path}, {len(table)} in total")
+    return table
+
+
+def write_index(table, index_path):
+    """Write the index, replacing `index_path` atomically."""
+    tmp_path = f"{index_path}.tmp"
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, index_path)
+
+
+def load_index(index_path):
+    """The memory-mapped index table."""
+    table = pq.read_table(index_path, memory_map=True)
+    # Indexes written before a column was added read it as nulls.
+    for field in INDEX_SCHEMA:
+        if field.name not in table.column_names:
+            table = table.append_column(field, pa.nulls(len(table), type=field.type))
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile a clip metadata JSON directory into a Parquet index.")
+    parser.add_argument("--data-jsons-path", type=str, required=True, help="Directory of clip metadata JSONs.")
+    parser.add_argument("--index", type=str, required=True, help="Output Parquet file.")
+    parser.add_argument("--append", action="store_true", help="Only add the JSON files missing from the index.")
+    parser.add_argument("--num-workers", type=int, default=16, help="Threads parsing JSON files.")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    build_index(args.data_jsons_path, args.index, append=args.append, num_workers=args.num_workers)
+    logger.info(f"Index built in {time.time() - start_time:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
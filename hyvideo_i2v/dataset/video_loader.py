@@ -6,10 +6,15 @@ import numpy as np
 import json
 import traceback
 import time
-import pyarrow as pa
 
 from torch.utils.data import Dataset
 
+from .bucket_sampler import shape_buckets, window_shape
+from .cond_cache import load_cond_cache
+from .latent_store import read_latent_window, read_shard_window, to_tensor
+from .text_cache import TextCache
+from .video_index import load_index, read_clip_jsons
+
 class VideoDataset(Dataset):
     def __init__(self,
                  data_jsons_path: str,
@@ -20,6 +25,11 @@ class VideoDataset(Dataset):
                  uncond_p=0.0,
                  args=None,
                  logger=None,
+                 data_index_path: str = None,
+                 random_temporal_offset: bool = False,
+                 pin_memory: bool = False,
+                 text_cache_path: str = None,
+                 cond_cache: bool = False,
                  ) -> None:
         """_summary_
 
@@ -32,6 +42,19 @@ class VideoDataset(Dataset):
             uncond_p (float, optional): text uncondition prod. Defaults to 0.0.
             args (_type_, optional): args. Defaults to None.
             logger (_type_, optional): logger. Defaults to None.
+            data_index_path (str, optional): Parquet index built by video_index.py, used instead of
+                scanning `data_jsons_path`. Defaults to None.
+            random_temporal_offset (bool, optional): sample the latent window at a random temporal offset
+                instead of the first frames. Defaults to False.
+            pin_memory (bool, optional): read latent windows into pinned memory (without dataloader
+                workers). Defaults to False.
+            text_cache_path (str, optional): text cache built by text_cache.py, used instead of tokenizing and,
+                if it has them, returned with the text encoder outputs. Those are conditioned on the first frame
+                of the clip, so they cannot be combined with `random_temporal_offset`. Defaults to None.
+            cond_cache (bool, optional): return the conditioning latents and semantic image cached by
+                cond_cache.py next to the latents. They are the first frame of the clip, so this cannot be
+                combined with `random_temporal_offset`, and clips without them are replaced like broken ones,
+                so every sample of a batch has them. Defaults to False.
         """
         self.args = args
         self.sample_n_frames = sample_n_frames
@@ -39,56 +62,52 @@ class VideoDataset(Dataset):
         self.text_encoder = text_encoder
         self.text_encoder_2 = text_encoder_2
         self.uncond_p = uncond_p
+        self.random_temporal_offset = random_temporal_offset
+        self.pin_memory = pin_memory
+        self.cond_cache = cond_cache
+        if cond_cache and random_temporal_offset:
+            raise ValueError("cond_cache holds the first frame of each clip, it cannot be used with "
+                             "random_temporal_offset")
 
         if logger is None:
             from loguru import logger
         self.logger = logger
 
-        json_files = os.listdir(data_jsons_path)
-
-        video_id_list = []
-        latent_shape_list = []
-        prompt_list = []
-        npy_save_path_list = []
-        height_list = []
-        width_list = []
-        for json_file in json_files:
-            with open(f"{data_jsons_path}/{json_file}", 'r', encoding='utf-8-sig') as file:
-                data = json.load(file)
-            video_id = data.get('video_id')
-            latent_shape = data.get('latent_shape')
-            prompt = data.get('prompt')
-            npy_save_path = data.get('npy_save_path')
-
-            video_id_list.append(video_id)
-            latent_shape_list.append(latent_shape)
-            prompt_list.append(prompt)
-            npy_save_path_list.append(npy_save_path)
-            height_list.append(latent_shape[3])
-            width_list.append(latent_shape[4])
-
-        schema = pa.schema([
-            ('video_id', pa.string()),
-            ('latent_shape', pa.list_(pa.int64())),
-            ('prompt', pa.string()),
-            ('npy_save_path', pa.string()),
-            ('height', pa.int64()),
-            ('width', pa.int64()),
-        ])
-
-        video_id_array = pa.array(video_id_list, type=pa.string())
-        latent_shape_array = pa.array(latent_shape_list, type=pa.list_(pa.int64()))
-        prompt_array = pa.array(prompt_list, type=pa.string())
-        npy_save_path_array = pa.array(npy_save_path_list, type=pa.string())
-        height_array = pa.array(height_list, type=pa.int64())
-        width_array = pa.array(width_list, type=pa.int64())
-
-        record_batch = pa.RecordBatch.from_arrays([video_id_array, latent_shape_array, prompt_array,
-                                                   npy_save_path_array, height_array, width_array], schema=schema)
-        self.table = pa.Table.from_batches([record_batch])
-
         s_time = time.time()
-        logger.info(f"load {data_jsons_path} \t cost {time.time() - s_time} s \t total length {len(self.table)}")
+        if data_index_path is not None:
+            self.table = load_index(data_index_path)
+            source = data_index_path
+        else:
+            # Without an index every JSON is parsed here, see video_index.py to build one.
+            self.table = read_clip_jsons(data_jsons_path, os.listdir(data_jsons_path))
+            source = data_jsons_path
+
+        logger.info(f"load {source} \t cost {time.time() - s_time} s \t total length {len(self.table)}")
+
+        self.text_cache = TextCache(text_cache_path, len(self.table)) if text_cache_path is not None else None
+        if random_temporal_offset and self.text_cache is not None and self.text_cache.has("prompt_embeds"):
+            # The cached LLM outputs saw the semantic image of latent frame 0, the first frame of the window only
+            # when it starts at frame 0.
+            raise ValueError("random_temporal_offset needs a text cache without text encoder outputs "
+                             "(built without --encode-text), its semantic images are the clips' first frames")
+        self.semantic_drop_p = getattr(args, "sematic_cond_drop_p", 0.0) if args is not None else 0.0
+        self._shape_buckets = None
+
+    @classmethod
+    def from_args(cls, args, text_encoder=None, text_encoder_2=None, logger=None, **kwargs):
+        """The training dataset set up by the data arguments of hyvideo_i2v/config.py, `kwargs` override them."""
+        options = dict(
+            sample_n_frames=args.sample_n_frames,
+            sample_stride=args.sample_stride,
+            uncond_p=args.uncond_p,
+            data_index_path=args.data_index_path,
+            text_cache_path=args.text_cache_path,
+            random_temporal_offset=args.random_temporal_offset,
+            cond_cache=args.cond_cache,
+        )
+        options.update(kwargs)
+        return cls(args.data_jsons_path, text_encoder=text_encoder, text_encoder_2=text_encoder_2, args=args,
+                   logger=logger, **options)
 
     def __len__(self):
         return len(self.table)
@@ -113,26 +132,49 @@ class VideoDataset(Dataset):
         text_mask = text_inputs["attention_mask"].squeeze(0)
         return text_ids, text_mask
 
+    def read_latents(self, idx, latent_shape, start_idx, length):
+        """Only the latent frames [start_idx, start_idx + length) of a clip, from its shard or its `.npy`."""
+        shard_path = self.table['shard_path'][idx].as_py()
+        if shard_path is not None:
+            window = read_shard_window(
+                shard_path,
+                self.table['shard_offset'][idx].as_py(),
+                self.table['latent_dtype'][idx].as_py(),
+                latent_shape,
+                start_idx,
+                length,
+            )
+        else:
+            window = read_latent_window(self.table['npy_save_path'][idx].as_py(), start_idx, length)
+        return to_tensor(window, pin_memory=self.pin_memory)
+
     def get_batch(self, idx):
         videoid = self.table['video_id'][idx].as_py()
         prompt = self.table['prompt'][idx].as_py()
         pixel_values = torch.tensor(0)
 
-        if random.random() < self.uncond_p:
+        drop_text = random.random() < self.uncond_p
+        if drop_text:
             prompt = ''
 
-        text_ids, text_mask = self.get_text_tokens(self.text_encoder, prompt)
+        text_cache = self.text_cache
+        text_row = None if drop_text else idx
+        if text_cache is not None:
+            text_ids = text_cache.get("text_ids", text_row).long()
+            text_mask = text_cache.get("text_mask", text_row).long()
+        else:
+            text_ids, text_mask = self.get_text_tokens(self.text_encoder, prompt)
         sample_n_frames = self.sample_n_frames
 
-        cache_path = self.table['npy_save_path'][idx].as_py()
-        latents = torch.from_numpy(np.load(cache_path)).squeeze(0)
         sample_n_latent = (sample_n_frames - 1) // 4 + 1
-        start_idx = 0
-        latents = latents[:, start_idx:start_idx + sample_n_latent, ...]
-
-        if latents.shape[1] < sample_n_latent:
+        latent_shape = self.table['latent_shape'][idx].as_py()
+        if latent_shape[-3] < sample_n_latent:
             raise Exception(
-                f' videoid: {videoid} has wrong cache data for temporal buckets of shape {latents.shape}, expected length: {sample_n_latent}')
+                f' videoid: {videoid} has wrong cache data for temporal buckets of shape {latent_shape}, expected length: {sample_n_latent}')
+        start_idx = 0
+        if self.random_temporal_offset:
+            start_idx = random.randint(0, latent_shape[-3] - sample_n_latent)
+        latents = self.read_latents(idx, latent_shape, start_idx, sample_n_latent)
 
         data_info = self.get_data_info(idx)
         num_frames, height, width = data_info['num_frames'], data_info['height'], data_info['width']
@@ -143,7 +185,32 @@ class VideoDataset(Dataset):
             'bucket': [num_frames, height, width],
             "videoid": videoid
         }
-        if self.text_encoder_2 is None:
+        if self.cond_cache:
+            # Raised like a broken clip, so that a batch never mixes samples with and without the cached keys.
+            cached = load_cond_cache(self.table['npy_save_path'][idx].as_py())
+            if cached is None:
+                raise FileNotFoundError(f"videoid: {videoid} has no conditioning cache, see cond_cache.py")
+            kwargs["cond_latent_moments"], kwargs["semantic_image"] = cached
+
+        if text_cache is not None and text_cache.has("prompt_embeds"):
+            # The LLM output also depends on the semantic image, so the only clip-independent dropout is the
+            # null condition (empty prompt, black image), used for text and semantic-image dropout alike.
+            drop_image = random.random() < self.semantic_drop_p
+            llm_row = None if drop_text or drop_image else idx
+            kwargs["prompt_embeds"] = text_cache.get("prompt_embeds", llm_row)
+            kwargs["prompt_mask"] = text_cache.get("prompt_mask", llm_row).long()
+            if text_cache.has("prompt_embeds_2"):
+                kwargs["prompt_embeds_2"] = text_cache.get("prompt_embeds_2", text_row)
+
+        if text_cache is not None and text_cache.has("text_ids_2"):
+            text_ids_2 = text_cache.get("text_ids_2", text_row).long()
+            text_mask_2 = text_cache.get("text_mask_2", text_row).long()
+        elif self.text_encoder_2 is not None:
+            text_ids_2, text_mask_2 = self.get_text_tokens(self.text_encoder_2, prompt)
+        else:
+            text_ids_2 = None
+
+        if text_ids_2 is None:
             return (
                 pixel_values,
                 latents,
@@ -152,7 +219,6 @@ class VideoDataset(Dataset):
                 {k: torch.as_tensor(v) if not isinstance(v, str) else v for k, v in kwargs.items()},
             )
         else:
-            text_ids_2, text_mask_2 = self.get_text_tokens(self.text_encoder_2, prompt)
             return (
                 pixel_values,
                 latents,
@@ -163,6 +229,16 @@ class VideoDataset(Dataset):
                 {k: torch.as_tensor(v) if not isinstance(v, str) else v for k, v in kwargs.items()},
             )
 
+    def retry_index(self, idx):
+        """A random clip to replace a broken one, with the same window shape so bucketed batches still collate."""
+        sample_n_latent = (self.sample_n_frames - 1) // 4 + 1
+        if self._shape_buckets is None:
+            self._shape_buckets = shape_buckets(self.table['latent_shape'].to_pylist(), sample_n_latent)
+        candidates = self._shape_buckets.get(window_shape(self.table['latent_shape'][idx].as_py(), sample_n_latent))
+        if not candidates:
+            return np.random.randint(len(self))
+        return random.choice(candidates)
+
     def __getitem__(self, idx):
         try_times = 100
         for i in range(try_times):
@@ -171,7 +247,7 @@ class VideoDataset(Dataset):
             except Exception as e:
                 self.logger.warning(
                     f"Error details: {str(e)}-{self.table['video_id'][idx]}-{traceback.format_exc()}\n")
-                idx = np.random.randint(len(self))
+                idx = self.retry_index(idx)
 
         raise RuntimeError('Too many bad data.')
 
@@ -42,17 +42,14 @@ def get_cu_seqlens(text_mask, img_len):
         torch.Tensor: the calculated cu_seqlens for flash attention
     """
     batch_size = text_mask.shape[0]
-    text_len = text_mask.sum(dim=1)
+    text_len = text_mask.sum(dim=1).to(torch.int32)
     max_len = text_mask.shape[1] + img_len
 
-    cu_seqlens = torch.zeros([2 * batch_size + 1], dtype=torch.int32, device="cuda")
-
-    for i in range(batch_size):
-        s = text_len[i] + img_len
-        s1 = i * max_len + s
-        s2 = (i + 1) * max_len
-        cu_seqlens[2 * i + 1] = s1
-        cu_seqlens[2 * i + 2] = s2
+    # [0, s_0, max_len, max_len + s_1, 2 * max_len, ...], built without host syncs.
+    offsets = torch.arange(batch_size, dtype=torch.int32, device=text_mask.device) * max_len
+    cu_seqlens = torch.zeros([2 * batch_size + 1], dtype=torch.int32, device=text_mask.device)
+    cu_seqlens[1::2] = offsets + text_len + img_len
+    cu_seqlens[2::2] = offsets + max_len
 
     return cu_seqlens
 
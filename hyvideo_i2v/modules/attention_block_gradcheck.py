@@ -0,0 +1,209 @@
+"""
+Gradient check of the block-sparse attention backward of attention_block_triton_diffres.py.
+
+Runs `BlockSparseAttentionFunction` under Jenga block masks (importance-selected blocks plus the rear text
+blocks, `text_amp` on the text logits, and sequence lengths ending inside the last block). It compares the
+output and the q/k/v gradients with autograd through the PyTorch reference
+(hyvideo/modules/attention_block_reference.py) in float64. Batches with a different length per sample also
+go through `block_sparse_attention_combined` with `cu_seqlens`, as in the model, where the rear text rows run
+dense; every row within its sample's length is checked. On CPU the kernels run in the Triton interpreter:
+
+    TRITON_INTERPRET=1 python -m hyvideo_i2v.modules.attention_block_gradcheck
+
+A mismatch raises, so the exit code can gate regressions.
+"""
+
+import argparse
+import os
+from dataclasses import dataclass
+
+import torch
+from loguru import logger
+
+from hyvideo.modules.attention_block_reference import block_sparse_attention_lse
+
+from .attention_block_triton_diffres import (
+    BlockSparseAttentionFunction,
+    _build_block_index_with_importance_optimized,
+    block_sparse_attention_combined,
+)
+
+
+@dataclass
+class Case:
+    batch_size: int = 1
+    heads: int = 2
+    num_blocks: int = 6
+    text_blocks: int = 2
+    block_size: int = 16
+    head_dim: int = 16
+    padding: int = 0  # tokens cut from the end by the sequence length
+    top_k: int = 1
+    p_remain_rate: float = 0.3
+    text_amp: float = 0.0
+
+
+CASES = [
+    Case(),
+    Case(padding=5, text_amp=-0.5),
+    Case(batch_size=2, heads=3, num_blocks=8, head_dim=32, top_k=2, text_amp=0.25),
+    Case(num_blocks=5, text_blocks=1, padding=11, p_remain_rate=0.9),
+]
+
+
+@dataclass
+class CombinedCase:
+    seqlens: tuple = (88, 75)  # valid tokens of each sample, all image tokens and part of the text
+    heads: int = 2
+    num_blocks: int = 6
+    text_blocks: int = 2
+    block_size: int = 16
+    head_dim: int = 16
+    top_k: int = 2
+    p_remain_rate: float = 0.3
+    text_amp: float = 0.25
+
+
+COMBINED_CASES = [
+    CombinedCase(),
+    CombinedCase(seqlens=(70, 93), heads=3, top_k=1, text_amp=-0.5),
+]
+
+
+def _check_case(case, device, dtype, atol, rtol):
+    n_ctx = case.num_blocks * case.block_size
+    seqlen = n_ctx - case.padding
+    normal_blocks = case.num_blocks - case.text_blocks
+    normal_tokens = normal_blocks * case.block_size
+    sm_scale = case.head_dim ** -0.5
+
+    q, k, v = (
+        torch.randn(case.batch_size, case.heads, n_ctx, case.head_dim, device=device, dtype=dtype)
+        for _ in range(3)
+    )
+    block_mask = _build_block_index_with_importance_optimized(
+        q[:, :, :normal_tokens], k, case.top_k, case.block_size, case.block_size,
+        text_start_block=normal_blocks, num_blocks=case.num_blocks,
+        prob_threshold=case.p_remain_rate, text_blocks=case.text_blocks,
+    )
+    seqlens = torch.full((case.batch_size,), seqlen, dtype=torch.int32, device=device)
+
+    inputs = [x.clone().requires_grad_() for x in (q, k, v)]
+    output = BlockSparseAttentionFunction.apply(
+        inputs[0][:, :, :normal_tokens], inputs[1], inputs[2], seqlens, block_mask, sm_scale,
+        case.block_size, case.block_size, case.text_amp, normal_blocks,
+    )
+    ref_inputs = [x.detach().double().requires_grad_() for x in (q, k, v)]
+    ref_output, _ = block_sparse_attention_lse(
+        ref_inputs[0][:, :, :normal_tokens], ref_inputs[1], ref_inputs[2], block_mask, seqlen, sm_scale,
+        case.block_size, case.block_size, text_amp=case.text_amp, text_block_start=normal_blocks,
+    )
+
+    grad_output = torch.randn_like(output)
+    output.backward(grad_output)
+    ref_output.backward(grad_output.double())
+
+    torch.testing.assert_close(output.double(), ref_output, atol=atol, rtol=rtol, msg=lambda m: f"{case}: o: {m}")
+    for name, x, ref_x in zip("qkv", inputs, ref_inputs):
+        torch.testing.assert_close(
+            x.grad.double(), ref_x.grad, atol=atol, rtol=rtol, msg=lambda m, name=name: f"{case}: d{name}: {m}"
+        )
+    density = block_mask[..., :normal_blocks].float().mean().item()
+    logger.info(f"{case}: output and q/k/v gradients match, image block density {density:.2f}")
+
+
+def _check_combined_case(case, device, dtype, atol, rtol):
+    batch_size = len(case.seqlens)
+    n_ctx = case.num_blocks * case.block_size
+    normal_blocks = case.num_blocks - case.text_blocks
+    normal_tokens = normal_blocks * case.block_size
+    sm_scale = case.head_dim ** -0.5
+
+    # [B, L, H, D] and cu_seqlens as the model passes them, see get_cu_seqlens in attenion.py.
+    q, k, v = (
+        torch.randn(batch_size, n_ctx, case.heads, case.head_dim, device=device, dtype=dtype) for _ in range(3)
+    )
+    offsets = torch.arange(batch_size, dtype=torch.int32, device=device) * n_ctx
+    cu_seqlens = torch.zeros(2 * batch_size + 1, dtype=torch.int32, device=device)
+    cu_seqlens[1::2] = offsets + torch.tensor(case.seqlens, dtype=torch.int32, device=device)
+    cu_seqlens[2::2] = offsets + n_ctx
+
+    inputs = [x.clone().requires_grad_() for x in (q, k, v)]
+    output = block_sparse_attention_combined(
+        *inputs, case.top_k, case.block_size, case.block_size, cu_seqlens_q=cu_seqlens, cu_seqlens_kv=cu_seqlens,
+        text_blocks=case.text_blocks, text_amp=case.text_amp, prob_threshold=case.p_remain_rate, shape_xfuse=True,
+    )
+    # The same selection as inside block_sparse_attention_combined.
+    block_mask = _build_block_index_with_importance_optimized(
+        q.transpose(1, 2)[:, :, :normal_tokens], k.transpose(1, 2), case.top_k, case.block_size, case.block_size,
+        text_start_block=normal_blocks, num_blocks=case.num_blocks,
+        prob_threshold=case.p_remain_rate, text_blocks=case.text_blocks,
+    )
+    # The text rows attend densely to every key of their sample, without text_amp.
+    dense_mask = block_mask.new_ones(batch_size, case.heads, case.num_blocks, case.num_blocks)
+    ref_inputs = [x.detach().double().requires_grad_() for x in (q, k, v)]
+    ref_q, ref_k, ref_v = (x.transpose(1, 2) for x in ref_inputs)
+    # The reference takes one sequence length, so samples run one by one.
+    ref_output = torch.cat([
+        torch.cat([
+            block_sparse_attention_lse(
+                ref_q[b:b + 1, :, :normal_tokens], ref_k[b:b + 1], ref_v[b:b + 1], block_mask[b:b + 1], seqlen,
+                sm_scale, case.block_size, case.block_size, text_amp=case.text_amp, text_block_start=normal_blocks,
+            )[0],
+            block_sparse_attention_lse(
+                ref_q[b:b + 1], ref_k[b:b + 1], ref_v[b:b + 1], dense_mask[b:b + 1], seqlen, sm_scale,
+                case.block_size, case.block_size,
+            )[0][:, :, normal_tokens:],
+        ], dim=2)
+        for b, seqlen in enumerate(case.seqlens)
+    ]).transpose(1, 2)
+    # Rows past a sample's length are padding, their outputs are not checked and get no gradient.
+    valid = torch.arange(n_ctx, device=device) < torch.tensor(case.seqlens, device=device)[:, None]
+    valid = valid[:, :, None, None]
+
+    grad_output = torch.randn_like(output) * valid
+    output.backward(grad_output)
+    ref_output.backward(grad_output.double())
+
+    output = output.double() * valid
+    ref_output = ref_output.detach() * valid
+    torch.testing.assert_close(output, ref_output, atol=atol, rtol=rtol, msg=lambda m: f"{case}: o: {m}")
+    for name, x, ref_x in zip("qkv", inputs, ref_inputs):
+        torch.testing.assert_close(
+            x.grad.double(), ref_x.grad, atol=atol, rtol=rtol, msg=lambda m, name=name: f"{case}: d{name}: {m}"
+        )
+    logger.info(f"{case}: output and q/k/v gradients match with per-sample sequence lengths")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the block-sparse attention backward against the reference.")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--atol", type=float, default=None,
+                        help="Defaults to 2e-4 for float32 in the interpreter, 1e-2 for TF32 dots on GPU, 3e-2 for "
+                             "half precision.")
+    parser.add_argument("--rtol", type=float, default=None, help="Defaults like --atol.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.device == "cpu" and os.environ.get("TRITON_INTERPRET") != "1":
+        parser.error("Running the kernels on CPU needs the Triton interpreter: set TRITON_INTERPRET=1.")
+    dtype = getattr(torch, args.dtype)
+    tol = 3e-2
+    if dtype == torch.float32:
+        tol = 2e-4 if args.device == "cpu" else 1e-2
+    atol = args.atol if args.atol is not None else tol
+    rtol = args.rtol if args.rtol is not None else tol
+
+    torch.manual_seed(args.seed)
+    for case in CASES:
+        _check_case(case, torch.device(args.device), dtype, atol, rtol)
+    for case in COMBINED_CASES:
+        _check_combined_case(case, torch.device(args.device), dtype, atol, rtol)
+    logger.info(
+        f"Block-sparse attention backward matches the reference on {len(CASES) + len(COMBINED_CASES)} cases"
+    )
+
+
+if __name__ == "__main__":
+    main()
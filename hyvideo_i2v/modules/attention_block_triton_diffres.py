@@ -4,6 +4,8 @@
 # modified from MInference code.
 # here we implement an diff res version.
 
+import contextlib
+
 import numpy as np
 import torch
 import triton
@@ -12,7 +14,24 @@ import time
 
 import torch._dynamo
 torch._dynamo.config.suppress_errors = True
-from flash_attn import flash_attn_func
+try:
+    from flash_attn import flash_attn_func
+except ImportError:
+    flash_attn_func = None
+
+
+
+def _triton_dtype(dtype):
+    if dtype == torch.bfloat16:
+        return tl.bfloat16
+    if dtype == torch.float32:
+        return tl.float32
+    return tl.float16
+
+
+def _device_guard(device):
+    # Under the Triton interpreter (TRITON_INTERPRET=1) the kernels run on CPU tensors.
+    return torch.cuda.device(device) if device.type == "cuda" else contextlib.nullcontext()
 
 # from flash_attn import flash_attn_varlen_func
 # import pycuda.autoprimaryctx
@@ -40,6 +59,7 @@ def _triton_block_sparse_attn_fwd_kernel_onehot(
     Q, K, V, seqlens, qk_scale, text_amp_runtime, text_block_start_runtime,
     block_mask,  # [BATCH*HEADS, NUM_ROWS, NUM_BLOCKS] one-hot mask
     Out,
+    Lse,  # [BATCH*HEADS, N_CTX] log2-sum-exp of each row, written when RETURN_LSE
     stride_qz, stride_qh, stride_qm, stride_qk,
     stride_kz, stride_kh, stride_kn, stride_kk,
     stride_vz, stride_vh, stride_vn, stride_vk,
@@ -52,6 +72,7 @@ def _triton_block_sparse_attn_fwd_kernel_onehot(
     BLOCK_DMODEL: tl.constexpr,
     dtype: tl.constexpr,
     is_text_block: tl.constexpr,  # indicates whether this is a text block
+    RETURN_LSE: tl.constexpr = False,
 ):
     start_m = tl.program_id(0)  # Current query block being processed
     off_hz = tl.program_id(1)   # batch * head index
@@ -65,13 +86,15 @@ def _triton_block_sparse_attn_fwd_kernel_onehot(
     offs_n = tl.arange(0, BLOCK_N)
     offs_d = tl.arange(0, BLOCK_DMODEL)
 
-    qo_offset = (off_hz // H) * stride_qz + (off_hz % H) * stride_qh
+    q_offset = (off_hz // H) * stride_qz + (off_hz % H) * stride_qh
     kv_offset = (off_hz // H) * stride_kz + (off_hz % H) * stride_kh
+    # JENGA: Out has its own strides, q may be a strided slice while Out is allocated contiguous.
+    o_offset = (off_hz // H) * stride_oz + (off_hz % H) * stride_oh
 
-    q_ptrs = Q + qo_offset + offs_m[:, None] * stride_qm + offs_d[None, :] * stride_qk
+    q_ptrs = Q + q_offset + offs_m[:, None] * stride_qm + offs_d[None, :] * stride_qk
     k_ptrs = K + kv_offset + offs_d[:, None] * stride_kk
     v_ptrs = V + kv_offset + offs_d[None, :] * stride_vk
-    o_ptrs = Out + qo_offset + offs_m[:, None] * stride_om + offs_d[None, :] * stride_ok
+    o_ptrs = Out + o_offset + offs_m[:, None] * stride_om + offs_d[None, :] * stride_ok
 
     # Current block mask row corresponding to this batch*head and query block
     mask_ptr = block_mask + off_hz * stride_bz + start_m * stride_bm
@@ -131,9 +154,13 @@ def _triton_block_sparse_attn_fwd_kernel_onehot(
             l_i = l_i * alpha + tl.sum(p, 1)
             m_i = m_i_new
 
-    # write back O
-    acc /= l_i[:, None]
+    # write back O, rows without a selected block stay zero
+    has_keys = l_i > 0
+    acc /= tl.where(has_keys, l_i, 1.0)[:, None]
     tl.store(o_ptrs, acc.to(dtype), mask=m_mask)
+    if RETURN_LSE:
+        lse = tl.where(has_keys, m_i + tl.math.log2(tl.where(has_keys, l_i, 1.0)), float("-inf"))
+        tl.store(Lse + off_hz * N_CTX + offs_m, lse, mask=offs_m < seqlen)
 
 
 def _triton_block_sparse_attention_onehot(
@@ -148,12 +175,16 @@ def _triton_block_sparse_attention_onehot(
     is_text_block=False,  # indicates whether this is a text block
     text_amp=0.0,         # controls scaling of qk values for text blocks
     text_block_start=0,   # starting index of text blocks
+    return_lse=False,     # also return the log2-sum-exp of each row, [BATCH, N_HEADS, N_CTX] float32
 ) -> torch.Tensor:
     # shape constraints
     Lq, Lk, Lv = q.shape[-1], k.shape[-1], v.shape[-1]
     assert Lq == Lk and Lk == Lv
     assert Lk in {16, 32, 64, 128}
     o = torch.zeros_like(q)
+    lse = None
+    if return_lse:
+        lse = torch.full(q.shape[:3], float("-inf"), dtype=torch.float32, device=q.device)
     
     batch_size, n_heads = q.shape[0], q.shape[1]
     num_query_blocks = block_mask.shape[-2]
@@ -164,10 +195,7 @@ def _triton_block_sparse_attention_onehot(
     
     grid = (num_query_blocks, batch_size * n_heads, 1)
     
-    if q.dtype == torch.bfloat16:
-        dtype = tl.bfloat16
-    else:
-        dtype = tl.float16
+    dtype = _triton_dtype(q.dtype)
 
     qk_scale = sm_scale * 1.44269504
 
@@ -176,11 +204,12 @@ def _triton_block_sparse_attention_onehot(
     if not block_mask_reshaped.device == q.device:
         block_mask_reshaped = block_mask_reshaped.to(q.device)
     
-    with torch.cuda.device(q.device):
+    with _device_guard(q.device):
         _triton_block_sparse_attn_fwd_kernel_onehot[grid](
             q, k, v, seqlens, qk_scale, text_amp, text_block_start,
             block_mask_reshaped,
             o,
+            lse if return_lse else o,
             q.stride(0), q.stride(1), q.stride(2), q.stride(3),
             k.stride(0), k.stride(1), k.stride(2), k.stride(3),
             v.stride(0), v.stride(1), v.stride(2), v.stride(3),
@@ -192,9 +221,238 @@ def _triton_block_sparse_attention_onehot(
             BLOCK_DMODEL=Lk,
             dtype=dtype,
             is_text_block=is_text_block,
+            RETURN_LSE=return_lse,
         )
+    if return_lse:
+        return o, lse
     return o
 
+@triton.jit
+def _triton_block_sparse_attn_bwd_dq_kernel_onehot(
+    Q, K, V, DO, DQ, Lse, Delta, seqlens, qk_scale, sm_scale, text_amp_runtime, text_block_start_runtime,
+    block_mask,  # [BATCH*HEADS, NUM_ROWS, NUM_BLOCKS] one-hot mask of the forward
+    stride_qz, stride_qh, stride_qm, stride_qk,
+    stride_kz, stride_kh, stride_kn, stride_kk,
+    stride_vz, stride_vh, stride_vn, stride_vk,
+    stride_doz, stride_doh, stride_dom, stride_dok,
+    stride_dqz, stride_dqh, stride_dqm, stride_dqk,
+    stride_bz, stride_bm, stride_bn,
+    H, N_CTX,
+    NUM_BLOCKS,
+    BLOCK_M: tl.constexpr,
+    BLOCK_N: tl.constexpr,
+    BLOCK_DMODEL: tl.constexpr,
+    dtype: tl.constexpr,
+):
+    # One program per (query block, batch * head), over the key blocks selected for it, like the forward.
+    start_m = tl.program_id(0)
+    off_hz = tl.program_id(1)
+
+    seqlen = tl.load(seqlens + off_hz // H)
+    if start_m * BLOCK_M >= seqlen:
+        return
+
+    offs_m = start_m * BLOCK_M + tl.arange(0, BLOCK_M)
+    offs_n = tl.arange(0, BLOCK_N)
+    offs_d = tl.arange(0, BLOCK_DMODEL)
+    m_valid = offs_m < seqlen
+
+    q_offset = (off_hz // H) * stride_qz + (off_hz % H) * stride_qh
+    kv_offset = (off_hz // H) * stride_kz + (off_hz % H) * stride_kh
+    do_offset = (off_hz // H) * stride_doz + (off_hz % H) * stride_doh
+    dq_offset = (off_hz // H) * stride_dqz + (off_hz % H) * stride_dqh
+
+    q = tl.load(Q + q_offset + offs_m[:, None] * stride_qm + offs_d[None, :] * stride_qk)
+    q = (q * qk_scale).to(dtype)
+    do = tl.load(DO + do_offset + offs_m[:, None] * stride_dom + offs_d[None, :] * stride_dok)
+    # Rows without a selected key have lse -inf and get no gradient.
+    lse = tl.load(Lse + off_hz * N_CTX + offs_m, mask=m_valid, other=float("inf"))
+    lse = tl.where(lse == float("-inf"), float("inf"), lse)
+    delta = tl.load(Delta + off_hz * N_CTX + offs_m, mask=m_valid, other=0.0)
+    mask_ptr = block_mask + off_hz * stride_bz + start_m * stride_bm
+
+    dq = tl.zeros([BLOCK_M, BLOCK_DMODEL], dtype=tl.float32)
+    for block_idx in range(NUM_BLOCKS):
+        is_valid_block = tl.load(mask_ptr + block_idx * stride_bn)
+        if is_valid_block:
+            cols = block_idx * BLOCK_N + offs_n
+            k = tl.load(K + kv_offset + cols[None, :] * stride_kn + offs_d[:, None] * stride_kk)  # [D, N]
+            vt = tl.load(V + kv_offset + cols[None, :] * stride_vn + offs_d[:, None] * stride_vk)  # [D, N]
+
+            # recompute P from the saved log2-sum-exp
+            qk = tl.dot(q, k)
+            qk = tl.where(block_idx >= text_block_start_runtime, qk + text_amp_runtime, qk)
+            valid = m_valid[:, None] & (cols[None, :] < seqlen)
+            p = tl.where(valid, tl.math.exp2(qk - lse[:, None]), 0.0)
+
+            # dS = P * (dO V^T - rowsum(dO * O))
+            ds = p * (tl.dot(do, vt) - delta[:, None])
+            dq += tl.dot(ds.to(dtype), tl.trans(k))
+
+    dq *= sm_scale
+    tl.store(DQ + dq_offset + offs_m[:, None] * stride_dqm + offs_d[None, :] * stride_dqk, dq.to(dtype),
+             mask=m_valid[:, None])
+
+
+@triton.jit
+def _triton_block_sparse_attn_bwd_dkdv_kernel_onehot(
+    Q, K, V, DO, DK, DV, Lse, Delta, seqlens, qk_scale, sm_scale, text_amp_runtime, text_block_start_runtime,
+    block_mask,  # [BATCH*HEADS, NUM_ROWS, NUM_BLOCKS] one-hot mask of the forward
+    stride_qz, stride_qh, stride_qm, stride_qk,
+    stride_kz, stride_kh, stride_kn, stride_kk,
+    stride_vz, stride_vh, stride_vn, stride_vk,
+    stride_doz, stride_doh, stride_dom, stride_dok,
+    stride_dkz, stride_dkh, stride_dkn, stride_dkk,
+    stride_dvz, stride_dvh, stride_dvn, stride_dvk,
+    stride_bz, stride_bm, stride_bn,
+    H, N_CTX,
+    NUM_ROWS,  # number of query blocks
+    BLOCK_M: tl.constexpr,
+    BLOCK_N: tl.constexpr,
+    BLOCK_DMODEL: tl.constexpr,
+    dtype: tl.constexpr,
+):
+    # One program per (key block, batch * head), over the query blocks that selected it: a column of the mask.
+    start_n = tl.program_id(0)
+    off_hz = tl.program_id(1)
+
+    seqlen = tl.load(seqlens + off_hz // H)
+    if start_n * BLOCK_N >= seqlen:
+        return
+
+    offs_m = tl.arange(0, BLOCK_M)
+    cols = start_n * BLOCK_N + tl.arange(0, BLOCK_N)
+    offs_d = tl.arange(0, BLOCK_DMODEL)
+    kv_valid = cols < seqlen
+
+    q_offset = (off_hz // H) * stride_qz + (off_hz % H) * stride_qh
+    kv_offset = (off_hz // H) * stride_kz + (off_hz % H) * stride_kh
+    do_offset = (off_hz // H) * stride_doz + (off_hz % H) * stride_doh
+    dk_offset = (off_hz // H) * stride_dkz + (off_hz % H) * stride_dkh
+    dv_offset = (off_hz // H) * stride_dvz + (off_hz % H) * stride_dvh
+
+    k = tl.load(K + kv_offset + cols[:, None] * stride_kn + offs_d[None, :] * stride_kk)  # [N, D]
+    v = tl.load(V + kv_offset + cols[:, None] * stride_vn + offs_d[None, :] * stride_vk)  # [N, D]
+    is_text_block_cond = start_n >= text_block_start_runtime
+    mask_ptr = block_mask + off_hz * stride_bz + start_n * stride_bn
+
+    dk = tl.zeros([BLOCK_N, BLOCK_DMODEL], dtype=tl.float32)
+    dv = tl.zeros([BLOCK_N, BLOCK_DMODEL], dtype=tl.float32)
+    for row_idx in range(NUM_ROWS):
+        is_valid_block = tl.load(mask_ptr + row_idx * stride_bm)
+        if is_valid_block:
+            rows = row_idx * BLOCK_M + offs_m
+            m_valid = rows < seqlen
+            q = tl.load(Q + q_offset + rows[:, None] * stride_qm + offs_d[None, :] * stride_qk)  # [M, D]
+            do = tl.load(DO + do_offset + rows[:, None] * stride_dom + offs_d[None, :] * stride_dok)  # [M, D]
+            lse = tl.load(Lse + off_hz * N_CTX + rows, mask=m_valid, other=float("inf"))
+            lse = tl.where(lse == float("-inf"), float("inf"), lse)
+            delta = tl.load(Delta + off_hz * N_CTX + rows, mask=m_valid, other=0.0)
+
+            # recompute P^T from the saved log2-sum-exp
+            qkt = tl.dot(k, tl.trans((q * qk_scale).to(dtype)))  # [N, M]
+            qkt = tl.where(is_text_block_cond, qkt + text_amp_runtime, qkt)
+            valid = kv_valid[:, None] & m_valid[None, :]
+            pt = tl.where(valid, tl.math.exp2(qkt - lse[None, :]), 0.0)
+
+            dv += tl.dot(pt.to(dtype), do)
+            dst = pt * (tl.dot(v, tl.trans(do)) - delta[None, :])
+            dk += tl.dot(dst.to(dtype), q)
+
+    dk *= sm_scale
+    tl.store(DK + dk_offset + cols[:, None] * stride_dkn + offs_d[None, :] * stride_dkk, dk.to(dtype),
+             mask=kv_valid[:, None])
+    tl.store(DV + dv_offset + cols[:, None] * stride_dvn + offs_d[None, :] * stride_dvk, dv.to(dtype),
+             mask=kv_valid[:, None])
+
+
+def _triton_block_sparse_attention_onehot_bwd(
+    do,                # [BATCH, N_HEADS, N_CTX, D_HEAD] gradient of the output
+    q, k, v, o,        # inputs and output of the forward
+    lse,               # [BATCH, N_HEADS, N_CTX] log2-sum-exp of the forward
+    seqlens,
+    block_mask,        # [BATCH, N_HEADS, NUM_QUERIES, NUM_BLOCKS] the forward's one-hot mask
+    sm_scale,
+    block_size_M=128,
+    block_size_N=128,
+    text_amp=0.0,
+    text_block_start=0,
+):
+    """Gradients of q, k and v of `_triton_block_sparse_attention_onehot` under the same block mask."""
+    do = do.to(q.dtype)
+    dq = torch.zeros_like(q)
+    dk = torch.zeros_like(k)
+    dv = torch.zeros_like(v)
+    delta = (o.float() * do.float()).sum(dim=-1).contiguous()
+
+    batch_size, n_heads = q.shape[0], q.shape[1]
+    num_query_blocks = block_mask.shape[-2]
+    num_blocks = block_mask.shape[-1]
+    block_mask_reshaped = block_mask.reshape(batch_size * n_heads, num_query_blocks, num_blocks)
+    dtype = _triton_dtype(q.dtype)
+    qk_scale = sm_scale * 1.44269504
+    block_strides = (block_mask_reshaped.stride(0), block_mask_reshaped.stride(1), block_mask_reshaped.stride(2))
+
+    with _device_guard(q.device):
+        _triton_block_sparse_attn_bwd_dq_kernel_onehot[(num_query_blocks, batch_size * n_heads, 1)](
+            q, k, v, do, dq, lse, delta, seqlens, qk_scale, sm_scale, text_amp, text_block_start,
+            block_mask_reshaped,
+            *q.stride(), *k.stride(), *v.stride(), *do.stride(), *dq.stride(),
+            *block_strides,
+            n_heads, q.shape[2],
+            num_blocks,
+            BLOCK_M=block_size_M, BLOCK_N=block_size_N,
+            BLOCK_DMODEL=q.shape[-1],
+            dtype=dtype,
+        )
+        _triton_block_sparse_attn_bwd_dkdv_kernel_onehot[(num_blocks, batch_size * n_heads, 1)](
+            q, k, v, do, dk, dv, lse, delta, seqlens, qk_scale, sm_scale, text_amp, text_block_start,
+            block_mask_reshaped,
+            *q.stride(), *k.stride(), *v.stride(), *do.stride(), *dk.stride(), *dv.stride(),
+            *block_strides,
+            n_heads, q.shape[2],
+            num_query_blocks,
+            BLOCK_M=block_size_M, BLOCK_N=block_size_N,
+            BLOCK_DMODEL=q.shape[-1],
+            dtype=dtype,
+        )
+    return dq, dk, dv
+
+
+class BlockSparseAttentionFunction(torch.autograd.Function):
+    """
+    `_triton_block_sparse_attention_onehot` with a backward pass. The forward saves its log-sum-exp and the
+    backward recomputes the probabilities under the same block mask, so only the selected blocks are visited
+    both ways. The mask is an input like seqlens: its selection is not differentiated.
+    """
+
+    @staticmethod
+    def forward(ctx, q, k, v, seqlens, block_mask, sm_scale, block_size_M=128, block_size_N=128,
+                text_amp=0.0, text_block_start=0):
+        seqlens = seqlens.to(q.device)
+        block_mask = block_mask.to(q.device)
+        o, lse = _triton_block_sparse_attention_onehot(
+            q, k, v, seqlens, block_mask, sm_scale, block_size_M, block_size_N,
+            text_amp=text_amp, text_block_start=text_block_start, return_lse=True,
+        )
+        ctx.save_for_backward(q, k, v, o, lse, seqlens, block_mask)
+        ctx.sm_scale = sm_scale
+        ctx.block_size_M = block_size_M
+        ctx.block_size_N = block_size_N
+        ctx.text_amp = text_amp
+        ctx.text_block_start = text_block_start
+        return o
+
+    @staticmethod
+    def backward(ctx, do):
+        q, k, v, o, lse, seqlens, block_mask = ctx.saved_tensors
+        dq, dk, dv = _triton_block_sparse_attention_onehot_bwd(
+            do, q, k, v, o, lse, seqlens, block_mask, ctx.sm_scale, ctx.block_size_M, ctx.block_size_N,
+            text_amp=ctx.text_amp, text_block_start=ctx.text_block_start,
+        )
+        return dq, dk, dv, None, None, None, None, None, None, None
+
+
 def _build_block_index_with_importance_optimized(
     query: torch.Tensor,     # [BATCH, N_HEADS, N_CTX, D_HEAD]
     key: torch.Tensor,       # [BATCH, N_HEADS, N_CTX, D_HEAD]
@@ -318,7 +576,8 @@ def block_sparse_attention_combined(
     
     # process variable length sequence
     if cu_seqlens_q is not None and cu_seqlens_kv is not None:
-        seqlens = cu_seqlens_q[1:2]
+        # JENGA: the valid length of every sample, cu_seqlens is [0, s_0, max_len, max_len + s_1, 2 * max_len, ...].
+        seqlens = cu_seqlens_q[1::2] - cu_seqlens_q[0:-1:2]
         seqlens = seqlens.to(torch.int32).to(query.device)
 
         pad = block_size_M - (context_size % block_size_M) if context_size % block_size_M != 0 else 0
@@ -346,23 +605,32 @@ def block_sparse_attention_combined(
         query_normal = query[:, :, :normal_tokens, :]
         if pad > 0:
             query_normal = query_normal.contiguous()
-        # Pass pre-computed pools to block index function
-        block_relation_onehot = _build_block_index_with_importance_optimized(
-            query_normal, key, top_k, block_size_M, block_size_N, 
-            text_start_block=normal_blocks, num_blocks=num_blocks,
-            prob_threshold=prob_threshold,
-            text_blocks=text_blocks,
-            block_neighbor_list=block_neighbor_list
-        )
+        # Pass pre-computed pools to block index function. The selection is not differentiated.
+        with torch.no_grad():
+            block_relation_onehot = _build_block_index_with_importance_optimized(
+                query_normal, key, top_k, block_size_M, block_size_N, 
+                text_start_block=normal_blocks, num_blocks=num_blocks,
+                prob_threshold=prob_threshold,
+                text_blocks=text_blocks,
+                block_neighbor_list=block_neighbor_list
+            )
         
-        # direct use one-hot version sparse attention
-        output_normal = _triton_block_sparse_attention_onehot(
-            query_normal, key, value, seqlens, 
-            block_relation_onehot, sm_scale, block_size_M, block_size_N,
-            is_text_block=False,  # this is not a text block
-            text_amp=text_amp,         # text_amp
-            text_block_start=normal_blocks,   # text block start index
-        )
+        if torch.is_grad_enabled() and (query.requires_grad or key.requires_grad or value.requires_grad):
+            # JENGA: training, the backward reuses the forward's block mask and log-sum-exp.
+            output_normal = BlockSparseAttentionFunction.apply(
+                query_normal, key, value, seqlens,
+                block_relation_onehot, sm_scale, block_size_M, block_size_N,
+                text_amp, normal_blocks,
+            )
+        else:
+            # direct use one-hot version sparse attention
+            output_normal = _triton_block_sparse_attention_onehot(
+                query_normal, key, value, seqlens, 
+                block_relation_onehot, sm_scale, block_size_M, block_size_N,
+                is_text_block=False,  # this is not a text block
+                text_amp=text_amp,         # text_amp
+                text_block_start=normal_blocks,   # text block start index
+            )
     else:
         output_normal = torch.empty(0, device=query.device)
     
@@ -373,10 +641,18 @@ def block_sparse_attention_combined(
         key_text = key  # can see all keys
         value_text = value
         # use Flash Attention
-        output_text = flash_attn_func(
-            query_text.permute(0, 2, 1, 3), key_text.permute(0, 2, 1, 3), value_text.permute(0, 2, 1, 3),
-            causal=False, softmax_scale=sm_scale
-        ).transpose(1, 2)
+        if cu_seqlens_q is None and flash_attn_func is not None:
+            output_text = flash_attn_func(
+                query_text.permute(0, 2, 1, 3), key_text.permute(0, 2, 1, 3), value_text.permute(0, 2, 1, 3),
+                causal=False, softmax_scale=sm_scale
+            ).transpose(1, 2)
+        else:
+            # JENGA: keys past each sample's length (text padding) are masked like in the block-sparse rows,
+            # otherwise the rows of the last blocks would attend to them. Also the fallback without flash-attn.
+            key_valid = torch.arange(key.shape[2], device=query.device) < seqlens[:, None]
+            output_text = torch.nn.functional.scaled_dot_product_attention(
+                query_text, key_text, value_text, attn_mask=key_valid[:, None, None, :], scale=sm_scale
+            )
     else:
         output_text = torch.empty(0, device=query.device)
     
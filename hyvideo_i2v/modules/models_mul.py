@@ -239,7 +239,7 @@ class MMDoubleStreamBlock(nn.Module):
         img_block_num = img_k.shape[1] // per_block_token
         select_block_num = int((1-sa_drop_rate)*img_block_num)
 
-        if curve_sel is not None or not isinstance(curve_sel, int):
+        if curve_sel is not None and not isinstance(curve_sel, int):
             current_curve_sel = random.choice(curve_sel)
             linear_to_hilbert, hilbert_order, block_neighbor_list = current_curve_sel
             # block_neighbor_list = None
@@ -453,7 +453,7 @@ class MMSingleStreamBlock(nn.Module):
         img_block_num = img_k.shape[1] // per_block_token
         select_block_num = int((1-sa_drop_rate)* img_block_num)
 
-        if curve_sel is not None or not isinstance(curve_sel, int):
+        if curve_sel is not None and not isinstance(curve_sel, int):
             current_curve_sel = random.choice(curve_sel)
             linear_to_hilbert, hilbert_order, block_neighbor_list = current_curve_sel
             # block_neighbor_list = None
@@ -726,6 +726,7 @@ class HYVideoDiffusionTransformer(ModelMixin, ConfigMixin):
         guidance: torch.Tensor = None,  # Guidance for modulation, should be cfg_scale x 1000.
         return_dict: bool = True,
         sa_drop_rate: float = 0.0,
+        curve_sel: list = None,  # JENGA: [[linear_to_hilbert, hilbert_order, block_neighbor_list]] of the grid.
     ) -> Union[torch.Tensor, Dict[str, torch.Tensor]]:
         out = {}
         img = x
@@ -778,6 +779,20 @@ class HYVideoDiffusionTransformer(ModelMixin, ConfigMixin):
         txt_seq_len = txt.shape[1]
         img_seq_len = img.shape[1]
 
+        # JENGA: space curve re-indexing as in inference (jenga_hyi2v.py ra_forward), so that the trained
+        # block-sparse attention selects among the same blocks.
+        first_frame_mask = full_first_frame_mask = None
+        if curve_sel is not None:
+            linear_to_hilbert, hilbert_order, _ = curve_sel[0]
+            img = img[:, hilbert_order]
+            freqs_cos = freqs_cos[hilbert_order]
+            freqs_sin = freqs_sin[hilbert_order]
+            if self.i2v_condition_type == "token_replace":
+                first_frame_mask = torch.zeros(img_seq_len, dtype=torch.bool, device=img.device)
+                first_frame_mask[:frist_frame_token_num] = True
+                first_frame_mask = first_frame_mask[hilbert_order]
+                full_first_frame_mask = torch.cat([first_frame_mask, first_frame_mask.new_zeros(txt_seq_len)])
+
         # Compute cu_squlens and max_seqlen for flash attention
         cu_seqlens_q = get_cu_seqlens(text_mask, img_seq_len)
         cu_seqlens_kv = cu_seqlens_q
@@ -797,9 +812,12 @@ class HYVideoDiffusionTransformer(ModelMixin, ConfigMixin):
                 max_seqlen_kv,
                 freqs_cis,
                 sa_drop_rate,
+                first_frame_mask,
                 self.i2v_condition_type,
                 token_replace_vec,
                 frist_frame_token_num,
+                0.0,
+                curve_sel,
             ]
 
             if self.training and self.gradient_checkpoint and \
@@ -823,9 +841,12 @@ class HYVideoDiffusionTransformer(ModelMixin, ConfigMixin):
                     max_seqlen_kv,
                     (freqs_cos, freqs_sin),
                     sa_drop_rate,
+                    full_first_frame_mask,
                     self.i2v_condition_type,
                     token_replace_vec,
                     frist_frame_token_num,
+                    0.0,
+                    curve_sel,
                 ]
 
                 if self.training and self.gradient_checkpoint and \
@@ -835,6 +856,8 @@ class HYVideoDiffusionTransformer(ModelMixin, ConfigMixin):
                     x = block(*single_block_args)
 
         img = x[:, :img_seq_len, ...]
+        if curve_sel is not None:
+            img = img[:, linear_to_hilbert]
 
         # ---------------------------- Final layer ------------------------------
         img = self.final_layer(img, vec)  # (N, T, patch_size ** 2 * out_channels)
@@ -1,5 +1,5 @@
+import functools
 import random
-import torchvision.transforms as transforms
 
 import numpy as np
 import torch
@@ -80,8 +80,12 @@ def numpy_to_pil(images: np.ndarray) -> List[PIL.Image.Image]:
     return pil_images
 
 
-def get_cond_latents(args, latents, vae):
-    """get conditioned latent by decode and encode the first frame latents"""
+def decode_first_frame(latents, vae):
+    """
+    Decode the first latent frame to 8-bit pixel values in [0, 255], (B, 3, H, W) float on the VAE device.
+
+    Rounding to 8 bits reproduces the former PIL round trip without leaving the device.
+    """
     first_image_latents = latents[:, :, 0, ...] if len(latents.shape) == 5 else latents
     first_image_latents = 1 / vae.config.scaling_factor * first_image_latents
     first_images = vae.decode(
@@ -89,48 +93,45 @@ def get_cond_latents(args, latents, vae):
     )[0]
     first_images = first_images.squeeze(2)
     first_images = (first_images / 2 + 0.5).clamp(0, 1)
-    first_images = first_images.cpu().permute(0, 2, 3, 1).float().numpy()
-    first_images = numpy_to_pil(first_images)
+    return (first_images.float() * 255).round()
 
-    image_transform = transforms.Compose(
-        [transforms.ToTensor(), transforms.Normalize([0.5], [0.5])]
-    )
-    first_images_pixel_values = [image_transform(image) for image in first_images]
-    first_images_pixel_values = (
-        torch.cat(first_images_pixel_values).unsqueeze(0).unsqueeze(2).to(vae.device)
-    )
 
+def encode_cond_latent_dist(args, first_images, vae):
+    """The VAE latent distribution of the 8-bit first frames from `decode_first_frame`."""
+    first_images_pixel_values = (first_images / 255 * 2 - 1).unsqueeze(2).to(vae.device)
     vae_dtype = PRECISION_TO_TYPE[args.vae_precision]
     with torch.autocast(
         device_type="cuda", dtype=vae_dtype, enabled=vae_dtype != torch.float32
     ):
-        cond_latents = vae.encode(
-            first_images_pixel_values
-        ).latent_dist.sample()  # B, C, F, H, W
-        cond_latents.mul_(vae.config.scaling_factor)
+        return vae.encode(first_images_pixel_values).latent_dist
+
 
+def get_cond_latents(args, latents, vae, first_images=None):
+    """get conditioned latent by decode and encode the first frame latents"""
+    if first_images is None:
+        first_images = decode_first_frame(latents, vae)
+    cond_latents = encode_cond_latent_dist(args, first_images, vae).sample()  # B, C, F, H, W
+    cond_latents.mul_(vae.config.scaling_factor)
     return cond_latents
 
 
-def get_cond_images(args, latents, vae, is_uncond=False):
-    """get conditioned images by decode the first frame latents"""
-    sematic_image_latents = (
-        latents[:, :, 0, ...] if len(latents.shape) == 5 else latents
-    )
-    sematic_image_latents = 1 / vae.config.scaling_factor * sematic_image_latents
-    semantic_images = vae.decode(
-        sematic_image_latents.unsqueeze(2).to(vae.dtype), return_dict=False
-    )[0]
-    semantic_images = semantic_images.squeeze(2)
-    semantic_images = (semantic_images / 2 + 0.5).clamp(0, 1)
-    semantic_images = semantic_images.cpu().permute(0, 2, 3, 1).float().numpy()
-    semantic_images = numpy_to_pil(semantic_images)
+def get_cond_images(args, latents, vae, is_uncond=False, first_images=None):
+    """get conditioned images by decode the first frame latents, as (H, W, 3) uint8 arrays for the processor"""
+    if first_images is None:
+        first_images = decode_first_frame(latents, vae)
+    semantic_images = first_images.permute(0, 2, 3, 1).to(torch.uint8)
     if is_uncond:
-        semantic_images = [
-            black_image(img.size[0], img.size[1]) for img in semantic_images
-        ]
+        semantic_images = torch.zeros_like(semantic_images)
+    return list(semantic_images.cpu().numpy())
+
 
-    return semantic_images
+def sample_cached_cond_latents(cond_latent_moments, vae):
+    """
+    Conditioning latents from the cached (mean, std) of their VAE distribution, (B, 2, C, 1, h, w), see
+    hyvideo_i2v/dataset/cond_cache.py. Sampling here keeps the VAE posterior noise of the live path.
+    """
+    mean, std = cond_latent_moments.unbind(1)
+    return (mean + std * torch.randn_like(std)) * vae.config.scaling_factor
 
 
 def load_state_dict(args, model, logger):
@@ -302,32 +303,54 @@ def prepare_model_inputs(
             f"Only support media/latent with shape (b, c, h, w) or (b, c, f, h, w), but got {media.shape} {latents.shape}."
         )
 
-    cond_latents = get_cond_latents(args, latents, vae)
-    is_uncond = (
-        torch.tensor(1).to(torch.int64)
-        if random.random() < args.sematic_cond_drop_p
-        else torch.tensor(0).to(torch.int64)
-    )
-    semantic_images = get_cond_images(args, latents, vae, is_uncond=is_uncond)
+    # ================================== Conditioning latents ===================================
+    # Cached by hyvideo_i2v/dataset/cond_cache.py, otherwise from one on-device decode of the first frame.
+    first_images = None
+    if "cond_latent_moments" in kwargs:
+        cond_latents = sample_cached_cond_latents(kwargs["cond_latent_moments"].to(device), vae)
+    else:
+        first_images = decode_first_frame(latents, vae)
+        cond_latents = get_cond_latents(args, latents, vae, first_images=first_images)
 
     # ======================================== Encode text ======================================
-    # Autocast is handled by text_encoder itself.
-    # Whether to apply text_mask is determined by args.use_attention_mask.
-    text_outputs = text_encoder.encode(
-        {"input_ids": text_ids, "attention_mask": text_mask},
-        data_type=batch_args[-1]["type"][0],
-        semantic_images=semantic_images,
-    )
-    text_states = text_outputs.hidden_state
-    text_mask = text_outputs.attention_mask
-    text_states_2 = (
-        text_encoder_2.encode(
-            {"input_ids": text_ids_2, "attention_mask": text_mask_2},
-            data_type=data_type,
-        ).hidden_state
-        if text_encoder_2 is not None
-        else None
-    )
+    if "prompt_embeds" in kwargs:
+        # Encoded offline with the semantic image and dropout applied, see hyvideo_i2v/dataset/text_cache.py.
+        text_states = kwargs["prompt_embeds"].to(device)
+        text_mask = kwargs["prompt_mask"].to(device)
+        text_states_2 = kwargs["prompt_embeds_2"].to(device) if "prompt_embeds_2" in kwargs else None
+    else:
+        is_uncond = (
+            torch.tensor(1).to(torch.int64)
+            if random.random() < args.sematic_cond_drop_p
+            else torch.tensor(0).to(torch.int64)
+        )
+        if "semantic_image" in kwargs:
+            semantic_images = kwargs["semantic_image"]
+            if is_uncond:
+                semantic_images = torch.zeros_like(semantic_images)
+            semantic_images = list(semantic_images.numpy())
+        else:
+            semantic_images = get_cond_images(
+                args, latents, vae, is_uncond=is_uncond, first_images=first_images
+            )
+
+        # Autocast is handled by text_encoder itself.
+        # Whether to apply text_mask is determined by args.use_attention_mask.
+        text_outputs = text_encoder.encode(
+            {"input_ids": text_ids, "attention_mask": text_mask},
+            data_type=batch_args[-1]["type"][0],
+            semantic_images=semantic_images,
+        )
+        text_states = text_outputs.hidden_state
+        text_mask = text_outputs.attention_mask
+        text_states_2 = (
+            text_encoder_2.encode(
+                {"input_ids": text_ids_2, "attention_mask": text_mask_2},
+                data_type=data_type,
+            ).hidden_state
+            if text_encoder_2 is not None
+            else None
+        )
 
     # ======================================== Build RoPE ======================================
     target_ndim = 3  # n-d RoPE
@@ -343,6 +366,13 @@ def prepare_model_inputs(
         rope_interpolation_factor=rope_interpolation_factor,
     )
 
+    # JENGA: with dropped blocks, tokens are blocked along the space curve of inference instead of in raster order.
+    train_sa_drop_rate = getattr(args, "train_sa_drop_rate", 0.0)
+    curve_sel = None
+    if train_sa_drop_rate > 0:
+        patch_size = model.patch_size if isinstance(model.patch_size, list) else [model.patch_size] * ndim
+        curve_sel = get_train_curve(*(s // p for s, p in zip(latents_size, patch_size)), device)
+
     # ===================================== Pack model kwargs ==================================
     model_kwargs = dict(
         text_states=text_states,  # [b, 256, 4096]
@@ -351,6 +381,9 @@ def prepare_model_inputs(
         freqs_cos=freqs_cos,  # [seqlen, head_dim]
         freqs_sin=freqs_sin,  # [seqlen, head_dim]
         return_dict=True,
+        # JENGA: block-sparse attention in training, differentiated under the forward's block mask.
+        sa_drop_rate=train_sa_drop_rate,
+        curve_sel=curve_sel,
     )
 
     return latents, model_kwargs, freqs_cos.shape[0], cond_latents
@@ -371,6 +404,20 @@ def set_manual_seed(global_seed):
     torch.manual_seed(global_seed)
 
 
+@functools.lru_cache(maxsize=None)
+def get_train_curve(latent_time, latent_height, latent_width, device):
+    """JENGA: the curve of a (T, H, W) token grid as build_multi_curve in jenga_hyi2v.py builds it, per shape."""
+    from gilbert import gilbert_block_neighbor_mapping, gilbert_mapping
+
+    linear_to_hilbert, hilbert_order = gilbert_mapping(latent_time, latent_height, latent_width)
+    block_neighbor_list = gilbert_block_neighbor_mapping(latent_time, latent_height, latent_width)
+    return [[
+        torch.tensor(linear_to_hilbert, dtype=torch.long, device=device),
+        torch.tensor(hilbert_order, dtype=torch.long, device=device),
+        block_neighbor_list.to(device),
+    ]]
+
+
 def get_rope_freq_from_size(
     args,
     model,
@@ -223,6 +223,8 @@ def ra_forward(
 def main():
     args = parse_args()
     import json
+    # With the prompt queue every worker sees all prompts and claims them dynamically.
+    shard = slice(None) if args.prompt_queue else slice(args.cur_id, None, args.chunk_num)
 
     if args.prompt is not None and os.path.isfile(args.prompt):
         # Check if it's a JSON file
@@ -245,9 +247,9 @@ def main():
                             ids.append(f"{len(ids):04d}")
                 
                 print(f"Total prompts from JSON: {len(prompts)}")
-                args.prompt = prompts[args.cur_id::args.chunk_num]
-                i2v_image_paths = i2v_image_paths[args.cur_id::args.chunk_num]
-                ids = ids[args.cur_id::args.chunk_num]
+                args.prompt = prompts[shard]
+                i2v_image_paths = i2v_image_paths[shard]
+                ids = ids[shard]
                 print(f"Selected prompts: {len(args.prompt)}", args.cur_id, args.chunk_num)
         else:
             # Original text file reading
@@ -258,9 +260,9 @@ def main():
                 args.prompt = lines
                 ids = [i for i in range(len(args.prompt))]
                 print(f"Total prompts: {len(args.prompt)}")
-                args.prompt = args.prompt[args.cur_id::args.chunk_num]
+                args.prompt = args.prompt[shard]
                 print(f"Total prompts: {len(args.prompt)}", args.cur_id, args.chunk_num)
-                ids = ids[args.cur_id::args.chunk_num]
+                ids = ids[shard]
                 # make to 4 digit string
                 ids = [f"{i:04d}" for i in ids]
     else:
@@ -311,7 +313,19 @@ def main():
     hunyuan_video_sampler.pipeline.transformer.__class__.forward = ra_forward
     hunyuan_video_sampler.pipeline.transformer.__class__.ra_forward = ra_forward
 
-    for i, prompt in enumerate(args.prompt):
+    work = enumerate(args.prompt)
+    prompt_queue = None
+    if args.prompt_queue:
+        from hyvideo.utils.prompt_queue import PromptQueue
+        prompt_queue = PromptQueue(
+            os.path.join(save_path, "prompt_queue.db"),
+            [{"index": i, "prompt": prompt, "image": i2v_image_paths[i]} for i, prompt in enumerate(args.prompt)],
+            lease_seconds=args.prompt_lease_seconds,
+        )
+        # Rank 0 claims and broadcasts, so a sequence-parallel group runs the same prompt and rank 0 completes it.
+        work = ((item["index"], item["prompt"]) for item in prompt_queue.claims(broadcast=True))
+
+    for i, prompt in work:
         # Get the updated args
         args = hunyuan_video_sampler.args
         hunyuan_video_sampler.pipeline.transformer.__class__.enable_teacache = False
@@ -373,12 +387,16 @@ def main():
         
         # Save samples
         if 'LOCAL_RANK' not in os.environ or int(os.environ['LOCAL_RANK']) == 0:
+            saved_paths = []
             for j, sample in enumerate(samples):
                 sample = samples[j].unsqueeze(0)
                 time_flag = datetime.fromtimestamp(time.time()).strftime("%m-%d-%H:%M")
                 cur_save_path = f"{save_path}/id_{ids[i]}_{time_flag}_seed{outputs['seeds'][j]}_{outputs['prompts'][j].replace('/','')[:100]}_.mp4"
                 save_videos_grid(sample, cur_save_path, fps=24)
+                saved_paths.append(cur_save_path)
                 logger.info(f'Sample save to: {cur_save_path}')
+            if prompt_queue is not None:
+                prompt_queue.complete(saved_paths)
 
 if __name__ == "__main__":
     main()
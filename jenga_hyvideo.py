@@ -12,9 +12,7 @@ from loguru import logger
 from datetime import datetime
 from einops import rearrange
 
-from hyvideo.utils.file_utils import save_videos_grid
 from hyvideo.config import parse_args
-from hyvideo.inference import HunyuanVideoSampler
 from hyvideo.modules.modulate_layers import modulate
 from hyvideo.modules.attenion import attention, parallel_attention, get_cu_seqlens
 from hyvideo.modules.posemb_layers import get_nd_rotary_pos_embed
@@ -26,18 +24,6 @@ from gilbert import transpose_gilbert_mapping, gilbert_mapping, gilbert_block_ne
 
 import torch.distributed as dist
 non_skip_steps = [0,1,2,3,4,7,10,13,16,19,22,25,26,29,32,35,38,41,43,45,46,47,49]
-try:
-    import xfuser
-    from xfuser.core.distributed import (
-        get_sequence_parallel_world_size,
-        get_sequence_parallel_rank,
-        get_sp_group,
-    )
-except:
-    xfuser = None
-    get_sequence_parallel_world_size = None
-    get_sequence_parallel_rank = None
-    get_sp_group = None
 
 
 def build_multi_curve(latent_time, latent_height, latent_width, res_rate_list):
@@ -70,38 +56,59 @@ def ra_forward(
         guidance: torch.Tensor = None,  # Guidance for modulation, should be cfg_scale x 1000.
         sa_drop_rate: float = 0.0,
         return_dict: bool = True,
-        single_block_size: list[int] = [4, 4, 8] # [t, h, w]
+        single_block_size: list[int] = [4, 4, 8], # [t, h, w]
+        cu_seqlens: Optional[torch.Tensor] = None,  # Cached per stage by the pipeline.
+        max_seqlen: Optional[int] = None,
+        modulation_step: Optional[int] = None,  # Index into precompute_modulations.
     ):
         # order_shuffled = [0,1,2].shuffle()
         out = {}
         img = x
         txt = text_states
-        _, _, ot, oh, ow = x.shape
-        tt, th, tw = (
-            ot // self.patch_size[0],
-            oh // self.patch_size[1],
-            ow // self.patch_size[2],
-        )
+        # JENGA: curve-native mode, x is already patchified in curve order as [B, L, C*pt*ph*pw].
+        curve_native = x.dim() == 3
+        if not curve_native:
+            _, _, ot, oh, ow = x.shape
+            tt, th, tw = (
+                ot // self.patch_size[0],
+                oh // self.patch_size[1],
+                ow // self.patch_size[2],
+            )
 
-        # Prepare modulation vectors.
-        vec = self.time_in(t)
+        # JENGA: block modulations and refined text can be precomputed for the whole schedule.
+        step_mods = None
+        double_mods = [None] * len(self.double_blocks)
+        single_mods = [None] * len(self.single_blocks)
+        final_mod = None
+        if modulation_step is not None:
+            step_mods = self.get_step_modulations(modulation_step)
+            double_mods, single_mods, final_mod = step_mods["double"], step_mods["single"], step_mods["final"]
+            vec = None
+        else:
+            # Prepare modulation vectors.
+            vec = self.time_in(t)
 
-        # text modulation
-        vec = vec + self.vector_in(text_states_2)
+            # text modulation
+            vec = vec + self.vector_in(text_states_2)
 
-        # guidance modulation
-        if self.guidance_embed:
-            if guidance is None:
-                raise ValueError(
-                    "Didn't get guidance strength for guidance distilled model."
-                )
+            # guidance modulation
+            if self.guidance_embed:
+                if guidance is None:
+                    raise ValueError(
+                        "Didn't get guidance strength for guidance distilled model."
+                    )
 
-            # our timestep_embedding is merged into guidance_in(TimestepEmbedder)
-            vec = vec + self.guidance_in(guidance)
+                # our timestep_embedding is merged into guidance_in(TimestepEmbedder)
+                vec = vec + self.guidance_in(guidance)
 
         # Embed image and text.
-        img = self.img_in(img)
-        if self.text_projection == "linear":
+        if curve_native:
+            img = self.img_in.forward_tokens(img)
+        else:
+            img = self.img_in(img)
+        if step_mods is not None:
+            txt = step_mods["txt"]
+        elif self.text_projection == "linear":
             txt = self.txt_in(txt)
         elif self.text_projection == "single_refiner":
             txt = self.txt_in(txt, t, text_mask if self.use_attention_mask else None)
@@ -113,14 +120,19 @@ def ra_forward(
         txt_seq_len = txt.shape[1]
         img_seq_len = img.shape[1]
 
-        img = img[:, self.hilbert_order]
-        freqs_cos = freqs_cos[self.hilbert_order]
-        freqs_sin = freqs_sin[self.hilbert_order]
+        if not curve_native:
+            # freqs are already in curve order when the pipeline runs curve-native.
+            img = img[:, self.hilbert_order]
+            freqs_cos = freqs_cos[self.hilbert_order]
+            freqs_sin = freqs_sin[self.hilbert_order]
 
         # Compute cu_squlens and max_seqlen for flash attention
-        cu_seqlens_q = get_cu_seqlens(text_mask, img_seq_len)
+        if cu_seqlens is None:
+            cu_seqlens = get_cu_seqlens(text_mask, img_seq_len)
+            max_seqlen = img_seq_len + txt_seq_len
+        cu_seqlens_q = cu_seqlens
         cu_seqlens_kv = cu_seqlens_q
-        max_seqlen_q = img_seq_len + txt_seq_len
+        max_seqlen_q = max_seqlen
         max_seqlen_kv = max_seqlen_q
 
         freqs_cis = (freqs_cos, freqs_sin) if freqs_cos is not None else None
@@ -154,7 +166,7 @@ def ra_forward(
                         self.curve_sel,
                         self.p_remain_rates,
                     ]
-                    img, txt = block(*double_block_args)
+                    img, txt = block(*double_block_args, mod=double_mods[idx])
                 # Merge txt and img to pass through single stream blocks.
                 x = torch.cat((img, txt), 1)
                 if len(self.single_blocks) > 0:
@@ -173,13 +185,13 @@ def ra_forward(
                             self.curve_sel,
                             self.p_remain_rates,
                         ]
-                        x = block(*single_block_args)
+                        x = block(*single_block_args, mod=single_mods[idx])
 
                 img = x[:, :img_seq_len, ...]
                 self.previous_residual = img - ori_img
         else:    
             # --------------------- Pass through DiT blocks ------------------------
-            for _, block in enumerate(self.double_blocks):
+            for idx, block in enumerate(self.double_blocks):
                 double_block_args = [
                     img,
                     txt,
@@ -194,12 +206,12 @@ def ra_forward(
                     self.curve_sel,
                     self.p_remain_rates,
                 ]
-                img, txt = block(*double_block_args)
+                img, txt = block(*double_block_args, mod=double_mods[idx])
 
             # Merge txt and img to pass through single stream blocks.
             x = torch.cat((img, txt), 1)
             if len(self.single_blocks) > 0:
-                for _, block in enumerate(self.single_blocks):
+                for idx, block in enumerate(self.single_blocks):
                     single_block_args = [
                         x,
                         vec,
@@ -215,7 +227,7 @@ def ra_forward(
                         self.p_remain_rates,
                     ]
 
-                    x = block(*single_block_args)
+                    x = block(*single_block_args, mod=single_mods[idx])
 
             img = x[:, :img_seq_len, ...]
 
@@ -223,11 +235,14 @@ def ra_forward(
         if self.cnt == self.num_steps:
             self.cnt = 0
 
-        img = img[:, self.linear_to_hilbert]
         # ---------------------------- Final layer ------------------------------
-        img = self.final_layer(img, vec)
-
-        img = self.unpatchify(img, tt, th, tw)
+        if curve_native:
+            # final_layer is per-token, the output stays in curve order for the scheduler.
+            img = self.final_layer(img, vec, mod=final_mod)
+        else:
+            img = img[:, self.linear_to_hilbert]
+            img = self.final_layer(img, vec, mod=final_mod)
+            img = self.unpatchify(img, tt, th, tw)
         if return_dict:
             out["x"] = img
             return out
@@ -235,11 +250,15 @@ def ra_forward(
 
 def main():
     args = parse_args()
+    # Heavy stack (diffusers, transformers, flash_attn, xfuser), not needed to parse arguments.
+    from hyvideo.inference import HunyuanVideoSampler
+    from hyvideo.utils.file_utils import save_videos_grid, write_video
     if ".txt" in args.prompt:
         with open(args.prompt, "r") as f:
             prompts = f.readlines()
             prompts = [prompt.strip() for prompt in prompts]
-            prompts = prompts[args.cur_id::args.chunk_num]
+            if not args.prompt_queue:
+                prompts = prompts[args.cur_id::args.chunk_num]
     else:
         prompts = [args.prompt]
         
@@ -269,6 +288,38 @@ def main():
     hunyuan_video_sampler.pipeline.transformer.__class__.forward = ra_forward
     hunyuan_video_sampler.pipeline.transformer.__class__.ra_forward = ra_forward
 
+    decode_worker = None
+    if args.decode_worker == "thread":
+        from hyvideo.constants import PRECISION_TO_TYPE
+        from hyvideo.utils.decode_worker import DecodeWorker
+        decode_worker = DecodeWorker(
+            hunyuan_video_sampler.vae,
+            PRECISION_TO_TYPE[args.vae_precision],
+            max_pending=args.decode_queue_size,
+            enable_tiling=args.vae_tiling,
+            stream_chunk=args.vae_stream_chunk,
+            residency=hunyuan_video_sampler.residency,
+        )
+    elif args.decode_worker == "spool":
+        from hyvideo.utils.decode_worker import LatentSpool
+        decode_worker = LatentSpool(
+            args.latent_spool_dir or os.path.join(save_path, "latent_spool"),
+            max_pending=args.decode_queue_size,
+        )
+
+    prompt_queue = None
+    if args.prompt_queue:
+        from hyvideo.utils.prompt_queue import PromptQueue
+        prompt_queue = PromptQueue(
+            os.path.join(save_path, "prompt_queue.db"),
+            [{"prompt": prompt} for prompt in prompts],
+            lease_seconds=args.prompt_lease_seconds,
+        )
+        prompts = (item["prompt"] for item in prompt_queue.claims())
+
+    pending_writers = []
+    num_videos = 0
+    run_start = time.time()
     for prompt in prompts:
         # Get the updated args
         args = hunyuan_video_sampler.args
@@ -304,18 +355,42 @@ def main():
             res_rate_list=args.res_rate_list,
             step_rate_list=args.step_rate_list,
             scheduler_shift_list=args.scheduler_shift_list,
+            output_type="latent" if decode_worker is not None else "pil",
         )
         samples = outputs['samples']
         gen_time = str(outputs['gen_time']).split('.')[0]
         
         # Save samples
         if 'LOCAL_RANK' not in os.environ or int(os.environ['LOCAL_RANK']) == 0:
+            saved_paths = []
             for i, sample in enumerate(samples):
                 sample = samples[i].unsqueeze(0)
                 time_flag = datetime.fromtimestamp(time.time()).strftime("%m-%d-%H:%M:%S")
                 cur_save_path = f"{save_path}/{args.post_fix}_{time_flag}_seed{outputs['seeds'][i]}_time{gen_time}_{outputs['prompts'][i][:100].replace('/','')}.mp4"
-                save_videos_grid(sample, cur_save_path, fps=24)    
+                saved_paths.append(cur_save_path)
+                num_videos += 1
+                if decode_worker is not None:
+                    # Decoded and saved by the worker while the next prompt is sampled.
+                    decode_worker.submit(sample, cur_save_path)
+                    continue
+                if args.async_save:
+                    # Encoded in the background while the next prompt is sampled.
+                    pending_writers.append(write_video(sample, cur_save_path, fps=24, background=True))
+                else:
+                    save_videos_grid(sample, cur_save_path, fps=24)
                 logger.info(f'Sample save to: {cur_save_path}')
+            if prompt_queue is not None:
+                prompt_queue.complete(saved_paths)
+
+    for writer in pending_writers:
+        writer.close()
+    if decode_worker is not None:
+        decode_worker.close()
+    elapsed = time.time() - run_start
+    logger.info(
+        f"Throughput: {num_videos} videos in {elapsed:.1f}s, {num_videos * 3600 / max(elapsed, 1e-6):.1f} videos/hour"
+        + (" (sampling only, decoded by the spool worker)" if args.decode_worker == "spool" else "")
+    )
 
 if __name__ == "__main__":
     main()
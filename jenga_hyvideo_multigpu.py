@@ -12,9 +12,7 @@ from loguru import logger
 from datetime import datetime
 from einops import rearrange
 
-from hyvideo.utils.file_utils import save_videos_grid
 from hyvideo.config import parse_args
-from hyvideo.inference import HunyuanVideoSampler
 from hyvideo.modules.attenion import get_cu_seqlens
 from typing import Optional
 
@@ -23,19 +21,6 @@ from gilbert import gilbert_mapping, gilbert_block_neighbor_mapping
 
 import torch.distributed as dist
 non_skip_steps = [0,1,2,3,4,7,10,13,16,19,22,25,26,29,32,35,38,41,43,45,46,47,49]
-try:
-    import xfuser
-    from xfuser.core.distributed import (
-        get_sequence_parallel_world_size,
-        get_sequence_parallel_rank,
-        get_sp_group,
-    )
-except:
-    xfuser = None
-    get_sequence_parallel_world_size = None
-    get_sequence_parallel_rank = None
-    get_sp_group = None
-
 # 在GPU上计算多项式函数
 def polynomial_func(x, coeffs):
     result = torch.zeros_like(x)
@@ -102,6 +87,13 @@ def build_multi_curve(latent_time, latent_height, latent_width, res_rate_list):
     return curve_sels
 
 def parallelize_transformer_prores(pipe):
+    # Only the multi-GPU path needs xfuser, single-GPU runs do not import it.
+    from xfuser.core.distributed import (
+        get_sequence_parallel_world_size,
+        get_sequence_parallel_rank,
+        get_sp_group,
+    )
+
     transformer = pipe.transformer
     transformer_sub_forward = transformer.transformer_sub_forward
 
@@ -118,35 +110,54 @@ def parallelize_transformer_prores(pipe):
         guidance: torch.Tensor = None,  # Guidance for modulation, should be cfg_scale x 1000.
         return_dict: bool = True,
         sa_drop_rate: float = 0.0,
+        cu_seqlens: Optional[torch.Tensor] = None,  # Cached per stage by the pipeline, for the local chunk.
+        max_seqlen: Optional[int] = None,
+        modulation_step: Optional[int] = None,  # Index into precompute_modulations.
     ):
         out = {}
         img = x
         txt = text_states
-        _, _, ot, oh, ow = x.shape
-        tt, th, tw = (
-            ot // self.patch_size[0],
-            oh // self.patch_size[1],
-            ow // self.patch_size[2],
-        )
+        # JENGA: curve-native mode, x is already patchified in curve order as [B, L, C*pt*ph*pw].
+        curve_native = x.dim() == 3
+        if not curve_native:
+            _, _, ot, oh, ow = x.shape
+            tt, th, tw = (
+                ot // self.patch_size[0],
+                oh // self.patch_size[1],
+                ow // self.patch_size[2],
+            )
 
-        # Prepare modulation vectors.
-        vec = self.time_in(t)
+        # JENGA: block modulations and refined text can be precomputed for the whole schedule.
+        step_mods = None
+        final_mod = None
+        if modulation_step is not None:
+            step_mods = self.get_step_modulations(modulation_step)
+            final_mod = step_mods["final"]
+            vec = None
+        else:
+            # Prepare modulation vectors.
+            vec = self.time_in(t)
 
-        # text modulation
-        vec = vec + self.vector_in(text_states_2)
+            # text modulation
+            vec = vec + self.vector_in(text_states_2)
 
-        # guidance modulation
-        if self.guidance_embed:
-            if guidance is None:
-                raise ValueError(
-                    "Didn't get guidance strength for guidance distilled model."
-                )
-            # our timestep_embedding is merged into guidance_in(TimestepEmbedder)
-            vec = vec + self.guidance_in(guidance)
+            # guidance modulation
+            if self.guidance_embed:
+                if guidance is None:
+                    raise ValueError(
+                        "Didn't get guidance strength for guidance distilled model."
+                    )
+                # our timestep_embedding is merged into guidance_in(TimestepEmbedder)
+                vec = vec + self.guidance_in(guidance)
 
         # Embed image and text.
-        img = self.img_in(img)
-        if self.text_projection == "linear":
+        if curve_native:
+            img = self.img_in.forward_tokens(img)
+        else:
+            img = self.img_in(img)
+        if step_mods is not None:
+            txt = step_mods["txt"]
+        elif self.text_projection == "linear":
             txt = self.txt_in(txt)
         elif self.text_projection == "single_refiner":
             txt = self.txt_in(txt, t, text_mask if self.use_attention_mask else None)
@@ -160,9 +171,10 @@ def parallelize_transformer_prores(pipe):
         img_seq_len_ori = img_seq_len
 
         # JULIAN: space curve re-indexing.
-        img = img[:, self.hilbert_order] # [bs, sq, xxx]
-        freqs_cos = freqs_cos[self.hilbert_order]
-        freqs_sin = freqs_sin[self.hilbert_order]
+        if not curve_native:
+            img = img[:, self.hilbert_order] # [bs, sq, xxx]
+            freqs_cos = freqs_cos[self.hilbert_order]
+            freqs_sin = freqs_sin[self.hilbert_order]
 
 
         if img_seq_len % get_sequence_parallel_world_size() == 0:
@@ -178,13 +190,21 @@ def parallelize_transformer_prores(pipe):
         # from xfuser.core.long_ctx_attention import xFuserLongContextAttention
         from hyvideo.modules.xdit_ring_atten import xFuserLongContextAttention
 
+        # Created once, the packed all-to-all reuses its communication buffers across blocks and steps.
         for block in transformer.double_blocks + transformer.single_blocks:
-            block.hybrid_seq_parallel_attn = xFuserLongContextAttention()
+            if block.hybrid_seq_parallel_attn is None:
+                block.hybrid_seq_parallel_attn = xFuserLongContextAttention(
+                    use_pack_qkv=not pipe.args.unpacked_qkv_all_to_all,
+                    head_balance_interval=pipe.args.head_balance_interval,
+                )
 
         output = transformer_sub_forward(img, vec, txt, text_mask, freqs_cos, freqs_sin, 
                                         token_per_block=128,
                                         sa_drop_rate=sa_drop_rate,
-                                        return_dict=return_dict)
+                                        return_dict=return_dict,
+                                        cu_seqlens=cu_seqlens,
+                                        max_seqlen=max_seqlen,
+                                        step_mods=step_mods)
 
         
 
@@ -192,10 +212,13 @@ def parallelize_transformer_prores(pipe):
         sample = output["x"]
         sample = get_sp_group().all_gather(sample, dim=split_dim)
         
-        sample = sample[:, self.linear_to_hilbert]
         # ---------------------------- Final layer ------------------------------
-        sample = self.final_layer(sample, vec)  # (N, T, patch_size ** 2 * out_channels)
-        sample = self.unpatchify(sample, tt, th, tw)
+        if curve_native:
+            sample = self.final_layer(sample, vec, mod=final_mod)
+        else:
+            sample = sample[:, self.linear_to_hilbert]
+            sample = self.final_layer(sample, vec, mod=final_mod)  # (N, T, patch_size ** 2 * out_channels)
+            sample = self.unpatchify(sample, tt, th, tw)
 
         output["x"] = sample
         return output
@@ -208,20 +231,32 @@ def transformer_sub_forward(
         self, img, vec, txt, text_mask, freqs_cos, freqs_sin, 
         token_per_block=128,
         sa_drop_rate=0.0,
-        return_dict=True
+        return_dict=True,
+        cu_seqlens=None,
+        max_seqlen=None,
+        step_mods=None,
     ):
     txt_seq_len = txt.shape[1]
     img_seq_len = img.shape[1]
     img_seq_len_ori = img_seq_len
 
     # Compute cu_squlens and max_seqlen for flash attention
-    cu_seqlens_q = get_cu_seqlens(text_mask, img_seq_len)
+    if cu_seqlens is None:
+        cu_seqlens = get_cu_seqlens(text_mask, img_seq_len)
+        max_seqlen = img_seq_len + txt_seq_len
+    cu_seqlens_q = cu_seqlens
     cu_seqlens_kv = cu_seqlens_q
-    max_seqlen_q = img_seq_len + txt_seq_len
+    max_seqlen_q = max_seqlen
     max_seqlen_kv = max_seqlen_q
 
     freqs_cis = (freqs_cos, freqs_sin) if freqs_cos is not None else None
 
+    if step_mods is not None:
+        double_mods, single_mods = step_mods["double"], step_mods["single"]
+    else:
+        double_mods = [None] * len(self.double_blocks)
+        single_mods = [None] * len(self.single_blocks)
+
     if self.enable_skip:
         if self.cnt in non_skip_steps or self.start_stage:
             should_calc = True
@@ -240,7 +275,7 @@ def transformer_sub_forward(
             img += self.previous_residual
         else:
             ori_img = img.clone()
-            for _, block in enumerate(self.double_blocks):
+            for idx, block in enumerate(self.double_blocks):
                 double_block_args = [
                     img,
                     txt,
@@ -255,11 +290,11 @@ def transformer_sub_forward(
                     self.curve_sel,
                     self.p_remain_rates
                 ]
-                img, txt = block(*double_block_args)
+                img, txt = block(*double_block_args, mod=double_mods[idx])
             # Merge txt and img to pass through single stream blocks.
             x = torch.cat((img, txt), 1)
             if len(self.single_blocks) > 0:
-                for _, block in enumerate(self.single_blocks):
+                for idx, block in enumerate(self.single_blocks):
                     single_block_args = [
                         x,
                         vec,
@@ -274,13 +309,13 @@ def transformer_sub_forward(
                         self.curve_sel,
                         self.p_remain_rates
                     ]
-                    x = block(*single_block_args)
+                    x = block(*single_block_args, mod=single_mods[idx])
 
             img = x[:, :img_seq_len, ...]
             self.previous_residual = img - ori_img
     else:    
         # --------------------- Pass through DiT blocks ------------------------
-        for _, block in enumerate(self.double_blocks):
+        for idx, block in enumerate(self.double_blocks):
             double_block_args = [
                 img,
                 txt,
@@ -296,12 +331,12 @@ def transformer_sub_forward(
                 self.p_remain_rates
             ]
 
-            img, txt = block(*double_block_args)
+            img, txt = block(*double_block_args, mod=double_mods[idx])
 
         # Merge txt and img to pass through single stream blocks.
         x = torch.cat((img, txt), 1)
         if len(self.single_blocks) > 0:
-            for _, block in enumerate(self.single_blocks):
+            for idx, block in enumerate(self.single_blocks):
                 single_block_args = [
                     x,
                     vec,
@@ -317,7 +352,7 @@ def transformer_sub_forward(
                     self.p_remain_rates
                 ]
 
-                x = block(*single_block_args)
+                x = block(*single_block_args, mod=single_mods[idx])
 
         img = x[:, :img_seq_len, ...]
 
@@ -333,11 +368,15 @@ def transformer_sub_forward(
 
 def main():
     args = parse_args()
+    # Heavy stack (diffusers, transformers, flash_attn, xfuser), not needed to parse arguments.
+    from hyvideo.inference import HunyuanVideoSampler
+    from hyvideo.utils.file_utils import save_videos_grid, write_video
     if ".txt" in args.prompt:
         with open(args.prompt, "r") as f:
             prompts = f.readlines()
             prompts = [prompt.strip() for prompt in prompts]
-            prompts = prompts[args.cur_id::args.chunk_num]
+            if not args.prompt_queue:
+                prompts = prompts[args.cur_id::args.chunk_num]
     else:
         prompts = [args.prompt]
         
@@ -373,6 +412,17 @@ def main():
     if hunyuan_video_sampler.parallel_args['ulysses_degree'] > 1 or hunyuan_video_sampler.parallel_args['ring_degree'] > 1:
         parallelize_transformer_prores(hunyuan_video_sampler.pipeline)
 
+    prompt_queue = None
+    if args.prompt_queue:
+        from hyvideo.utils.prompt_queue import PromptQueue
+        prompt_queue = PromptQueue(
+            os.path.join(save_path, "prompt_queue.db"),
+            [{"prompt": prompt} for prompt in prompts],
+            lease_seconds=args.prompt_lease_seconds,
+        )
+        prompts = (item["prompt"] for item in prompt_queue.claims(broadcast=True))
+
+    pending_writers = []
     for prompt in prompts:
         # Get the updated args
         args = hunyuan_video_sampler.args
@@ -417,14 +467,34 @@ def main():
         
         # Save samples
         if 'LOCAL_RANK' not in os.environ or int(os.environ['LOCAL_RANK']) == 0:
+            saved_paths = []
             for i, sample in enumerate(samples):
                 sample = samples[i].unsqueeze(0)
                 time_flag = datetime.fromtimestamp(time.time()).strftime("%Y-%m-%d-%H:%M:%S")
                 # torch.save(hunyuan_video_sampler.pipeline.transformer.calc_count[:, LINEAR_TO_HILBERT], f"{save_path}/{time_flag}_calc_count.pt")
                 cur_save_path = f"{save_path}/{args.post_fix}_{time_flag}_seed{outputs['seeds'][i]}_time{gen_time}_{outputs['prompts'][i][:100].replace('/','')}.mp4"
-                save_videos_grid(sample, cur_save_path, fps=24)
+                saved_paths.append(cur_save_path)
+                if args.async_save:
+                    # Encoded in the background while the next prompt is sampled.
+                    pending_writers.append(write_video(sample, cur_save_path, fps=24, background=True))
+                else:
+                    save_videos_grid(sample, cur_save_path, fps=24)
                 
                 logger.info(f'Sample save to: {cur_save_path}')
+            if prompt_queue is not None:
+                prompt_queue.complete(saved_paths)
+
+    for writer in pending_writers:
+        writer.close()
+
+    if args.head_balance_interval > 0 and dist.is_initialized() and dist.get_rank() == 0:
+        from hyvideo.modules.head_balance import log_head_balance
+
+        transformer = hunyuan_video_sampler.pipeline.transformer
+        log_head_balance(
+            getattr(block.hybrid_seq_parallel_attn, "balancer", None)
+            for block in list(transformer.double_blocks) + list(transformer.single_blocks)
+        )
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,46 @@
+#!/bin/bash
+# Description: End-to-end throughput (videos/hour) on a prompt file with inline decode, a decode thread,
+# and two samplers sharing one spool decode process. Compare the "Throughput:" / "Decode worker:" lines.
+
+PROMPTS=${PROMPTS:-./assets/prompt_sora.txt}
+SAVE_PATH=${SAVE_PATH:-./results/decode_bench}
+
+COMMON_ARGS="--video-size 720 1280 \
+    --video-length 125 \
+    --infer-steps 50 \
+    --prompt ${PROMPTS} \
+    --seed 42 \
+    --embedded-cfg-scale 6.0 \
+    --flow-shift 7.0 \
+    --flow-reverse \
+    --sa-drop-rates 0.75 0.85 \
+    --p-remain-rates 0.3 \
+    --res-rate-list 1.0 1.0 \
+    --step-rate-list 0.5 1.0 \
+    --scheduler-shift-list 7 7"
+
+# 1. Denoise, decode and save strictly in sequence.
+CUDA_VISIBLE_DEVICES=0 python3 -u ./jenga_hyvideo.py ${COMMON_ARGS} \
+    --post-fix "Bench_Inline" --save-path ${SAVE_PATH}/inline 2>&1 | grep "Throughput:"
+
+# 2. Decode and save in a background thread while the next prompt is denoised.
+CUDA_VISIBLE_DEVICES=0 python3 -u ./jenga_hyvideo.py ${COMMON_ARGS} \
+    --decode-worker thread --decode-queue-size 2 \
+    --post-fix "Bench_Thread" --save-path ${SAVE_PATH}/thread 2>&1 | grep "Throughput:"
+
+# 3. Two samplers (half of the prompts each) feeding one decode process through a spool directory.
+SPOOL=${SAVE_PATH}/spool/latent_spool
+rm -f ${SPOOL}/STOP
+CUDA_VISIBLE_DEVICES=2 python3 -u -m hyvideo.utils.decode_worker \
+    --latent-spool-dir ${SPOOL} --save-path ${SAVE_PATH}/spool 2>&1 | grep "Decode worker:" &
+DECODER_PID=$!
+SAMPLER_PIDS=()
+for ID in 0 1; do
+    CUDA_VISIBLE_DEVICES=${ID} python3 -u ./jenga_hyvideo.py ${COMMON_ARGS} \
+        --decode-worker spool --latent-spool-dir ${SPOOL} --chunk-num 2 --cur-id ${ID} \
+        --post-fix "Bench_Spool" --save-path ${SAVE_PATH}/spool 2>&1 | grep "Throughput:" &
+    SAMPLER_PIDS+=($!)
+done
+wait "${SAMPLER_PIDS[@]}"
+touch ${SPOOL}/STOP
+wait ${DECODER_PID}
@@ -0,0 +1,30 @@
+#!/bin/bash
+# Description: Import-time regression check for the CLI entry points.
+# Prints the slowest imports (cumulative) of `import jenga_hyvideo` and fails if the total
+# exceeds IMPORTTIME_BUDGET_MS or if a heavy backend (diffusers, transformers, flash_attn,
+# triton, xfuser) is imported eagerly: they are imported on first use.
+
+IMPORTTIME_BUDGET_MS=${IMPORTTIME_BUDGET_MS:-3000}
+MODULE=${1:-jenga_hyvideo}
+
+LOG=$(mktemp)
+python3 -X importtime -c "import ${MODULE}" 2> "${LOG}" || { cat "${LOG}"; exit 1; }
+
+echo "Slowest imports of ${MODULE} (cumulative us):"
+grep "^import time:" "${LOG}" | grep -v "self \[us\]" | sort -t'|' -k2 -n -r | head -n 20
+
+EAGER=0
+for heavy in diffusers transformers flash_attn triton xfuser; do
+    if grep -qE "\| +${heavy}$" "${LOG}"; then
+        echo "ERROR: ${heavy} is imported eagerly by ${MODULE}"
+        EAGER=1
+    fi
+done
+
+TOTAL_US=$(grep -E "\| +${MODULE}$" "${LOG}" | tail -n 1 | awk -F'|' '{gsub(/ /, "", $2); print $2}')
+rm -f "${LOG}"
+TOTAL_MS=$((TOTAL_US / 1000))
+echo "Total: ${TOTAL_MS} ms (budget ${IMPORTTIME_BUDGET_MS} ms)"
+if [ "${EAGER}" -ne 0 ] || [ "${TOTAL_MS}" -gt "${IMPORTTIME_BUDGET_MS}" ]; then
+    exit 1
+fi
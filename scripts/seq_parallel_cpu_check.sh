@@ -0,0 +1,28 @@
+#!/bin/bash
+# Description: Check the Ulysses sequence-parallel forward against a single process on CPU (gloo),
+# with the reference block-sparse backend, and report the all-to-all volume per step. No GPU needed.
+# With the xfuser stack installed, also run a tiny model through parallelize_transformer_prores.
+
+for WORLD_SIZE in 2 4; do
+    python3 -u -m hyvideo.modules.seq_parallel_harness --world-size ${WORLD_SIZE} --steps 3 || exit 1
+    # Re-plan the head-to-rank assignment after every step, the output must not change.
+    python3 -u -m hyvideo.modules.seq_parallel_harness --world-size ${WORLD_SIZE} --steps 3 \
+        --head-balance-interval 1 || exit 1
+    # Sparse ring over all ranks, then Ulysses pairs inside a ring.
+    python3 -u -m hyvideo.modules.seq_parallel_harness --world-size ${WORLD_SIZE} --steps 3 \
+        --ring-degree ${WORLD_SIZE} || exit 1
+    python3 -u -m hyvideo.modules.seq_parallel_harness --world-size ${WORLD_SIZE} --steps 3 \
+        --ring-degree $((WORLD_SIZE / 2)) || exit 1
+    # Head balancing inside a ring, every rank must adopt the same head assignment.
+    python3 -u -m hyvideo.modules.seq_parallel_harness --world-size ${WORLD_SIZE} --steps 3 \
+        --ring-degree $((WORLD_SIZE / 2)) --head-balance-interval 1 || exit 1
+    # The real entry point: parallelize_transformer_prores and xFuserLongContextAttention, with the xfuser stack.
+    if python3 -c "import xfuser, yunchang, flash_attn" 2> /dev/null; then
+        python3 -u -m hyvideo.modules.seq_parallel_harness --world-size ${WORLD_SIZE} --steps 3 \
+            --entry transformer || exit 1
+        python3 -u -m hyvideo.modules.seq_parallel_harness --world-size ${WORLD_SIZE} --steps 3 \
+            --entry transformer --ring-degree $((WORLD_SIZE / 2)) --head-balance-interval 1 || exit 1
+    else
+        echo "xfuser, yunchang or flash_attn not installed, skipping --entry transformer"
+    fi
+done
@@ -0,0 +1,5 @@
+#!/bin/bash
+# Description: Check the block-sparse attention backward (forward output and q/k/v gradients) against the
+# PyTorch reference on CPU with the Triton interpreter. No GPU needed.
+
+TRITON_INTERPRET=1 python3 -u -m hyvideo_i2v.modules.attention_block_gradcheck --device cpu || exit 1
@@ -0,0 +1,4 @@
+#!/bin/bash
+# Description: Check that batched VAE tiling decodes every tile exactly once, on CPU.
+
+python3 -u -m hyvideo.vae.autoencoder_kl_causal_3d || exit 1